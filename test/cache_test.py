@@ -22,6 +22,15 @@ class MockClient:
     def gets(self, key):
         return self._check('gets', (key,))
 
+    def get_multi(self, keys):
+        return self._check('get_multi', (keys,))
+
+    def add_multi(self, mapping, time=0):
+        return self._check('add_multi', (list(mapping), time), list(mapping.values()))
+
+    def set_multi(self, mapping, time=0):
+        return self._check('set_multi', (list(mapping), time), list(mapping.values()))
+
     def add(self, key, value, time=0):
         return self._check('add', (key, time), value)
 
@@ -37,9 +46,18 @@ class MockServer:
         result = value if isinstance(value, BaseException) else (value, cas)
         self.responses.appendleft(('gets', (key,), result))
 
+    def get_multi(self, keys, result):
+        self.responses.appendleft(('get_multi', (keys,), result))
+
     def add(self, key, result, time=0):
         self.responses.appendleft(('add', (key, time), result))
 
+    def add_multi(self, keys, result, time=0):
+        self.responses.appendleft(('add_multi', (keys, time), result))
+
+    def set_multi(self, keys, result, time=0):
+        self.responses.appendleft(('set_multi', (keys, time), result))
+
     def cas(self, key, cas, result, time=0):
         self.responses.appendleft(('cas', (key, cas, time), result))
 
@@ -65,6 +83,10 @@ class E(Exception):
 def error(mc):
     raise E
 
+@cache.mutable('foo_{}')
+def ident(mc, x):
+    return x
+
 def test_hit(mock_cache):
     client, server = mock_cache
     server.gets('foo', 1, 0)
@@ -126,3 +148,161 @@ def test_set_error(mock_cache):
     server.gets('foo', None, 0)
     server.cas('foo', 0, pylibmc.Error(), time=86400)
     assert one(client) == 1
+
+def test_multi(mock_cache):
+    client, server = mock_cache
+    server.get_multi(['foo_1', 'foo_2', 'foo_3'], { 'foo_1': 4, 'foo_2': None })
+    server.add_multi(['foo_3'], [], time=30)
+    server.get_multi(['foo_2', 'foo_3'], { 'foo_2': None, 'foo_3': None })
+    server.set_multi(['foo_2', 'foo_3'], [], time=86400)
+    assert ident.multi(client, [(1,), (2,), (3,)]) == [4, 2, 3]
+    assert client.values[-1] == [2, 3]
+
+def test_multi_batch(mock_cache):
+    client, server = mock_cache
+    server.get_multi(['foo_1', 'foo_2', 'foo_3'], { 'foo_2': 4 })
+    server.add_multi(['foo_1', 'foo_3'], [], time=30)
+    server.get_multi(['foo_1', 'foo_3'], { 'foo_1': None, 'foo_3': None })
+    server.set_multi(['foo_1', 'foo_3'], [], time=86400)
+
+    calls = []
+    def batch(mc, args):
+        calls.append(args)
+        return [arg * 2 for arg, in args]
+
+    assert ident.multi(client, [(1,), (2,), (3,)], batch=batch) == [2, 4, 6]
+    assert calls == [[(1,), (3,)]]
+
+def test_multi_hit(mock_cache):
+    client, server = mock_cache
+    server.get_multi(['foo_1', 'foo_2'], { 'foo_1': 3, 'foo_2': 4 })
+    assert ident.multi(client, [(1,), (2,)]) == [3, 4]
+
+def test_multi_race(mock_cache):
+    client, server = mock_cache
+    server.get_multi(['foo_1', 'foo_2', 'foo_3', 'foo_4'], {})
+    # Someone else filled foo_1 first
+    server.add_multi(['foo_1', 'foo_2', 'foo_3', 'foo_4'], ['foo_1'], time=30)
+    server.get_multi(['foo_1'], { 'foo_1': 5 })
+    # And then foo_2 was purged and foo_3 was filled while we were busy
+    server.get_multi(['foo_2', 'foo_3', 'foo_4'], { 'foo_3': 6, 'foo_4': None })
+    server.set_multi(['foo_4'], [], time=86400)
+    assert ident.multi(client, [(1,), (2,), (3,), (4,)]) == [5, 2, 3, 4]
+
+def test_multi_error(mock_cache):
+    client, server = mock_cache
+    server.get_multi(['foo_1'], pylibmc.Error())
+    server.get_multi(['foo_1'], pylibmc.Error())
+    assert ident.multi(client, [(1,)]) == [1]
+
+def test_local(mock_cache):
+    client, server = mock_cache
+    local = cache.LocalClient(client, cache.LocalCache())
+    server.gets('view_foo', 1, 0)
+    assert local.gets('view_foo') == (1, 0)
+    assert local.gets('view_foo') == (1, None)
+
+    # Not a hot key
+    server.gets('foo', 1, 0)
+    server.gets('foo', 2, 1)
+    assert local.gets('foo') == (1, 0)
+    assert local.gets('foo') == (2, 1)
+
+def test_local_expire(mock_cache, monkeypatch):
+    client, server = mock_cache
+    local = cache.LocalClient(client, cache.LocalCache(ttl=5))
+    now = 100
+    monkeypatch.setattr(cache.time, 'monotonic', lambda: now)
+    server.gets('view_foo', 1, 0)
+    assert local.gets('view_foo') == (1, 0)
+    now = 106
+    server.gets('view_foo', 2, 1)
+    assert local.gets('view_foo') == (2, 1)
+
+def test_local_invalidate(mock_cache):
+    client, server = mock_cache
+    local = cache.LocalClient(client, cache.LocalCache())
+    server.gets('view_foo', 1, 0)
+    assert local.gets('view_foo') == (1, 0)
+    server.cas('view_foo', 1, True, time=0)
+    local.cas('view_foo', 2, 1)
+    server.gets('view_foo', 2, 2)
+    assert local.gets('view_foo') == (2, 2)
+
+def test_pool(memcached):
+    pool = cache.ClientPool(memcached)
+    mc = pool.get()
+    assert isinstance(mc, cache.TracingClient)
+    pool.put(mc)
+    assert pool.get() is mc
+
+def test_pool_down(tmp_path, monkeypatch):
+    now = 100
+    monkeypatch.setattr(cache.time, 'monotonic', lambda: now)
+    pool = cache.ClientPool(str(tmp_path / "sock"), cooldown=30)
+    assert isinstance(pool.get(), cache.NoopClient)
+    assert pool.down_until == 130
+
+    # Don't try again until the cooldown has elapsed
+    monkeypatch.setattr(cache, 'mc_connect', lambda servers: pytest.fail())
+    now = 120
+    assert isinstance(pool.get(), cache.NoopClient)
+
+def test_purger(monkeypatch):
+    now = 100
+    monkeypatch.setattr(cache.time, 'monotonic', lambda: now)
+    calls = []
+    def purge(c, mc, *args):
+        calls.append(args)
+
+    with cache.Purger(None, None, interval=60) as purger:
+        # Duplicate purges are coalesced until the interval elapses
+        for _ in range(3):
+            purger.add(purge, 'rgl')
+            purger.add(purge)
+        assert not calls
+
+        now = 160
+        purger.add(purge, 'etf2l')
+        assert calls == [('rgl',), (), ('etf2l',)]
+
+        calls.clear()
+        purger.add(purge)
+        assert not calls
+    # And anything left over is purged at the end
+    assert calls == [()]
+
+def test_purger_error(caplog):
+    class Connection:
+        def __init__(self):
+            self.queries = []
+
+        def cursor(self):
+            return self
+
+        def execute(self, query):
+            self.queries.append(query)
+
+    calls = []
+    def purge(c, mc, *args):
+        calls.append(args)
+        if args == ('fail',):
+            raise RuntimeError()
+
+    # Purges requested before the error are still run, after rolling back
+    c = Connection()
+    with pytest.raises(ValueError):
+        with cache.Purger(c, None) as purger:
+            purger.add(purge, 'committed')
+            raise ValueError()
+    assert c.queries == ["ROLLBACK;"]
+    assert calls == [('committed',)]
+
+    # But errors while purging don't hide the original error
+    calls.clear()
+    with pytest.raises(ValueError):
+        with cache.Purger(c, None) as purger:
+            purger.add(purge, 'fail')
+            raise ValueError()
+    assert calls == [('fail',)]
+    assert "Could not purge" in caplog.text
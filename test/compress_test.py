@@ -0,0 +1,40 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+# Copyright (C) 2025 Sean Anderson <seanga2@gmail.com>
+
+from argparse import Namespace
+
+import trends.importer.compress
+from trends.importer.compress import LEVEL, compress, iter_logs
+
+def test_compress(connection, monkeypatch):
+    cur = connection.cursor()
+    def sizes():
+        cur.execute("""SELECT
+                           count(*) FILTER (WHERE data NOTNULL),
+                           count(*) FILTER (WHERE dictid NOTNULL),
+                           sum(length(zdata))
+                       FROM log_json;""")
+        return tuple(cur.fetchone())
+
+    # Logs are compressed when they are imported
+    logs = dict(iter_logs(connection))
+    cur.execute("SELECT logid, title FROM log;")
+    assert { logid: log['info']['title'] for logid, log in logs.items() } == dict(cur.fetchall())
+    plain, dicts, before = sizes()
+    assert not plain and not dicts
+
+    # The test logs are too sparse to train on each real partition
+    monkeypatch.setattr(trends.importer.compress, 'PARTITION_SIZE', 1000000)
+    compress(Namespace(level=LEVEL), connection, None)
+    cur.execute("SELECT lower FROM log_json_dict;")
+    assert [row[0] for row in cur] == [2000000]
+    assert dict(iter_logs(connection)) == logs
+    plain, dicts, after = sizes()
+    cur.execute("SELECT count(*) FROM log_json WHERE logid >= 2000000;")
+    assert not plain and dicts == cur.fetchone()[0]
+    assert after < before
+
+    # There's nothing new to train on
+    compress(Namespace(level=LEVEL), connection, None)
+    assert dict(iter_logs(connection)) == logs
+    assert sizes() == (plain, dicts, after)
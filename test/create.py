@@ -79,6 +79,7 @@ def create_test_db(url, memcached):
         3302963,
         3302982,
         3384488,
+        batch_size=10,
     )
 
     util.import_demos(url, mc,
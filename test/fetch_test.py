@@ -10,7 +10,8 @@ from hypothesis import given, strategies as st
 import pytest
 import responses, responses.registries
 
-from trends.importer.fetch import ListFetcher, BulkFetcher, ReverseFetcher, DemoBulkFetcher
+from trends.importer.fetch import ListFetcher, BulkFetcher, ReverseFetcher, DemoBulkFetcher, \
+                                  prefetch
 
 def response_200(logid):
     return responses.Response(method=responses.GET, url=f"https://logs.tf/api/v1/log/{logid}",
@@ -40,6 +41,26 @@ def test_list():
 
     assert len(responses.calls) == 2
 
+@responses.activate
+def test_prefetch():
+    for logid in range(1, 20):
+        responses.add(response_200(logid) if logid % 3 else response_404(logid))
+    fetcher = ListFetcher()
+
+    consumed = []
+    def logids():
+        for logid in range(1, 20):
+            consumed.append(logid)
+            yield logid
+
+    logs = prefetch(fetcher, logids(), jobs=4)
+    assert next(logs) == (1, {'success': True})
+    # Only a few logs should be fetched ahead of time
+    assert len(consumed) <= 9
+    assert [(logid, bool(log)) for logid, log in logs] == \
+           [(logid, bool(logid % 3)) for logid in range(2, 20)]
+    assert len(responses.calls) == 19
+
 @pytest.mark.skip(reason="Waiting on https://github.com/getsentry/responses/pull/563")
 #@responses.activate(registry=responses.registries.OrderedRegistry)
 def test_retry():
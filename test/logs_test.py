@@ -0,0 +1,95 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+# Copyright (C) 2025 Sean Anderson <seanga2@gmail.com>
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+import time
+
+import pytest
+
+from trends.importer.logs import IdCache, upsert_ids, upsert_players
+from trends.sql import db_connect
+
+def test_id_cache():
+    ids = IdCache(size=2)
+    ids.put('name', "a", 1)
+    ids.put('name', "b", 2)
+    ids.commit()
+    assert ids.get('name', "a") == 1
+
+    # The least-recently used id is evicted
+    ids.put('map', "a", 3)
+    assert ids.get('name', "b") is None
+    assert ids.get('name', "a") == 1
+    assert ids.get('map', "a") == 3
+
+    # Ids from a transaction which was rolled back are forgotten...
+    ids.rollback()
+    assert ids.get('name', "a") == 1
+    assert ids.get('map', "a") is None
+
+    # ...unless it was committed first
+    ids.put('map', "a", 3)
+    ids.commit()
+    ids.rollback()
+    assert ids.get('map', "a") == 3
+
+def test_upsert_players_cached(database):
+    with closing(db_connect(database.url())) as c:
+        cur = c.cursor()
+        cur.execute("""SELECT steamid64::TEXT, playerid, nameid, last_active
+                       FROM player
+                       WHERE last_active NOTNULL
+                       LIMIT 1;""")
+        steamid, playerid, nameid, last_active = cur.fetchone()
+
+        # Players are cached with a fake id so we can tell when the database was used
+        ids = IdCache()
+        ids.put('player', steamid, (-1, last_active))
+        assert upsert_players(cur, ((steamid, nameid, last_active),), ids)[steamid] == -1
+        assert upsert_players(cur, ((steamid, nameid, last_active + 1),), ids, update=False) \
+               [steamid] == -1
+        assert upsert_players(cur, ((steamid, nameid, last_active + 1),), ids)[steamid] == playerid
+        assert ids.get('player', steamid) == (playerid, last_active + 1)
+        c.rollback()
+
+@pytest.mark.parametrize('upsert', ('name', 'player'))
+def test_upsert_race(database, upsert):
+    # Insert a value in one transaction while another is trying to insert it too
+    with closing(db_connect(database.url())) as c1, closing(db_connect(database.url())) as c2:
+        cur1 = c1.cursor()
+        cur2 = c2.cursor()
+        cur2.execute("SELECT pg_backend_pid();")
+        pid = cur2.fetchone()[0]
+
+        if upsert == 'name':
+            value = "upsert race"
+            cur1.execute("INSERT INTO name (name) VALUES (%s) RETURNING nameid;", (value,))
+            def insert():
+                return upsert_ids(cur2, 'name', (value,), IdCache())
+        else:
+            value = "76561190000000000"
+            cur1.execute("SELECT nameid FROM name LIMIT 1;")
+            nameid = cur1.fetchone()[0]
+            cur1.execute("""INSERT INTO player (steamid64, nameid, last_active)
+                            VALUES (%s, %s, 0)
+                            RETURNING playerid;""", (value, nameid))
+            def insert():
+                return upsert_players(cur2, ((value, nameid, 0),), IdCache(), update=False)
+        id = cur1.fetchone()[0]
+
+        with ThreadPoolExecutor(1) as executor:
+            future = executor.submit(insert)
+            cur1.execute("SELECT pg_blocking_pids(%s);", (pid,))
+            while not cur1.fetchone()[0]:
+                time.sleep(0.01)
+                cur1.execute("SELECT pg_blocking_pids(%s);", (pid,))
+            c1.commit()
+            assert future.result() == { value: id }
+        c2.rollback()
+
+        if upsert == 'name':
+            cur1.execute("DELETE FROM name WHERE name = %s;", (value,))
+        else:
+            cur1.execute("DELETE FROM player WHERE steamid64 = %s;", (value,))
+        c1.commit()
@@ -0,0 +1,66 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+# Copyright (C) 2025 Sean Anderson <seanga2@gmail.com>
+
+import pytest
+import requests
+import responses, responses.registries
+
+from trends.importer import players
+from trends.importer.players import PlayerFetcher, RateLimiter
+
+URL = "https://api.steampowered.com/ISteamUser/GetPlayerSummaries/v0002/"
+
+@pytest.fixture
+def clock(monkeypatch):
+    class Clock:
+        now = 100
+
+        def sleep(self, delay):
+            self.now += delay
+
+    clock = Clock()
+    monkeypatch.setattr(players.time, 'monotonic', lambda: clock.now)
+    monkeypatch.setattr(players.time, 'sleep', clock.sleep)
+    return clock
+
+def test_limiter(clock):
+    limiter = RateLimiter(10, increase=0.1)
+    for _ in range(10):
+        limiter.acquire()
+    assert clock.now == pytest.approx(100.9)
+
+    # Back off quickly, but recover slowly
+    limiter.throttle()
+    limiter.throttle()
+    assert limiter.rate == 2.5
+    limiter.acquire()
+    start = clock.now
+    limiter.acquire()
+    assert clock.now - start == pytest.approx(0.4)
+    limiter.succeed()
+    assert limiter.rate == 3.5
+    for _ in range(10):
+        limiter.succeed()
+    assert limiter.rate == 10
+
+def response(status, **kwargs):
+    return responses.Response(method=responses.GET, url=URL, status=status, **kwargs)
+
+@responses.activate(registry=responses.registries.OrderedRegistry)
+def test_fetcher(clock):
+    summaries = [{ 'steamid': '76561198053621664', 'personaname': "b4nny", 'avatarhash': "0" }]
+    responses.add(response(429))
+    responses.add(response(429))
+    responses.add(response(200, json={ 'response': { 'players': summaries } }))
+    responses.add(response(429))
+    responses.add(response(429))
+    responses.add(response(429))
+    responses.add(response(403))
+
+    limiter = RateLimiter(1)
+    fetcher = PlayerFetcher("key", limiter, tries=3)
+    assert fetcher.get_data([76561198053621664]) == summaries
+    assert limiter.rate == pytest.approx(0.3)
+    assert fetcher.get_data([76561198053621664]) is None
+    with pytest.raises(requests.exceptions.HTTPError):
+        fetcher.get_data([76561198053621664])
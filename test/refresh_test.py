@@ -0,0 +1,33 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+# Copyright (C) 2025 Sean Anderson <seanga2@gmail.com>
+
+from argparse import Namespace
+
+from trends.cache import mc_connect
+from trends.importer.refresh import cubes, refresh
+
+def test_cubes(connection):
+    # The test database is built incrementally, so it should match a cube built from scratch
+    cur = connection.cursor()
+    for cube in cubes:
+        cur.execute(f"SELECT count(*) FROM {cube};")
+        assert cur.fetchone()[0]
+        cur.execute(f"""(SELECT * FROM {cube} EXCEPT ALL SELECT * FROM {cube}_rows())
+                        UNION ALL
+                        (SELECT * FROM {cube}_rows() EXCEPT ALL SELECT * FROM {cube});""")
+        assert not cur.fetchall()
+
+def test_refresh(connection, memcached):
+    def contents():
+        cur = connection.cursor()
+        ret = {}
+        for view in (*cubes, 'map_popularity'):
+            cur.execute(f"SELECT * FROM {view};")
+            ret[view] = sorted(map(tuple, cur), key=repr)
+        return ret
+
+    # Now that the views are populated, they should be refreshed in the background
+    before = contents()
+    for full in (False, True):
+        refresh(Namespace(full=full), connection, mc_connect(memcached))
+    assert contents() == before
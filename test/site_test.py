@@ -3,7 +3,9 @@
 
 import collections
 from contextlib import contextmanager
+import json
 import random
+import re
 import urllib.parse
 
 from flask.testing import EnvironBuilder
@@ -14,7 +16,6 @@ import pytest
 from python_testing_crawler import Allow, Crawler, Rule, Request
 from werkzeug.datastructures import MultiDict
 from werkzeug.exceptions import HTTPException
-from werkzeug.urls import url_encode
 
 import trends
 from trends.cache import mc_connect
@@ -193,6 +194,86 @@ def test_player_search(client, connection):
                 resp = client.get(path, query_string={'q': player['name']})
                 assert str(player['steamid64']) in resp.get_data(as_text=True)
 
+@pytest.mark.parametrize('page', ('peers', 'maps', 'totals'))
+def test_cubes(client, connection, monkeypatch, page):
+    players = connection.cursor()
+    players.execute("""SELECT steamid64
+                       FROM peer_stats
+                       JOIN player USING (playerid)
+                       GROUP BY steamid64
+                       HAVING count(DISTINCT peerid) < 100
+                       ORDER BY sum(logs) DESC
+                       LIMIT 5;""")
+    players = players.fetchall()
+
+    def rows(path, params):
+        resp = client.get(path, query_string=params)
+        assert resp.status_code == 200
+        # Rows with the same sort key may be in any order
+        return sorted(re.split(r'</?tr[^>]*>', resp.get_data(as_text=True)))
+
+    # Pages using the cubes should match the same page calculated from the logs
+    for player in players:
+        for params in ({}, { 'league': 'etf2l' }, { 'format': 'sixes' }, { 'class': 'soldier' },
+                       { 'class': 'medic' }, { 'map': 'cp_' }):
+            path = f"/player/{player['steamid64']}/{page}"
+            expected = rows(path, params)
+            with monkeypatch.context() as m:
+                m.setattr(trends.site.player, 'use_cube', lambda filters, *params: False)
+                assert rows(path, params) == expected
+
+def test_trends(client, connection):
+    players = connection.cursor()
+    players.execute("""SELECT playerid, steamid64
+                       FROM player_stats
+                       JOIN player USING (playerid)
+                       GROUP BY playerid, steamid64
+                       ORDER BY count(*) DESC
+                       LIMIT 3;""")
+
+    for player in players.fetchall():
+        for window in (1, 20, 500):
+            for params in ({}, { 'format': 'sixes' }):
+                resp = client.get(f"/player/{player['steamid64']}/trends",
+                                  query_string={ **params, 'window': window })
+                assert resp.status_code == 200
+                body = resp.get_data(as_text=True)
+                start = body.index('>', body.index('id="trend-data"')) + 1
+                trends = json.loads(body[start:body.index('</script>', start)])
+
+                expected = connection.cursor()
+                expected.execute(
+                    """SELECT
+                           log.logid,
+                           (sum((wins > losses)::INT) OVER win
+                            + 0.5 * sum((wins = losses)::INT) OVER win) /
+                               count(*) OVER win AS winrate,
+                           sum(ps.kills) OVER win * 30.0 * 60 /
+                               nullif(sum(log.duration) OVER win, 0) AS kills,
+                           sum(ps.dmg) OVER win * 60.0 /
+                               nullif(sum(log.duration) OVER win, 0) AS dpm,
+                           sum(ps.dt) OVER win * 60.0 /
+                               nullif(sum(nullelse(ps.dt, log.duration)) OVER win, 0) AS dtm,
+                           sum(hsg) OVER win * 60.0 /
+                               nullif(sum(nullelse(hsg, log.duration)) OVER win, 0) AS hpm_given
+                       FROM log_nodups AS log
+                       JOIN player_stats AS ps USING (logid)
+                       JOIN format USING (formatid)
+                       WHERE ps.playerid = %(playerid)s
+                           AND (%(format)s ISNULL OR format = %(format)s)
+                       WINDOW win AS (
+                           ORDER BY log.logid
+                           GROUPS BETWEEN %(window)s - 1 PRECEDING AND CURRENT ROW
+                       ) ORDER BY log.logid;""",
+                    { 'playerid': player['playerid'], 'window': window,
+                      'format': params.get('format') })
+
+                assert len(trends) == expected.rowcount
+                for trend, row in zip(trends, expected):
+                    assert trend['logid'] == row['logid']
+                    for col in ('winrate', 'kills', 'dpm', 'dtm', 'hpm_given'):
+                        assert trend[col] == pytest.approx(row[col] and float(row[col]))
+
 def test_team_search(client, connection):
     teams = connection.cursor()
     teams.execute("""SELECT league, teamid, team_name
@@ -270,6 +351,17 @@ def test_dupes(connection):
     cur.execute("SELECT logid, duplicate_of FROM log WHERE duplicate_of NOTNULL")
     assert { logid: duplicate_of for logid, duplicate_of in cur } == duplicates
 
+def test_log_page(client, memcached, logs):
+    logids = "+".join(map(str, logs[:5]))
+    mc_connect(memcached).flush_all()
+    uncached = client.get(f"/log/{logids}")
+    assert uncached.status_code == 200
+    # The merged logs should be cached
+    assert client.get(f"/log/{logids}").data == uncached.data
+    # But the order of the logs matters
+    reversed_logids = "+".join(map(str, logs[4::-1]))
+    assert client.get(f"/log/{reversed_logids}").data != uncached.data
+
 LOG_VALID_KEYS = {
     'demoid',
     'duplicate_of',
@@ -353,11 +445,10 @@ def test_api_logs(client):
     assert next_page is None
 
     def paged(**args):
-        args['offset'] = 0
         if 'limit' not in args:
             args['limit'] = 10
+        logs, next_page = get(**args)
         while True:
-            logs, next_page = get(**args)
             assert len(logs) <= args['limit']
             yield from logs
 
@@ -365,11 +456,23 @@ def test_api_logs(client):
                 assert next_page is None
                 return
 
-            args['offset'] += args['limit']
-            assert next_page == f"/api/v1/logs?{url_encode(args)}"
+            assert 'cursor=' in next_page and 'offset=' not in next_page
+            resp = client.get(next_page)
+            assert resp.status_code == 200
+            logs, next_page = resp.json['logs'], resp.json['next_page']
 
     assert logs == list(paged())
     assert get(offset=len(logs)) == ([], None)
+    assert get(limit=1000) == (logs, None)
+    for sort in ('logid', 'duration', 'date', 'updated'):
+        for sort_dir in ('asc', 'desc'):
+            assert get(sort=sort, sort_dir=sort_dir)[0] == \
+                   list(paged(sort=sort, sort_dir=sort_dir, limit=7))
+
+    next_page = get(limit=10)[1]
+    cursor = urllib.parse.parse_qs(urllib.parse.urlsplit(next_page).query)['cursor'][0]
+    for params in ({ 'cursor': "garbage" }, { 'cursor': cursor, 'sort': 'duration' }):
+        assert client.get("api/v1/logs", query_string=params).status_code == 400
 
     for log in get(view='players')[0]:
         assert set(log.keys()) == LOG_VALID_KEYS | { 'red', 'blue' }
@@ -430,6 +533,47 @@ def test_api_logs(client):
         assert "76561198330799279" in players
         assert "76561198046130018" in players
 
+def test_api_logs_bulk(client, connection):
+    logs = client.get("api/v1/logs").json['logs']
+    logids = [log['logid'] for log in logs[:20]]
+
+    def check(bulk, logids):
+        assert [log['summary']['logid'] for log in bulk] == logids
+        for log in bulk:
+            summary = client.get(f"api/v1/log/{log['summary']['logid']}").json['summary']
+            assert log['summary'] == summary
+
+            cur = connection.cursor()
+            cur.execute("SELECT count(*) FROM round WHERE logid = %s;", (summary['logid'],))
+            assert len(log['rounds']) == cur.fetchone()[0]
+            cur.execute("""SELECT steamid64::TEXT, kills, dmg
+                           FROM player_stats
+                           JOIN player USING (playerid)
+                           WHERE logid = %s
+                           ORDER BY steamid64;""", (summary['logid'],))
+            assert sorted((player['steamid64'], player['kills'], player['dmg'])
+                          for player in log['players']) == [tuple(row) for row in cur]
+
+    resp = client.get("api/v1/logs/bulk", query_string={ 'logid': logids + [1, logids[0]] })
+    assert resp.status_code == 200
+    assert resp.json['next_page'] is None
+    check(resp.json['logs'], logids)
+
+    params = { 'sort': 'updated', 'sort_dir': 'asc', 'limit': 7 }
+    resp = client.get("api/v1/logs/bulk", query_string=params)
+    bulk = []
+    while True:
+        assert resp.status_code == 200
+        bulk.extend(resp.json['logs'])
+        if not resp.json['next_page']:
+            break
+        resp = client.get(resp.json['next_page'])
+    check(bulk, [log['logid'] for log in
+                 client.get("api/v1/logs", query_string={ **params, 'limit': 100 }).json['logs']])
+
+    resp = client.get("api/v1/logs/bulk", query_string={ 'logid': list(range(501)) })
+    assert resp.status_code == 400
+
 @contextmanager
 def check_purge(db, cache, extra=()):
     mc = mc_connect(cache)
@@ -50,12 +50,12 @@ def database():
             db_init(c)
         yield database
 
-def import_logs(url, mc, *logids):
+def import_logs(url, mc, *logids, batch_size=None):
     with db_connect(url) as c:
         logfiles = { logid: f"{os.path.dirname(__file__)}/logs/log_{logid}.json"
                      for logid in logids }
         fetcher = trends.importer.fetch.FileFetcher(logs=logfiles)
-        trends.importer.logs.import_logs(c, mc, fetcher, False)
+        trends.importer.logs.import_logs(c, mc, fetcher, False, batch_size=batch_size)
 
 class SinceEpoch:
     since = datetime.fromtimestamp(0)
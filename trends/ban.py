@@ -7,6 +7,7 @@ import sys
 from .steamid import SteamID
 from .sql import db_connect, delete_logs
 from .importer.cli import init_logging
+from .importer.refresh import update_summaries
 
 def ban_player(steamid, reason, database):
     init_logging(logging.INFO)
@@ -21,6 +22,7 @@ def ban_player(steamid, reason, database):
                        WHERE uploader = (SELECT playerid FROM player WHERE steamid64 = %s);""",
                     (steamid,))
         delete_logs(cur)
+        update_summaries(c)
         cur.execute("COMMIT;")
 
 if __name__ == "__main__":
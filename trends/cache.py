@@ -1,10 +1,14 @@
 # SPDX-License-Identifier: AGPL-3.0-only
 # Copyright (C) 2020, 25 Sean Anderson <seanga2@gmail.com>
 
+import collections
 import contextlib
 from functools import wraps
 import logging
+import os
 import secrets
+import threading
+import time
 import zlib
 
 from mpmetrics import Counter
@@ -28,6 +32,9 @@ class NoopClient:
     def add(self, key, value, *args, **kwargs):
         return True
 
+    def add_multi(self, mapping, *args, **kwargs):
+        return []
+
     def replace(self, key, value, *args, **kwargs):
         return False
 
@@ -46,23 +53,32 @@ class NoopClient:
     def flush_all(self):
         return True
 
+# Errors which mean that we could not talk to memcached at all
+UNAVAILABLE = (pylibmc.ConnectionError, pylibmc.HostLookupError, pylibmc.ServerDead,
+               pylibmc.ServerDown, pylibmc.SocketCreateError, pylibmc.UnixSocketError)
+
 class TracingClient(pylibmc.Client):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._tracing_enabled = False
+        self.failed = False
 
     @contextlib.contextmanager
     def _cache_span(self, op, key):
-        if self._tracing_enabled:
-            yield
-            return
+        try:
+            if self._tracing_enabled:
+                yield
+                return
 
-        desc = f"{op} {key}"
-        sentry_sdk.add_breadcrumb(category='query', message=desc)
-        with sentry_sdk.start_span(op='db.query', description=desc) as span:
-            span.set_data('db.system', "memcached")
-            span.set_data('db.operation', op)
-            yield span
+            desc = f"{op} {key}"
+            sentry_sdk.add_breadcrumb(category='query', message=desc)
+            with sentry_sdk.start_span(op='db.query', description=desc) as span:
+                span.set_data('db.system', "memcached")
+                span.set_data('db.operation', op)
+                yield span
+        except UNAVAILABLE:
+            self.failed = True
+            raise
 
     def get(self, key, default=None):
         with self._cache_span('get', key) as span:
@@ -80,13 +96,17 @@ class TracingClient(pylibmc.Client):
             return super().set(key, value, *args, **kwargs)
 
     def set_multi(self, mapping, *args, **kwargs):
-        with self._cache_span('set_multi', ', '.join(mapping.values())) as span:
+        with self._cache_span('set_multi', ', '.join(mapping.keys())) as span:
             return super().set_multi(mapping, *args, **kwargs)
 
     def add(self, key, value, *args, **kwargs):
         with self._cache_span('add', key):
             return super().add(key, value, *args, **kwargs)
 
+    def add_multi(self, mapping, *args, **kwargs):
+        with self._cache_span('add_multi', ', '.join(mapping.keys())):
+            return super().add_multi(mapping, *args, **kwargs)
+
     def replace(self, key, value, *args, **kwargs):
         with self._cache_span('replace', key):
             return super().replace(key, value, *args, **kwargs)
@@ -130,45 +150,225 @@ class TracingClient(pylibmc.Client):
                 return zlib.compress(data), flag | 8
         return data, flag
 
+def hot_key(key):
+    return key.endswith('_version') or key.startswith('view_')
+
+class LocalCache:
+    """A small in-process cache for keys which are read on almost every request
+
+    Values are only kept for ``ttl`` seconds, since we cannot see when other processes (such as
+    the importer updating a version key) change them. Writes made through a :class:`LocalClient`
+    are seen immediately.
+
+    :param int size: The maximum number of values to keep
+    :param float ttl: The number of seconds to keep each value
+    :param cacheable: A function taking a key and returning whether to cache it
+    """
+
+    def __init__(self, size=1000, ttl=5, cacheable=hot_key):
+        self.size = size
+        self.ttl = ttl
+        self.cacheable = cacheable
+        self.values = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        if not self.cacheable(key):
+            return None
+
+        LOCAL_ACCESS.labels(key).inc()
+        with self.lock:
+            expires, value = self.values.get(key, (0, None))
+            if expires < time.monotonic():
+                self.values.pop(key, None)
+                return None
+            self.values.move_to_end(key)
+        LOCAL_HIT.labels(key).inc()
+        return value
+
+    def put(self, key, value):
+        if value is None or not self.cacheable(key):
+            return
+
+        with self.lock:
+            self.values[key] = (time.monotonic() + self.ttl, value)
+            self.values.move_to_end(key)
+            while len(self.values) > self.size:
+                self.values.popitem(last=False)
+
+    def discard(self, keys):
+        with self.lock:
+            for key in keys:
+                self.values.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
+
+class LocalClient:
+    """Wrap a memcached client with a :class:`LocalCache`"""
+
+    def __init__(self, mc, local):
+        self.mc = mc
+        self.local = local
+
+    def __getattr__(self, name):
+        return getattr(self.mc, name)
+
+    def get(self, key, default=None):
+        if (value := self.local.get(key)) is not None:
+            return value
+        value = self.mc.get(key)
+        self.local.put(key, value)
+        return default if value is None else value
+
+    def get_multi(self, keys):
+        keys = list(keys)
+        values = {}
+        for key in keys:
+            if (value := self.local.get(key)) is not None:
+                values[key] = value
+        if missing := [key for key in keys if key not in values]:
+            fetched = self.mc.get_multi(missing)
+            for key, value in fetched.items():
+                self.local.put(key, value)
+            values.update(fetched)
+        return values
+
+    def gets(self, key):
+        # A hit never needs a cas token
+        if (value := self.local.get(key)) is not None:
+            return value, None
+        value, cas = self.mc.gets(key)
+        self.local.put(key, value)
+        return value, cas
+
+    def set(self, key, value, *args, **kwargs):
+        self.local.discard((key,))
+        return self.mc.set(key, value, *args, **kwargs)
+
+    def set_multi(self, mapping, *args, **kwargs):
+        self.local.discard(mapping.keys())
+        return self.mc.set_multi(mapping, *args, **kwargs)
+
+    def add(self, key, value, *args, **kwargs):
+        self.local.discard((key,))
+        return self.mc.add(key, value, *args, **kwargs)
+
+    def add_multi(self, mapping, *args, **kwargs):
+        self.local.discard(mapping.keys())
+        return self.mc.add_multi(mapping, *args, **kwargs)
+
+    def replace(self, key, value, *args, **kwargs):
+        self.local.discard((key,))
+        return self.mc.replace(key, value, *args, **kwargs)
+
+    def cas(self, key, value, cas, time=0):
+        self.local.discard((key,))
+        return self.mc.cas(key, value, cas, time)
+
+    def delete(self, key):
+        self.local.discard((key,))
+        return self.mc.delete(key)
+
+    def delete_multi(self, keys):
+        keys = list(keys)
+        self.local.discard(keys)
+        return self.mc.delete_multi(keys)
+
+    def flush_all(self):
+        self.local.clear()
+        return self.mc.flush_all()
+
 def mc_connect(servers):
     if servers:
         return TracingClient(servers.split(','), binary=False, behaviors={ 'cas': True })
     return NoopClient()
 
+class ClientPool:
+    """A pool of memcached clients, shared by the requests handled by one process
+
+    pylibmc doesn't actually connect until we make a request, so new clients are checked before
+    they are handed out. If memcached can't be reached (either when checking a new client or while
+    using one), the pool hands out a :class:`NoopClient` for the next ``cooldown`` seconds,
+    instead of waiting for a timeout on every request.
+
+    :param str servers: The memcached servers, as for :py:func:`mc_connect`
+    :param int size: The maximum number of idle clients to keep
+    :param float cooldown: The number of seconds to wait before trying memcached again
+    """
+
+    def __init__(self, servers, size=4, cooldown=30):
+        self.servers = servers
+        self.size = size
+        self.cooldown = cooldown
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.idle = []
+        self.down_until = 0
+
+    def trip(self):
+        self.down_until = time.monotonic() + self.cooldown
+        with self.lock:
+            self.idle.clear()
+
+    def get(self):
+        if not self.servers or time.monotonic() < self.down_until:
+            return NoopClient()
+
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+
+        mc = mc_connect(self.servers)
+        try:
+            mc.get('connection_test')
+            return mc
+        except pylibmc.Error:
+            logging.exception("Could not connect to memcached")
+        self.trip()
+        return NoopClient()
+
+    def put(self, mc):
+        if isinstance(mc, NoopClient):
+            return
+
+        if mc.failed:
+            logging.error("Lost connection to memcached; retrying in %s seconds", self.cooldown)
+            self.trip()
+            return
+
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append(mc)
+
 CACHE_ACCESS = Counter('memcached_request', "Total memcached requests", ['key_template'])
 CACHE_HIT = Counter('memcached_request_hit', "Successful memcached requests", ['key_template'])
+LOCAL_ACCESS = Counter('memcached_local_request', "Total in-process cache requests", ['key'])
+LOCAL_HIT = Counter('memcached_local_request_hit', "Successful in-process cache requests", ['key'])
 
 def mutable(key_template, timeout=30, expire=86400):
     def decorator(f):
-        @wraps(f)
-        def wrapper(mc, *args, **kwargs):
-            key = key_template.format(*args, **kwargs)
-            with sentry_sdk.start_span(op='cache.get', description=key) as span:
-                CACHE_ACCESS.labels(key_template).inc()
-                span.set_data('cache.key', key)
-                try:
+        def get(mc, key, span):
+            try:
+                val, cas = mc.gets(key)
+                if val is None and cas is None:
+                    # Add a dummy value so we can delete it if we have to purge
+                    mc.add(key, None, time=timeout)
+                    # Did someone else fill the cache in the meantime?
                     val, cas = mc.gets(key)
-                    if val is not None:
-                        span.set_data('cache.hit', True)
-                        CACHE_HIT.labels(key_template).inc()
-                        return val
-
-                    if cas is None:
-                        # Add a dummy value so we can delete it if we have to purge
-                        mc.add(key, None, time=timeout)
+            except pylibmc.Error:
+                logging.exception("Could not get %s", key)
+                val, cas = None, None
 
-                        val, cas = mc.gets(key)
-                        # Did someone else fill the cache in the meantime?
-                        if val is not None:
-                            span.set_data('cache.hit', True)
-                            CACHE_HIT.labels(key_template).inc()
-                            return val
-                except pylibmc.Error:
-                    logging.exception("Could not get %s", key)
-                    cas = None
+            if val is not None:
+                span.set_data('cache.hit', True)
+                CACHE_HIT.labels(key_template).inc()
+            else:
                 span.set_data('cache.hit', False)
+            return val, cas
 
-            val = f(mc, *args, **kwargs)
+        def put(mc, key, val, cas):
             try:
                 if cas is not None:
                     with sentry_sdk.start_span(op='cache.put', description=key) as span:
@@ -178,7 +378,86 @@ def mutable(key_template, timeout=30, expire=86400):
                 pass
             except pylibmc.Error:
                 logging.exception("Could not set %s", key)
+
+        @wraps(f)
+        def wrapper(mc, *args, **kwargs):
+            key = key_template.format(*args, **kwargs)
+            with sentry_sdk.start_span(op='cache.get', description=key) as span:
+                CACHE_ACCESS.labels(key_template).inc()
+                span.set_data('cache.key', key)
+                val, cas = get(mc, key, span)
+                if val is not None:
+                    return val
+
+            val = f(mc, *args, **kwargs)
+            put(mc, key, val, cas)
             return val
+
+        def multi(mc, args, batch=None):
+            """Look up several values at once
+
+            Hits are fetched with a single request, and dummy values for misses are added with
+            another. The misses are then filled with a single request. There is no batched ``cas``,
+            so instead we check that the dummy values are still there just before filling them.
+            This leaves a (much smaller) window where a purge may be overwritten.
+
+            :param mc: The memcached client
+            :param args: The positional arguments for each value
+            :type args: list of tuple
+            :param batch: Called with the memcached client and the arguments of all the misses to
+                          calculate their values at once. By default, the decorated function is
+                          called for each miss.
+            :type batch: Callable[[Client, list[tuple]], list]
+            :return: The values, in the same order as ``args``
+            :rtype: list
+            """
+
+            keys = [key_template.format(*arg) for arg in args]
+            with sentry_sdk.start_span(op='cache.get', description=", ".join(keys)) as span:
+                CACHE_ACCESS.labels(key_template).inc(len(keys))
+                span.set_data('cache.key', keys)
+                try:
+                    vals = mc.get_multi(keys)
+                    if missing := [key for key in keys if key not in vals]:
+                        # Add dummy values so we can tell if we have to purge
+                        if failed := mc.add_multi(dict.fromkeys(missing), time=timeout):
+                            # Did someone else fill the cache in the meantime?
+                            vals.update(mc.get_multi(failed))
+                except pylibmc.Error:
+                    logging.exception("Could not get %s", ", ".join(keys))
+                    vals = {}
+
+                hits = sum(vals.get(key) is not None for key in keys)
+                span.set_data('cache.hit', hits == len(keys))
+                CACHE_HIT.labels(key_template).inc(hits)
+
+            ret = [vals.get(key) for key in keys]
+            misses = [i for i, val in enumerate(ret) if val is None]
+            if batch is None:
+                new = [f(mc, *args[i]) for i in misses]
+            elif misses:
+                new = batch(mc, [args[i] for i in misses])
+            else:
+                new = []
+
+            for i, val in zip(misses, new):
+                ret[i] = val
+
+            if misses:
+                fill = { keys[i]: ret[i] for i in misses }
+                with sentry_sdk.start_span(op='cache.put', description=", ".join(fill)) as span:
+                    span.set_data('cache.key', list(fill))
+                    try:
+                        # Skip values which were purged or filled by someone else
+                        vals = mc.get_multi(list(fill))
+                        if fill := { key: val for key, val in fill.items()
+                                     if key in vals and vals[key] is None }:
+                            mc.set_multi(fill, time=expire)
+                    except pylibmc.Error:
+                        logging.exception("Could not set %s", ", ".join(fill))
+            return ret
+
+        wrapper.multi = multi
         return wrapper
     return decorator
 
@@ -230,8 +509,9 @@ def purge(c, mc, col, table, prefix, cond="TRUE"):
                 f"""SELECT {col}
                     FROM {table}
                     WHERE {cond}
-                    FOR UPDATE SKIP LOCKED LIMIT 1000;""")
-            vals = tuple(row[0] for row in cur)
+                    FOR UPDATE SKIP LOCKED LIMIT 10000;""")
+            # The same value is often queued several times
+            vals = set(row[0] for row in cur)
             if not vals:
                 return
 
@@ -270,3 +550,59 @@ def purge_players(c, mc):
     _update_version(mc, 'players')
     mc.delete("index")
     purge(c, mc, 'steamid64', 'cache_purge_player', "overview_")
+
+class Purger:
+    """Coalesce purges requested over the course of an import
+
+    Importers which commit many small transactions would otherwise rotate the same versions and
+    scan the same purge tables after every one. Instead, purges requested with :meth:`add` are
+    deduplicated and run together once ``interval`` seconds have passed since the last time, as
+    well as when the context exits (after rolling back if there was an error). Values queued in the purge tables are still purged in
+    large batches by each purge function.
+
+    :param c: The database connection
+    :param mc: The memcached client
+    :param float interval: The minimum number of seconds between purges
+    """
+
+    def __init__(self, c, mc, interval=60):
+        self.c = c
+        self.mc = mc
+        self.interval = interval
+        self.pending = {}
+        self.last = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+            return
+
+        # Earlier transactions were still committed, so purge them. The current transaction may
+        # have failed, so roll it back first, and don't hide the original error.
+        try:
+            self.c.cursor().execute("ROLLBACK;")
+            self.flush()
+        except Exception:
+            logging.exception("Could not purge after an error")
+
+    def add(self, purge, *args):
+        """Request a purge
+
+        :param purge: The purge function to call, such as :func:`purge_players`
+        :param args: Any additional arguments for ``purge``
+        """
+
+        self.pending[purge, args] = None
+        if time.monotonic() - self.last >= self.interval:
+            self.flush()
+
+    def flush(self):
+        """Run all pending purges"""
+        pending = self.pending
+        self.pending = {}
+        for purge, args in pending:
+            purge(self.c, self.mc, *args)
+        self.last = time.monotonic()
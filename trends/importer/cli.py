@@ -10,6 +10,7 @@ import psycopg2
 from ..cache import mc_connect
 from ..sql import db_connect, db_init
 from ..util import sentry_init
+from .compress import create_compress_parser
 from .demos import create_demos_parser
 from .etf2l import create_etf2l_parser
 from .logs import create_logs_parser
@@ -23,6 +24,7 @@ from .weapons import create_weapons_parser
 def create_parser():
     parser = argparse.ArgumentParser()
     sub = parser.add_subparsers()
+    create_compress_parser(sub)
     create_demos_parser(sub)
     create_etf2l_parser(sub)
     create_link_demos_parser(sub)
@@ -0,0 +1,264 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+# Copyright (C) 2025 Sean Anderson <seanga2@gmail.com>
+
+import argparse
+import json
+import logging
+import time
+
+import psycopg2.extras
+import zstandard
+
+from ..util import chunk
+
+# The size of each log_json partition (see db_init)
+PARTITION_SIZE = 100000
+# zstd's default dictionary size
+DICT_SIZE = 112640
+# How many logs to train each dictionary on
+DICT_SAMPLES = 2000
+# Decompression speed hardly depends on the level, so spend some time compressing
+LEVEL = 10
+
+class LogCodec:
+    """Compress and decompress the json in log_json
+
+    Logs are compressed with the dictionary for their partition, or with the dictionary of the
+    closest preceding partition if theirs has not been trained yet. Dictionaries are never modified
+    once they are created, so they are cached for the life of the codec.
+
+    :param int level: The compression level to use
+    """
+
+    def __init__(self, level=LEVEL):
+        self.level = level
+        self.compressors = {}
+        self.decompressors = {}
+
+    def _dict(self, c, dictid):
+        c.execute("SELECT data FROM log_json_dict WHERE dictid = %s;", (dictid,))
+        return zstandard.ZstdCompressionDict(bytes(c.fetchone()[0]))
+
+    def compressor(self, c, dictid):
+        if dictid not in self.compressors:
+            dict_data = None if dictid is None else self._dict(c, dictid)
+            self.compressors[dictid] = zstandard.ZstdCompressor(level=self.level,
+                                                                dict_data=dict_data)
+        return self.compressors[dictid]
+
+    def decompressor(self, c, dictid):
+        if dictid not in self.decompressors:
+            dict_data = None if dictid is None else self._dict(c, dictid)
+            self.decompressors[dictid] = zstandard.ZstdDecompressor(dict_data=dict_data)
+        return self.decompressors[dictid]
+
+    def encode(self, c, logs):
+        """Compress logs for log_json
+
+        :param c: The database cursor
+        :param logs: The logs to compress
+        :type logs: list of (logid, json) where json is a str
+        :return: Rows for the logid, data, zdata, and dictid columns of log_json
+        :rtype: list of tuples
+        """
+
+        if not logs:
+            return []
+
+        c.execute("""SELECT
+                         logid,
+                         (SELECT
+                                 dictid
+                             FROM log_json_dict
+                             WHERE lower <= logid
+                             ORDER BY lower DESC
+                             LIMIT 1
+                         ) AS dictid
+                     FROM unnest(%s::INT[]) AS logid;""", ([logid for logid, _ in logs],))
+        dictids = { row[0]: row[1] for row in c }
+        return [(logid, None,
+                 self.compressor(c, dictids[logid]).compress(data.encode()), dictids[logid])
+                for logid, data in logs]
+
+    def decode(self, c, data, zdata, dictid):
+        """Decompress a row of log_json
+
+        :param c: The database cursor
+        :param data: The ``data`` column
+        :param zdata: The ``zdata`` column
+        :param dictid: The ``dictid`` column
+        :return: The parsed json
+        """
+
+        if zdata is None:
+            return data
+        return json.loads(self.decompressor(c, dictid).decompress(zdata))
+
+def iter_logs(c, codec=None, bounds=None):
+    """Iterate over the json of logs, whether compressed or not
+
+    :param c: The database connection
+    :param LogCodec codec: The codec to decompress logs with
+    :param bounds: The (inclusive) range of logids to read
+    :type bounds: (int, int)
+    :return: The logs
+    :rtype: iterator of (logid, json)
+    """
+
+    codec = codec or LogCodec()
+    cur = c.cursor()
+    with c.cursor(name='log_json', withhold=True) as logs:
+        logs.itersize = 100
+        logs.execute("""SELECT
+                            logid,
+                            data,
+                            zdata,
+                            dictid
+                        FROM log_json
+                        {}
+                        ORDER BY logid;"""
+                     .format("WHERE logid BETWEEN %s AND %s" if bounds else ""), bounds)
+        for log in logs:
+            yield log[0], codec.decode(cur, log[1], log[2], log[3])
+
+def train_dict(c, codec, lower, upper, size=DICT_SIZE, samples=DICT_SAMPLES):
+    """Train a dictionary on some logs
+
+    :param c: The database cursor
+    :param LogCodec codec: The codec to decompress existing logs with
+    :param int lower: The first logid to sample
+    :param int upper: The last logid to sample
+    :param int size: The maximum size of the dictionary
+    :param int samples: The maximum number of logs to train on
+    :return: The trained dictionary, or ``None`` if there are not enough logs to train on
+    :rtype: bytes
+    """
+
+    c.execute("""SELECT
+                     data,
+                     zdata,
+                     dictid
+                 FROM log_json
+                 WHERE logid IN (SELECT
+                         logid
+                     FROM log_json
+                     WHERE logid BETWEEN %s AND %s
+                     ORDER BY random()
+                     LIMIT %s
+                 );""", (lower, upper, samples))
+    logs = [json.dumps(codec.decode(c, *row)).encode() for row in c.fetchall()]
+    try:
+        return zstandard.train_dictionary(size, logs, level=codec.level).as_bytes()
+    except zstandard.ZstdError:
+        logging.warning("Could not train a dictionary on %s log(s) from %s to %s", len(logs),
+                        lower, upper)
+        return None
+
+def recompress(c, codec, lower, upper):
+    """Recompress logs with their current dictionaries
+
+    Each chunk of logs is committed separately.
+
+    :param c: The database connection
+    :param LogCodec codec: The codec to use
+    :param int lower: The first logid to recompress
+    :param int upper: The last logid to recompress
+    """
+
+    cur = c.cursor()
+    for logs in chunk(iter_logs(c, codec, (lower, upper)), 1000):
+        cur.execute("BEGIN;")
+        rows = codec.encode(cur, [(logid, json.dumps(log)) for logid, log in logs])
+        psycopg2.extras.execute_values(cur,
+            """UPDATE log_json SET
+                   data = NULL,
+                   zdata = new.zdata,
+                   dictid = new.dictid
+               FROM (VALUES %s) AS new (logid, zdata, dictid)
+               WHERE log_json.logid = new.logid;""",
+            [(logid, zdata, dictid) for logid, _, zdata, dictid in rows],
+            "(%s, %s::BYTEA, %s::INT)", page_size=len(rows))
+        cur.execute("COMMIT;")
+        logging.info("Recompressed logs %s to %s", rows[0][0], rows[-1][0])
+
+def compress(args, c, mc):
+    """Train dictionaries for full partitions of log_json and recompress them"""
+    codec = LogCodec(args.level if args else LEVEL)
+    cur = c.cursor()
+    cur.execute("""SELECT
+                       part * %(size)s AS lower
+                   FROM generate_series(0, (SELECT max(logid) FROM log_json) / %(size)s - 1)
+                       AS part
+                   WHERE part * %(size)s NOT IN (SELECT lower FROM log_json_dict)
+                   ORDER BY part;""", { 'size': PARTITION_SIZE })
+    trained = []
+    for lower, in cur.fetchall():
+        upper = lower + PARTITION_SIZE - 1
+        cur.execute("BEGIN;")
+        dict_data = train_dict(cur, codec, lower, upper)
+        if dict_data is not None:
+            cur.execute("""INSERT INTO log_json_dict (lower, data)
+                           VALUES (%s, %s);""", (lower, dict_data))
+            logging.info("Trained a %s byte dictionary for logs %s to %s", len(dict_data), lower,
+                         upper)
+            trained.append(lower)
+        cur.execute("COMMIT;")
+
+    # Logs after each partition may have been compressed with an older dictionary, so recompress
+    # everything up to the next dictionary
+    for lower in trained:
+        cur.execute("SELECT min(lower) FROM log_json_dict WHERE lower > %s;", (lower,))
+        recompress(c, codec, lower, (cur.fetchone()[0] or 2**31) - 1)
+
+def create_compress_parser(sub):
+    compress_parser = sub.add_parser("compress", help="Compress the original logs")
+    compress_parser.set_defaults(importer=compress)
+    compress_parser.add_argument("-l", "--level", type=int, default=LEVEL,
+                                 help=f"zstd compression level, defaults to {LEVEL}")
+
+def benchmark(files, levels=(3, 10, 19), sizes=(0, 16384, 32768, DICT_SIZE)):
+    """Compare compression ratio and decompression speed for some logs
+
+    Dictionaries are trained on half of the logs and tested on the other half, so they are not
+    tested on their own training data.
+
+    :param files: The logs to test with
+    :type files: list of paths
+    :param levels: The compression levels to try
+    :param sizes: The dictionary sizes to try, where 0 means no dictionary
+    """
+
+    logs = []
+    for file in files:
+        with open(file) as f:
+            logs.append(json.dumps(json.load(f)).encode())
+    train, test = logs[::2], logs[1::2]
+    total = sum(len(log) for log in test)
+
+    print(f"{len(test)} logs, {total} bytes")
+    print("level    dict   ratio  compress (MB/s)  decompress (MB/s)")
+    for size in sizes:
+        dict_data = zstandard.train_dictionary(size, train) if size else None
+        dctx = zstandard.ZstdDecompressor(dict_data=dict_data)
+        for level in levels:
+            cctx = zstandard.ZstdCompressor(level=level, dict_data=dict_data)
+
+            start = time.perf_counter()
+            compressed = [cctx.compress(log) for log in test]
+            ctime = time.perf_counter() - start
+
+            iters = 0
+            start = time.perf_counter()
+            while (dtime := time.perf_counter() - start) < 1:
+                for data in compressed:
+                    dctx.decompress(data)
+                iters += 1
+
+            ratio = total / sum(len(data) for data in compressed)
+            print(f"{level:5} {size:7} {ratio:7.2f} {total / ctime / 1e6:16.1f} "
+                  f"{iters * total / dtime / 1e6:18.1f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=benchmark.__doc__.splitlines()[0])
+    parser.add_argument("files", nargs='+', metavar="LOG", help="Logs to test with")
+    benchmark(parser.parse_args().files)
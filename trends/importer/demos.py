@@ -10,6 +10,7 @@ import psycopg2
 import sentry_sdk
 
 from .fetch import DemoFileFetcher, DemoListFetcher, DemoBulkFetcher
+from .logs import IdCache, upsert_ids, upsert_players
 from ..cache import purge_players
 from ..steamid import SteamID
 from ..sql import disable_tracing, publicize
@@ -27,8 +28,8 @@ def filter_demoids(c, demoids):
                    WHERE public.demo.demoid IS NULL""", ((demoid,) for demoid in demoids))
             yield from (row[0] for row in cur)
 
-def import_demo(c, demo):
-    players = []
+def import_demo(c, demo, ids):
+    players = {}
     for player in demo['players']:
         # Probably nothing useful here
         if player['team'] not in ('red', 'blue'):
@@ -39,30 +40,22 @@ def import_demo(c, demo):
         except ValueError:
             continue
 
-        c.execute("INSERT INTO name (name) VALUES (%(name)s) ON CONFLICT DO NOTHING;", player)
-        c.execute("""INSERT INTO player (
-                         steamid64,
-                         nameid,
-                         last_active
-                     ) VALUES (
-                         %s,
-                         (SELECT nameid FROM name WHERE name = %s),
-                         %s
-                     ) ON CONFLICT DO NOTHING;""",
-                  (steamid, player['name'], demo['time']))
+        players.setdefault(str(steamid), (steamid, player['name']))
+
+    nameids = upsert_ids(c, 'name', (name for steamid, name in players.values()), ids)
+    playerids = upsert_players(c, ((steamid, nameids[name], demo['time'])
+                                   for steamid, name in players.values()), ids, update=False)
+    for steamid, name in players.values():
         c.execute("INSERT INTO cache_purge_player (steamid64) VALUES (%s);", (steamid,))
-        players.append(steamid)
 
-    demo['players'] = players
-    c.execute("INSERT INTO map (map) VALUES (%(map)s) ON CONFLICT DO NOTHING;", demo)
+    demo['mapid'] = upsert_ids(c, 'map', (demo['map'],), ids)[demo['map']]
+    demo['players'] = [playerids[steamid] for steamid in players] or None
     c.execute("""INSERT INTO demo (
                      demoid, url, server, duration, mapid, time, red_name, blue_name, red_score,
                      blue_score, players
                  ) VALUES (
-                     %(id)s, %(url)s, %(server)s, %(duration)s,
-                     (SELECT mapid FROM map WHERE map = %(map)s), %(time)s, %(red)s, %(blue)s,
-                     %(redScore)s, %(blueScore)s,
-                     (SELECT array_agg(playerid) FROM player WHERE steamid64 = ANY(%(players)s))
+                     %(id)s, %(url)s, %(server)s, %(duration)s, %(mapid)s, %(time)s, %(red)s,
+                     %(blue)s, %(redScore)s, %(blueScore)s, %(players)s
                  )""", demo);
 
 def create_demos_parser(sub):
@@ -125,6 +118,7 @@ def import_demos(c, mc, fetcher):
 
     count = 0
     start = datetime.now()
+    ids = IdCache()
     for demoid in filter_demoids(c, fetcher.get_ids()):
         demo = fetcher.get_data(demoid)
         if demo is None:
@@ -134,16 +128,18 @@ def import_demos(c, mc, fetcher):
              disable_tracing():
             cur.execute("BEGIN;")
             try:
-                import_demo(c.cursor(), demo)
+                import_demo(c.cursor(), demo, ids)
             except (IndexError, KeyError, psycopg2.errors.NumericValueOutOfRange):
                 logging.exception("Could not parse demo %s", demoid)
                 cur.execute("ROLLBACK;")
+                ids.rollback()
             except psycopg2.Error:
                 logging.error("Could not import demo %s", demoid)
                 raise
             else:
                 count += 1
             cur.execute("COMMIT;")
+            ids.commit()
 
         now = datetime.now()
         if (now - start).total_seconds() > 60 or count > 500:
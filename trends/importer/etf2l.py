@@ -11,7 +11,7 @@ import time
 from psycopg2.extras import NumericRange
 import sentry_sdk
 
-from ..cache import purge_comps, purge_matches, purge_players, purge_teams
+from ..cache import Purger, purge_comps, purge_matches, purge_players, purge_teams
 from .fetch import ETF2LFileFetcher, ETF2LBulkFetcher, FetchError
 from .league import *
 from ..sql import db_connect
@@ -162,59 +162,61 @@ def import_etf2l_cli(args, c, mc):
 def import_etf2l(c, mc, fetcher, filter=filter_matchids):
     cur = c.cursor()
     count = 0
-    for result in filter(c, fetcher.get_results()):
-        try:
-            res = parse_result(result)
-            for team in res['teams']:
-                team['league'] = 'etf2l'
-                team['compid'] = res['compid']
-                team['divid'] = res['divid']
-
-                cur.execute(
-                    """SELECT coalesce(fetched, 0)
-                       FROM league_team
-                       WHERE league = 'etf2l'
-                           AND teamid = %(teamid)s
-                       UNION ALL
-                       SELECT 0;""", team)
-                row = cur.fetchone()
-                if row[0] <= (res['fetched'] or 0):
-                    team['fetched'] = time.time()
-                    team['updates'] = []
-                    for xfer in fetcher.get_xfers(team['teamid'], since=row[0]):
-                        try:
-                            team['updates'].append(parse_xfer(xfer))
-                        except ValueError:
-                            pass
-                else:
-                    team['fetched'] = row[0]
-                    team['updates'] = ()
-
-            res['teamid1'] = res['teams'][0]['teamid']
-            res['teamid2'] = res['teams'][1]['teamid']
-            # sigh...
-            if res['teamid1'] == res['teamid2']:
-                continue
-
-            with sentry_sdk.start_span(op='db.transaction', description=f"import {result['id']}"):
-                cur.execute("BEGIN;")
-                import_compdiv(cur, res)
+    with Purger(c, mc) as purger:
+        for result in filter(c, fetcher.get_results()):
+            try:
+                res = parse_result(result)
                 for team in res['teams']:
-                    import_team(cur, team)
-                import_match(cur, res)
-                cur.execute("COMMIT;")
-            purge_comps(c, mc, 'etf2l')
-            purge_teams(c, mc, 'etf2l')
-            purge_matches(c, mc, 'etf2l')
-            purge_players(c, mc)
-        except FetchError:
-            continue
-        except (IndexError, KeyError, psycopg2.errors.UniqueViolation):
-            logging.exception("Could not parse result %s", result['id'])
-            cur.execute("ROLLBACK;")
-        except psycopg2.Error:
-            logging.error("Could not import result %s", result['id'])
-            raise
-        else:
-            count += 1
+                    team['league'] = 'etf2l'
+                    team['compid'] = res['compid']
+                    team['divid'] = res['divid']
+
+                    cur.execute(
+                        """SELECT coalesce(fetched, 0)
+                           FROM league_team
+                           WHERE league = 'etf2l'
+                               AND teamid = %(teamid)s
+                           UNION ALL
+                           SELECT 0;""", team)
+                    row = cur.fetchone()
+                    if row[0] <= (res['fetched'] or 0):
+                        team['fetched'] = time.time()
+                        team['updates'] = []
+                        for xfer in fetcher.get_xfers(team['teamid'], since=row[0]):
+                            try:
+                                team['updates'].append(parse_xfer(xfer))
+                            except ValueError:
+                                pass
+                    else:
+                        team['fetched'] = row[0]
+                        team['updates'] = ()
+
+                res['teamid1'] = res['teams'][0]['teamid']
+                res['teamid2'] = res['teams'][1]['teamid']
+                # sigh...
+                if res['teamid1'] == res['teamid2']:
+                    continue
+
+                with sentry_sdk.start_span(op='db.transaction',
+                                           description=f"import {result['id']}"):
+                    cur.execute("BEGIN;")
+                    import_compdiv(cur, res)
+                    for team in res['teams']:
+                        import_team(cur, team)
+                    import_match(cur, res)
+                    cur.execute("COMMIT;")
+                purger.add(purge_comps, 'etf2l')
+                purger.add(purge_teams, 'etf2l')
+                purger.add(purge_matches, 'etf2l')
+                purger.add(purge_players)
+            except FetchError:
+                continue
+            except (IndexError, KeyError, psycopg2.errors.UniqueViolation):
+                logging.exception("Could not parse result %s", result['id'])
+                cur.execute("ROLLBACK;")
+            except psycopg2.Error:
+                logging.error("Could not import result %s", result['id'])
+                raise
+            else:
+                count += 1
     logging.info("Imported %s matches", count)
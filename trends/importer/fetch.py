@@ -2,6 +2,7 @@
 # Copyright (C) 2020-21 Sean Anderson <seanga2@gmail.com>
 
 import collections
+import concurrent.futures
 from glob import glob
 import itertools
 import json
@@ -9,6 +10,7 @@ import logging
 import os
 import re
 import sqlite3
+import threading
 import time
 
 import requests, requests.adapters
@@ -33,6 +35,50 @@ def create_session():
         s.mount("https://", requests.adapters.HTTPAdapter(max_retries=retries))
         return s
 
+def prefetch(fetcher, ids, jobs=1, ping=lambda: None):
+    """Fetch data for several ids concurrently
+
+    Data is fetched by a pool of ``jobs`` threads, but is yielded in the same order as ``ids``. At
+    most ``2 * jobs`` results are buffered; no further ids are consumed until the caller catches
+    up.
+
+    :param fetcher: The fetcher to use. Its ``get_data`` method must be thread-safe if ``jobs`` is
+                    greater than 1.
+    :param ids: The ids to fetch
+    :type ids: any iterable
+    :param int jobs: The number of fetches to run concurrently
+    :param ping: Called periodically while waiting for data
+    :return: Pairs of ids and their data
+    :rtype: iterable of (id, data)
+    """
+
+    if jobs <= 1:
+        for id in ids:
+            ping()
+            yield id, fetcher.get_data(id)
+        return
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending = collections.deque()
+        ids = iter(ids)
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) < 2 * jobs:
+                try:
+                    id = next(ids)
+                except StopIteration:
+                    exhausted = True
+                else:
+                    pending.append((id, executor.submit(fetcher.get_data, id)))
+
+            if not pending:
+                return
+
+            id, future = pending.popleft()
+            while not concurrent.futures.wait((future,), timeout=1).done:
+                ping()
+            yield id, future.result()
+
 class ListFetcher:
     """Fetcher for a list of log ids for logs to get from logs.tf"""
     def __init__(self, logids=None, **kwargs):
@@ -42,9 +88,18 @@ class ListFetcher:
         :type logids: iteratable of ints
         """
 
-        self.s = create_session()
+        # Sessions aren't thread-safe, so use one per thread
+        self.local = threading.local()
         self.logids = logids if logids is not None else iter(())
 
+    @property
+    def s(self):
+        try:
+            return self.local.s
+        except AttributeError:
+            self.local.s = create_session()
+            return self.local.s
+
     def get_ids(self):
         return self.logids
 
@@ -167,6 +222,9 @@ class FileFetcher:
         with open(self.logs[logid]) as logfile:
             return json.load(logfile)
 
+    def get_batch(self, logids):
+        return { logid: self.get_data(logid) for logid in logids }
+
 class CloneLogsFetcher:
     """Fetcher for SQLite databases created with clone_logs"""
     def __init__(self, db=None, **kwargs):
@@ -180,77 +238,115 @@ class CloneLogsFetcher:
         self.c.row_factory = sqlite3.Row
 
         # Add some indices for better performance
-        for table in ('chat', 'heal_spread', 'player', 'player_weapon', 'round'):
+        for table in ('chat', 'heal_spread', 'killstreak', 'player', 'player_weapon', 'round'):
             self.c.execute("CREATE INDEX IF NOT EXISTS {0}_pkey ON {0} (log_id)".format(table))
+        self.c.execute("CREATE TEMP TABLE batch (id INTEGER PRIMARY KEY)")
 
     def date_colspec(self, column='date'):
         return "cast(strftime('%s', {}, 'utc') AS INT)".format(column)
 
     def get_ids(self):
-        return self.c.execute("SELECT id, {} FROM log".format(self.date_colspec()))
-
-    def get_data(self, logid):
-        class_keys = [('heavy', 'heavyweapons') if cls == 'heavy' else cls for cls in classes]
-        def extract(row, keys, format_string='{}'):
-            ret = {}
-            for key in keys:
+        return self.c.execute("SELECT id, {} FROM log ORDER BY id".format(self.date_colspec()))
+
+    @staticmethod
+    def extract(row, keys, format_string='{}'):
+        ret = {}
+        for key in keys:
+            try:
+                ret[key[1]] = row[format_string.format(key[0])]
+            except IndexError:
                 try:
-                    ret[key[1]] = row[format_string.format(key[0])]
+                    ret[key] = row[format_string.format(key)]
                 except IndexError:
-                    try:
-                        ret[key] = row[format_string.format(key)]
-                    except IndexError:
-                        logging.error("No such key %s", key)
-                        raise
-
-            return ret
-
-        ret = {
-            'version': 3,
-        }
-        log = self.c.execute("""SELECT
-                                    {} AS date,
-                                    *
-                                FROM log
-                                WHERE id = ?;""".format(self.date_colspec()), (logid,)).fetchone()
-        ret['info'] = extract(log, (
-            'date',
-            'title',
-            'map',
-            ('duration',               'total_length'),
-            ('has_real_damage',        'hasRealDamage'),
-            ('has_weapon_damage',      'hasWeaponDamage'),
-            ('has_accuracy',           'hasAccuracy'),
-            ('has_medkit_pickups',     'hasHP'),
-            ('has_medkit_pickups',     'hasHP'),
-            ('has_medkit_health',      'hasHP_real'),
-            ('has_headshot_kills',     'hasHS'),
-            ('has_headshot_hits',      'hasHS_hit'),
-            ('has_backstabs',          'hasBS'),
-            ('has_point_captures',     'hasCP'),
-            ('has_sentries_built',     'hasSB'),
-            ('has_damage_taken',       'hasDT'),
-            ('has_airshots',           'hasAS'),
-            ('has_heals_received',     'hasHR'),
-            ('has_intel_captures',     'hasIntel'),
-            ('scoring_attack_defense', 'AD_scoring'),
-        ))
-        ret['info']['uploader'] = extract(log, (('steam_id', 'id'), 'name', 'info'), 'uploader_{}')
-        team_keys = ('score', 'kills', 'deaths', ('damage', 'dmg'), 'charges', 'drops',
-                     ('first_caps', 'firstcaps'), 'caps')
-        ret['teams'] = {
-            'Red': extract(log, team_keys, 'red_{}'),
-            'Blue': extract(log, team_keys, 'blu_{}'),
-        }
-
-        ret['rounds'] = []
-        rounds = self.c.execute("""SELECT
-                                       {} AS start_time,
-                                       *
-                                   FROM round
-                                   WHERE log_id = ?
-                                   ORDER BY idx ASC;""".format(self.date_colspec('start')),
-                                (logid,))
+                    logging.error("No such key %s", key)
+                    raise
+
+        return ret
+
+    def scan(self, table, order, columns='*'):
+        """Scan the rows of a table belonging to the current batch
+
+        :param str table: The table to scan
+        :param str order: The column to order by (after ``log_id``)
+        :param str columns: The columns to select
+        :return: The rows of ``table``
+        :rtype: iterable of sqlite3.Row
+        """
+
+        return self.c.execute("""SELECT {0}
+                                 FROM {1}
+                                 JOIN batch ON (batch.id = log_id)
+                                 ORDER BY log_id, {1}.{2}""".format(columns, table, order))
+
+    def get_batch(self, logids):
+        """Get several logs at once
+
+        Rather than querying each table once per log (or per player), each table is scanned once
+        for the whole batch.
+
+        :param logids: The logs to get
+        :type logids: iterable of int
+        :return: The logs, formatted like the logs.tf API
+        :rtype: dict of int to dict
+        """
+
+        extract = self.extract
+        self.c.execute("DELETE FROM batch")
+        self.c.executemany("INSERT INTO batch (id) VALUES (?)", ((logid,) for logid in logids))
+
+        ret = {}
+        logs = self.c.execute("""SELECT
+                                     {} AS date,
+                                     log.*
+                                 FROM log
+                                 JOIN batch USING (id)
+                                 ORDER BY id;""".format(self.date_colspec()))
+        for log in logs:
+            team_keys = ('score', 'kills', 'deaths', ('damage', 'dmg'), 'charges', 'drops',
+                         ('first_caps', 'firstcaps'), 'caps')
+            info = extract(log, (
+                'date',
+                'title',
+                'map',
+                ('duration',               'total_length'),
+                ('has_real_damage',        'hasRealDamage'),
+                ('has_weapon_damage',      'hasWeaponDamage'),
+                ('has_accuracy',           'hasAccuracy'),
+                ('has_medkit_pickups',     'hasHP'),
+                ('has_medkit_pickups',     'hasHP'),
+                ('has_medkit_health',      'hasHP_real'),
+                ('has_headshot_kills',     'hasHS'),
+                ('has_headshot_hits',      'hasHS_hit'),
+                ('has_backstabs',          'hasBS'),
+                ('has_point_captures',     'hasCP'),
+                ('has_sentries_built',     'hasSB'),
+                ('has_damage_taken',       'hasDT'),
+                ('has_airshots',           'hasAS'),
+                ('has_heals_received',     'hasHR'),
+                ('has_intel_captures',     'hasIntel'),
+                ('scoring_attack_defense', 'AD_scoring'),
+            ))
+            info['uploader'] = extract(log, (('steam_id', 'id'), 'name', 'info'), 'uploader_{}')
+
+            ret[log['id']] = {
+                'version': 3,
+                'info': info,
+                'teams': {
+                    'Red': extract(log, team_keys, 'red_{}'),
+                    'Blue': extract(log, team_keys, 'blu_{}'),
+                },
+                'rounds': [],
+                'players': {},
+                'names': {},
+                'healspread': collections.defaultdict(dict),
+                'chat': [],
+                'killstreaks': [],
+            }
+            for prop in util.events:
+                ret[log['id']][prop] = collections.defaultdict(dict)
+
+        rounds = self.scan('round', 'idx', "{} AS start_time, round.*"
+                                           .format(self.date_colspec('start')))
         for round in rounds:
             tmp = extract(round, ('start_time',
                                   'winner',
@@ -260,17 +356,15 @@ class CloneLogsFetcher:
             tmp['team'] = {}
             tmp['team']['Red'] = extract(round, round_team_keys, 'red_{}')
             tmp['team']['Blue'] = extract(round, round_team_keys, 'blu_{}')
-            ret['rounds'].append(tmp)
-
-        ret['players'] = {}
-        ret['names'] = {}
-        for prop in events:
-            ret[prop] = collections.defaultdict(dict)
-        players = self.c.execute("SELECT * FROM player WHERE log_id = ?;", (logid,))
-        for player in players:
+            ret[round['log_id']]['rounds'].append(tmp)
+
+        # Weapons are looked up by (log_id, steam_id, class)
+        class_stats = {}
+        for player in self.scan('player', 'rowid'):
+            log = ret[player['log_id']]
             steamid = player['steam_id']
-            ret['names'][steamid] = player['name']
-            ret['players'][steamid] = extract(player, (
+            log['names'][steamid] = player['name']
+            log['players'][steamid] = extract(player, (
                 'team',
                 'kills',
                 'deaths',
@@ -302,7 +396,7 @@ class CloneLogsFetcher:
                 if player[f'charges_{medigun}']:
                     ubertypes[medigun] = player[f'charges_{medigun}']
             if any(ubertypes.values()):
-                ret['players'][steamid]['ubertypes'] = ubertypes
+                log['players'][steamid]['ubertypes'] = ubertypes
 
             medic_stats = extract(player, (
                 'advantages_lost',
@@ -314,10 +408,10 @@ class CloneLogsFetcher:
                 ('average_charge_length', 'avg_uber_length'),
             ))
             if any(medic_stats.values()):
-                ret['players'][steamid]['medicstats'] = medic_stats
+                log['players'][steamid]['medicstats'] = medic_stats
 
-            ret['players'][steamid]['class_stats'] = []
-            for cls in classes:
+            log['players'][steamid]['class_stats'] = []
+            for cls in util.classes:
                 tmp = extract(player, (('time', 'total_time'), 'kills', 'assists', 'deaths',
                                        ('damage', 'dmg')),
                               '{}_as_' + ('heavy' if cls == 'heavyweapons' else cls))
@@ -325,43 +419,40 @@ class CloneLogsFetcher:
                     continue
 
                 tmp['type'] = cls
-                weapons = self.c.execute("""SELECT
-                                                *
-                                            FROM player_weapon
-                                            WHERE log_id = ?
-                                                AND steam_id = ?
-                                                AND class = ?;""", (logid, steamid, cls))
-                tmp['weapon'] = {
-                        weapon['weapon']: extract(weapon, ('kills', ('damage', 'dmg'),
-                                                           ('average_damage', 'avg_dmg'),
-                                                           'shots', 'hits'))
-                        for weapon in weapons
-                }
-
-                ret['players'][steamid]['class_stats'].append(tmp)
-
-            for prop, event in events.items():
-                for cls in classes:
+                tmp['weapon'] = {}
+                class_stats[player['log_id'], steamid, cls] = tmp
+                log['players'][steamid]['class_stats'].append(tmp)
+
+            for prop, event in util.events.items():
+                for cls in util.classes:
                     val = player['{}_{}s'.format('heavy' if cls == 'heavyweapons' else cls, event)]
                     if val:
-                        ret[prop][steamid][cls] = val
+                        log[prop][steamid][cls] = val
+
+        for weapon in self.scan('player_weapon', 'rowid'):
+            cls = class_stats.get((weapon['log_id'], weapon['steam_id'], weapon['class']))
+            if cls is not None:
+                cls['weapon'][weapon['weapon']] = extract(weapon, ('kills', ('damage', 'dmg'),
+                                                                   ('average_damage', 'avg_dmg'),
+                                                                   'shots', 'hits'))
 
-        heals = self.c.execute("SELECT * FROM heal_spread WHERE log_id = ?", (logid,))
-        ret['healspread'] = collections.defaultdict(dict)
-        for heal in heals:
-            ret['healspread'][heal['healer_steam_id']][heal['target_steam_id']] = heal['heal_amount']
+        for heal in self.scan('heal_spread', 'rowid'):
+            healspread = ret[heal['log_id']]['healspread']
+            healspread[heal['healer_steam_id']][heal['target_steam_id']] = heal['heal_amount']
 
-        chat = self.c.execute("SELECT * FROM chat WHERE log_id = ? ORDER BY idx ASC", (logid,))
-        ret['chat'] = [extract(msg, (('steam_id', 'steamid'), 'name', ('message', 'msg')))
-                       for msg in chat]
+        for msg in self.scan('chat', 'idx'):
+            ret[msg['log_id']]['chat'].append(extract(msg, (('steam_id', 'steamid'), 'name',
+                                                            ('message', 'msg'))))
 
-        killstreaks = self.c.execute("SELECT * FROM killstreak WHERE log_id = ? ORDER BY time ASC",
-                                     (logid,))
-        ret['killstreaks'] = [extract(killstreak, (('steam_id', 'steamid'), 'streak', 'time'))
-                              for killstreak in killstreaks]
+        for killstreak in self.scan('killstreak', 'time'):
+            ret[killstreak['log_id']]['killstreaks'].append(
+                extract(killstreak, (('steam_id', 'steamid'), 'streak', 'time')))
 
         return ret
 
+    def get_data(self, logid):
+        return self.get_batch((logid,)).get(logid)
+
 class DemoFileFetcher:
     def __init__(self, /, demos, **kwargs):
         self.demos = {}
@@ -390,7 +481,6 @@ class DemoListFetcher(ListFetcher):
 
 class DemoBulkFetcher(DemoListFetcher):
     def __init__(self, since=None, until=None, count=None, page=1, **kwargs):
-        self.s = create_session()
         self.since = since
         self.until = until
         self.count = count
@@ -5,6 +5,7 @@ from datetime import datetime, timedelta
 import logging
 
 from ..cache import purge_comps, purge_logs, purge_matches, purge_players, purge_teams
+from .refresh import update_cubes, update_summaries
 from ..util import League
 
 def create_link_matches_parser(sub):
@@ -86,6 +87,11 @@ def link_matches(args, c, mc):
 
         cur.execute("SELECT count(*) from log_matches;");
         count = cur.fetchone()[0]
+        cur.execute("""INSERT INTO cube_dirty (playerid)
+                       SELECT DISTINCT playerid
+                       FROM log_matches
+                       JOIN player_stats_backing USING (logid)
+                       ON CONFLICT DO NOTHING;""")
         cur.execute("""UPDATE log SET
                            league = log_matches.league,
                            matchid = log_matches.matchid,
@@ -93,6 +99,7 @@ def link_matches(args, c, mc):
                            team1_is_red = log_matches.team1_is_red
                        FROM log_matches
                        WHERE log.logid = log_matches.logid;""")
+        update_summaries(c)
         cur.execute("INSERT INTO cache_purge_log (logid) SELECT logid FROM log_matches;")
         cur.execute("""INSERT INTO cache_purge_comp (league, compid)
                        SELECT league, compid
@@ -124,3 +131,4 @@ def link_matches(args, c, mc):
         for league in League:
             purge_matches(c, mc, league)
         purge_players(c, mc)
+    update_cubes(c, mc)
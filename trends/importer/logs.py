@@ -2,18 +2,26 @@
 # Copyright (C) 2020-21 Sean Anderson <seanga2@gmail.com>
 
 import argparse
+import collections
 from datetime import datetime
+import decimal
+import io
 import json
 import logging
+import time
 
 import psycopg2
 import sentry_sdk
 import systemd_watchdog
 
 from ..cache import purge_logs, purge_players
-from .fetch import ListFetcher, BulkFetcher, FileFetcher, ReverseFetcher, CloneLogsFetcher
+from .compress import LogCodec
+from .fetch import ListFetcher, BulkFetcher, FileFetcher, ReverseFetcher, CloneLogsFetcher, \
+                   prefetch
+from .refresh import add_logs, update_cubes, update_summaries
 from ..steamid import SteamID
-from ..sql import disable_tracing, delete_logs, log_tables, publicize, table_columns
+from ..sql import disable_tracing, disable_wait_callback, delete_logs, log_tables, publicize, \
+                  table_columns
 from .. import util
 from ..util import chunk
 
@@ -52,15 +60,280 @@ def filter_logids(c, logids, update_only=False):
             if not update_only if not row['exists'] else row['newer']:
                 yield row['logid']
 
-def import_log(c, logid, log):
-    """Import a log into the database.
+# Errors which indicate a malformed log
+parse_errors = (IndexError, KeyError)
+
+# Columns to insert for each of the log tables, in the order they appear in rows from write_logs
+log_columns = {
+    'log': ('logid', 'time', 'duration', 'title', 'mapid', 'red_score', 'blue_score',
+            'ad_scoring', 'uploader', 'uploader_nameid', 'updated'),
+    'log_json': ('logid', 'data', 'zdata', 'dictid'),
+    'round': ('logid', 'seq', 'duration', 'time', 'winner', 'firstcap', 'red_score',
+              'blue_score', 'red_kills', 'blue_kills', 'red_dmg', 'blue_dmg', 'red_ubers',
+              'blue_ubers'),
+    'player_stats_backing': ('logid', 'playerid', 'team', 'nameid', 'kills', 'assists',
+                             'deaths', 'dmg', 'dt'),
+    'player_stats_extra': ('logid', 'playerid', 'suicides', 'dmg_real', 'dt_real', 'hr', 'lks',
+                           'airshots', 'medkits', 'medkits_hp', 'backstabs', 'headshots',
+                           'headshots_hit', 'sentries', 'healing', 'cpc', 'ic'),
+    'killstreak': ('logid', 'playerid', 'time', 'kills'),
+    'medic_stats': ('logid', 'playerid', 'ubers', 'medigun_ubers', 'kritz_ubers', 'other_ubers',
+                    'drops', 'advantages_lost', 'biggest_advantage_lost',
+                    'avg_time_before_healing', 'avg_time_before_using', 'avg_time_to_build',
+                    'avg_uber_duration', 'deaths_after_uber', 'deaths_before_uber'),
+    'heal_stats': ('logid', 'healer', 'healee', 'healing'),
+    'class_stats': ('logid', 'playerid', 'classid', 'kills', 'assists', 'deaths', 'dmg',
+                    'duration'),
+    'weapon_stats': ('logid', 'playerid', 'classid', 'weaponid', 'kills', 'dmg', 'avg_dmg',
+                     'shots', 'hits'),
+    'event_stats': ('logid', 'playerid', 'eventid', 'demoman', 'engineer', 'heavyweapons',
+                    'medic', 'pyro', 'scout', 'sniper', 'soldier', 'spy'),
+    'chat': ('logid', 'playerid', 'seq', 'msg'),
+}
+
+def insert_values(c, query, rows, template=None, fetch=False):
+    """Insert several rows using a single statement
+
+    This is a thin wrapper around :func:`psycopg2.extras.execute_values` which always uses one
+    page, and which skips the query entirely if there are no rows.
+
+    :param c: The database cursor
+    :param str query: The query to execute, with a single ``%s`` for the values
+    :param list rows: The rows to insert
+    :param str template: The template for each row
+    :param bool fetch: Whether to return the results of the query
+    :return: The results of the query, if ``fetch`` is set
+    :rtype: list
+    """
+
+    if not rows:
+        return []
+    return psycopg2.extras.execute_values(c, query, rows, template, page_size=len(rows),
+                                          fetch=fetch)
+
+def copy_value(value):
+    """Format a value for ``COPY ... FROM STDIN`` in the text format"""
+    if value is None:
+        return '\\N'
+    elif value is True:
+        return 't'
+    elif value is False:
+        return 'f'
+    elif isinstance(value, bytes):
+        return '\\\\x' + value.hex()
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n') \
+                     .replace('\r', '\\r')
+
+def copy_rows(c, table, columns, rows):
+    """Insert several rows using ``COPY``
+
+    Unlike with :func:`insert_values`, values are not converted to the type of their column. For
+    example, floats may not be copied into integer columns.
+
+    :param c: The database cursor
+    :param str table: The table to insert into
+    :param columns: The columns of each row
+    :type columns: iterable of str
+    :param list rows: The rows to insert
+    """
+
+    if not rows:
+        return
+    data = io.StringIO()
+    for row in rows:
+        data.write('\t'.join(copy_value(value) for value in row))
+        data.write('\n')
+    data.seek(0)
+    with disable_wait_callback():
+        c.copy_expert("COPY {} ({}) FROM STDIN;".format(table, ", ".join(columns)), data)
+
+class IdCache:
+    """A bounded cache of ids from lookup tables
+
+    The same names, players, and maps show up in many consecutive logs. To avoid looking them up
+    again for every log, remember the ids of the values we have seen most recently. Ids learned
+    during a transaction may disappear if it is rolled back, so they are forgotten by
+    :meth:`rollback` unless :meth:`commit` is called first.
+
+    :param int size: The maximum number of ids to remember
+    """
+
+    def __init__(self, size=100000):
+        self.size = size
+        self.ids = collections.OrderedDict()
+        self.pending = set()
+        self.tables = {}
+
+    def get(self, table, value):
+        """Get a cached id
+
+        :param str table: The table of the value
+        :param value: The value to look up
+        :return: The id of ``value``, or ``None`` if it is not cached
+        """
+
+        key = (table, value)
+        try:
+            self.ids.move_to_end(key)
+        except KeyError:
+            return None
+        return self.ids[key]
+
+    def put(self, table, value, id):
+        """Cache the id of a value, which was learned in the current transaction"""
+        key = (table, value)
+        self.ids[key] = id
+        self.ids.move_to_end(key)
+        self.pending.add(key)
+        if len(self.ids) > self.size:
+            self.ids.popitem(last=False)
+
+    def commit(self):
+        """Keep the ids learned in the current transaction"""
+        self.pending.clear()
+
+    def rollback(self):
+        """Forget the ids learned in the current transaction"""
+        for key in self.pending:
+            self.ids.pop(key, None)
+        self.pending.clear()
+
+    def table(self, c, table):
+        """Get all of the ids in a table
+
+        This is intended for small tables (such as ``class``) which are never modified by the
+        importer.
+
+        :param c: The database cursor
+        :param str table: The table to get ids from
+        :return: A mapping of values to ids
+        :rtype: dict
+        """
+
+        if table not in self.tables:
+            c.execute("SELECT {0}, {0}id FROM {0};".format(table))
+            self.tables[table] = dict(c.fetchall())
+        return self.tables[table]
+
+def upsert_ids(c, table, values, ids):
+    """Insert values into a lookup table, returning their ids
+
+    Lookup tables (such as ``name``) have a serial ``<table>id`` column and a unique ``<table>``
+    column.
+
+    :param c: The database cursor
+    :param str table: The table to insert into
+    :param values: The values to insert
+    :type values: any iterable
+    :param IdCache ids: Cached ids
+    :return: A mapping of values to ids
+    :rtype: dict
+    """
+
+    ret = {}
+    missing = []
+    for value in dict.fromkeys(values):
+        id = ids.get(table, value)
+        if id is None:
+            missing.append((value,))
+        else:
+            ret[value] = id
+
+    rows = insert_values(c, """WITH new (value) AS (VALUES %s),
+                               inserted AS (INSERT INTO {0} ({0})
+                                   SELECT value
+                                   FROM new
+                                   ON CONFLICT DO NOTHING
+                                   RETURNING {0}id, {0}
+                               )
+                               SELECT {0}id, {0} FROM inserted
+                               UNION ALL
+                               SELECT {0}id, {0}
+                               FROM {0}
+                               JOIN new ON ({0} = value);""".format(table),
+                         missing, fetch=True)
+    # If another transaction inserted a value while we waited on the conflict, neither half of the
+    # query will see it, so look it up again with a new snapshot
+    if len(rows) < len(missing):
+        found = set(value for id, value in rows)
+        c.execute("SELECT {0}id, {0} FROM {0} WHERE {0} = ANY(%s);".format(table),
+                  ([value for value, in missing if value not in found],))
+        rows.extend(c.fetchall())
+    for id, value in rows:
+        ids.put(table, value, id)
+        ret[value] = id
+    return ret
+
+def upsert_players(c, players, ids, update=True):
+    """Insert players, returning their ids
+
+    :param c: The database cursor
+    :param players: The players to insert
+    :type players: iterable of (steamid64, nameid, last_active) tuples
+    :param IdCache ids: Cached ids
+    :param bool update: Whether to update the ``last_active`` of players which already exist (if
+                        it is later)
+    :return: A mapping of (string) steamid64s to playerids
+    :rtype: dict
+    """
+
+    ret = {}
+    missing = {}
+    for steamid, nameid, last_active in players:
+        steamid = str(steamid)
+        cached = ids.get('player', steamid)
+        if cached is not None and (not update or last_active is None
+                                   or (cached[1] or 0) >= last_active):
+            ret[steamid] = cached[0]
+        else:
+            missing[steamid] = (steamid, nameid, last_active)
+
+    if update:
+        rows = insert_values(c, """INSERT INTO player (steamid64, nameid, last_active)
+                                   VALUES %s
+                                   ON CONFLICT (steamid64) DO UPDATE SET
+                                       last_active = greatest(player.last_active,
+                                                              EXCLUDED.last_active)
+                                   RETURNING steamid64, playerid, last_active;""",
+                             list(missing.values()), fetch=True)
+    else:
+        rows = insert_values(c, """WITH new (steamid64, nameid, last_active) AS (VALUES %s),
+                                   inserted AS (INSERT INTO player (steamid64, nameid, last_active)
+                                       SELECT *
+                                       FROM new
+                                       ON CONFLICT DO NOTHING
+                                       RETURNING steamid64, playerid, last_active
+                                   )
+                                   SELECT * FROM inserted
+                                   UNION ALL
+                                   SELECT steamid64, playerid, player.last_active
+                                   FROM player
+                                   JOIN new USING (steamid64);""",
+                             list(missing.values()), "(%s::BIGINT, %s::INT, %s::BIGINT)",
+                             fetch=True)
+        # See upsert_ids
+        if len(rows) < len(missing):
+            found = set(str(row[0]) for row in rows)
+            c.execute("""SELECT steamid64, playerid, last_active
+                         FROM player
+                         WHERE steamid64 = ANY(%s::BIGINT[]);""",
+                      ([steamid for steamid in missing if steamid not in found],))
+            rows.extend(c.fetchall())
+    for steamid, playerid, last_active in rows:
+        ids.put('player', str(steamid), (playerid, last_active))
+        ret[str(steamid)] = playerid
+    return ret
+
+def parse_info(logid, log):
+    """Parse the top-level information of a log
 
-    :param sqlite3.Connection c: The database connection
     :param int logid: The id of the log
     :param log: A log parsed from json
+    :return: The parsed log, to be passed to :func:`parse_stats` and :func:`write_logs`
+    :rtype: dict
     :raises TypeError: if a required property is missing
+    :raises KeyError: if a required property is missing
     :raised IndexError: if there are no rounds in the log
-    :raises sqlite3.DatabaseError: if there was a problem accessing the database
     """
 
     # Unused for the moment
@@ -99,37 +372,42 @@ def import_log(c, logid, log):
     # If we're still negative, use the sum of (positive) rounds
     info['duration'] = round_length if length <= 0 else length
 
-    c.execute("INSERT INTO map (map) VALUES (%(map)s) ON CONFLICT DO NOTHING;", info)
-    c.execute("INSERT INTO name (name) VALUES (%(uploader_name)s) ON CONFLICT DO NOTHING;", info)
-    c.execute("""INSERT INTO player (steamid64, nameid) VALUES (
-                     %(uploader_steamid)s,
-                     (SELECT nameid FROM name WHERE name = %(uploader_name)s)
-                 ) ON CONFLICT (steamid64) DO NOTHING;""", info)
-    c.execute("SELECT playerid FROM player WHERE steamid64 = %(uploader_steamid)s;", info)
-    info['uploader_playerid'] = c.fetchone()[0]
-    c.execute("""INSERT INTO log (
-                     logid, time, duration, title, mapid, red_score, blue_score, ad_scoring,
-                     uploader, uploader_nameid, updated
-                 ) VALUES (
-                     %(logid)s, %(date)s, %(duration)s, %(title)s,
-                     (SELECT mapid FROM map WHERE map = %(map)s),
-                     %(red_score)s, %(blue_score)s, %(AD_scoring)s, %(uploader_playerid)s,
-                     (SELECT nameid FROM name WHERE name = %(uploader_name)s),
-                     greatest(extract(EPOCH FROM now())::BIGINT, %(date)s)
-                 );""",
-              info)
-    c.execute("INSERT INTO log_json (logid, data) VALUES (%s, %s)", (logid, log))
-
-    # From here on in we want to keep our log and log_json rows
-    c.execute("SAVEPOINT import;")
+    return {
+        'info': info,
+        'rounds': rounds,
+        # Save the json now, since parse_stats will modify the log
+        'json': json.dumps(log),
+        'stats': None,
+    }
 
-    # Ignore logs from banned players
-    c.execute("SELECT banned FROM player WHERE playerid = %(uploader_playerid)s;", info);
-    for row in c:
-        if row[0]:
-            return
+def parse_stats(parsed, log):
+    """Parse the per-player (and per-round) stats of a log
+
+    The stats are stored in ``parsed['stats']``.
+
+    :param dict parsed: The log, as returned by :func:`parse_info`
+    :param log: A log parsed from json
+    :raises TypeError: if a required property is missing
+    :raises KeyError: if a required property is missing
+    """
 
+    info = parsed['info']
+    logid = info['logid']
     doubled_ubers = True
+    stats = {
+        'names': [],
+        'players': {},
+        'player_stats_backing': [],
+        'player_stats_extra': [],
+        'event_stats': [],
+        'medic_stats': [],
+        'class_stats': [],
+        'weapon_stats': [],
+        'killstreak': [],
+        'chat': [],
+        'heal_stats': [],
+        'round': [],
+    }
 
     for steamid_str, player in log['players'].items():
         # Some players don't have teams (they do actually have teams but they weren't parsed
@@ -143,9 +421,10 @@ def import_log(c, logid, log):
             continue
 
         player['logid'] = logid
-        player['steamid'] = steamid
-        player['time'] = info['date']
-        player['name'] = log['names'][steamid_str] 
+        player['steamid'] = str(steamid)
+        player['name'] = log['names'][steamid_str]
+        stats['names'].append(player['name'])
+        stats['players'].setdefault(player['steamid'], player['name'])
 
         # If we don't have a property, it may be absent or set to 0.
         # Instead, set missing keys to None so they become NULLs.
@@ -177,41 +456,11 @@ def import_log(c, logid, log):
         player['suicides'] = player.get('suicides')
         player['heal'] = player.get('heal')
 
-        c.execute("INSERT INTO name (name) VALUES (%(name)s) ON CONFLICT DO NOTHING;", player)
-        c.execute("""INSERT INTO player (
-                         steamid64,
-                         nameid,
-                         last_active
-                     ) VALUES (
-                         %(steamid)s,
-                         (SELECT nameid FROM name WHERE name = %(name)s),
-                         %(time)s
-                     ) ON CONFLICT (steamid64)
-                     DO UPDATE SET
-                         last_active = greatest(player.last_active, EXCLUDED.last_active);""",
-                  player)
-        c.execute("SELECT playerid FROM player WHERE steamid64 = %(steamid)s;", player)
-        player['playerid'] = c.fetchone()[0]
-        c.execute("""INSERT INTO player_stats_backing (
-                         logid, playerid, team, nameid, kills, assists, deaths, dmg, dt
-                     ) VALUES (
-                         %(logid)s, %(playerid)s, %(team)s,
-                         (SELECT nameid FROM name WHERE name = %(name)s), %(kills)s, %(assists)s,
-                         %(deaths)s, %(dmg)s, %(dt)s
-                     );""", player)
+        stats['player_stats_backing'].append(player)
         if any((player[key] for key in ('suicides', 'dmg_real', 'dt_real', 'hr', 'lks', 'as',
                                         'medkits', 'medkits_hp', 'backstabs', 'headshots',
                                         'headshots_hit', 'sentries', 'heal', 'cpc', 'ic'))):
-            c.execute("""INSERT INTO player_stats_extra (
-                             logid, playerid, suicides, dmg_real, dt_real, hr, lks, airshots,
-                             medkits, medkits_hp, backstabs, headshots, headshots_hit, sentries,
-                             healing, cpc, ic
-                         ) VALUES (
-                             %(logid)s, %(playerid)s, %(suicides)s, %(dmg_real)s, %(dt_real)s,
-                             %(hr)s, %(lks)s, %(as)s, %(medkits)s, %(medkits_hp)s, %(backstabs)s,
-                             %(headshots)s, %(headshots_hit)s, %(sentries)s, %(heal)s, %(cpc)s,
-                             %(ic)s
-                         );""", player)
+            stats['player_stats_extra'].append(player)
 
         for prop, event in util.events.items():
             if not log.get(prop):
@@ -223,22 +472,14 @@ def import_log(c, logid, log):
                 continue
 
             events['logid'] = logid
-            events['playerid'] = player['playerid']
+            events['steamid'] = player['steamid']
             events['event'] = event
             for cls in util.classes:
                 events[cls] = events.get(cls, 0)
 
             # There are also 'unknown' events, but we skip them; they can be determined by the
             # difference between the sum of this event and the event in player_stats
-            c.execute("""INSERT INTO event_stats (
-                             logid, playerid, eventid, demoman, engineer, heavyweapons, medic,
-                             pyro, scout, sniper, soldier, spy
-                         ) VALUES (
-                             %(logid)s, %(playerid)s,
-                             (SELECT eventid FROM event WHERE event = %(event)s), %(demoman)s,
-                             %(engineer)s, %(heavyweapons)s, %(medic)s, %(pyro)s, %(scout)s,
-                             %(sniper)s, %(soldier)s, %(spy)s
-                         );""", events)
+            stats['event_stats'].append(events)
 
         for cls in player['class_stats']:
             # 99% of these contain no info which can't be inferred from player_stats
@@ -248,7 +489,7 @@ def import_log(c, logid, log):
             if cls['type'] == 'medic':
                 medic = player.get('medicstats', {})
                 medic['logid'] = logid
-                medic['playerid'] = player['playerid']
+                medic['steamid'] = player['steamid']
                 medic['ubers'] = player['ubers']
                 medic['drops'] = player['drops']
 
@@ -291,36 +532,17 @@ def import_log(c, logid, log):
                              'deaths_within_20s_after_uber', 'deaths_with_95_99_uber'):
                     medic[prop] = medic.get(prop)
 
-                c.execute("""INSERT INTO medic_stats (
-                                 logid, playerid, ubers, medigun_ubers, kritz_ubers,
-                                 other_ubers, drops, advantages_lost, biggest_advantage_lost,
-                                 avg_time_before_healing, avg_time_before_using,
-                                 avg_time_to_build, avg_uber_duration, deaths_after_uber,
-                                 deaths_before_uber
-                             ) VALUES (
-                                 %(logid)s, %(playerid)s, %(ubers)s, %(medigun_ubers)s,
-                                 %(kritz_ubers)s, %(other_ubers)s, %(drops)s, %(advantages_lost)s,
-                                 %(biggest_advantage_lost)s, %(avg_time_before_healing)s,
-                                 %(avg_time_before_using)s, %(avg_time_to_build)s,
-                                 %(avg_uber_length)s, %(deaths_within_20s_after_uber)s,
-                                 %(deaths_with_95_99_uber)s
-                            );""", medic)
+                stats['medic_stats'].append(medic)
 
             cls['logid'] = logid
-            cls['playerid'] = player['playerid']
+            cls['steamid'] = player['steamid']
 
             # Some logs accidentally have a timestamp instead of a duration. Try and fix this up as
             # best we can... This may also fix some logs where players have slightly more time
             # played than the match duration.
             cls['total_time'] = max(min(cls['total_time'], info['duration']), 0)
 
-            c.execute("""INSERT INTO class_stats (
-                             logid, playerid, classid, kills, assists, deaths, dmg, duration
-                         ) VALUES (
-                             %(logid)s, %(playerid)s,
-                             (SELECT classid FROM class WHERE class = %(type)s), %(kills)s,
-                             %(assists)s, %(deaths)s, %(dmg)s, %(total_time)s
-                         );""", cls);
+            stats['class_stats'].append(cls)
 
             # Some very old logs have no weapons stats at all
             if not cls.get('weapon'):
@@ -335,7 +557,7 @@ def import_log(c, logid, log):
                     weapon = { 'kills': weapon }
 
                 weapon['logid'] = logid
-                weapon['playerid'] = player['playerid']
+                weapon['steamid'] = player['steamid']
                 weapon['class'] = cls['type']
                 weapon['name'] = weapon_name
 
@@ -346,82 +568,66 @@ def import_log(c, logid, log):
                     weapon['shots'] = None
                     weapon['hits'] = None
 
-                c.execute("INSERT INTO weapon (weapon) VALUES (%(name)s) ON CONFLICT DO NOTHING;",
-                          weapon)
-                c.execute("""INSERT INTO weapon_stats (
-                                 logid, playerid, classid, weaponid, kills, dmg, avg_dmg, shots,
-                                 hits
-                             ) VALUES (
-                                 %(logid)s, %(playerid)s,
-                                 (SELECT classid FROM class WHERE class = %(class)s),
-                                 (SELECT weaponid FROM weapon WHERE weapon = %(name)s), %(kills)s,
-                                 %(dmg)s, %(avg_dmg)s, %(shots)s, %(hits)s
-                             );""", weapon)
+                stats['weapon_stats'].append(weapon)
 
+    # Sometimes a player only shows up in killstreaks, rounds, or healspread. These rows would
+    # violate our foreign keys, so skip them.
+    has_stats = set(player['steamid'] for player in stats['player_stats_backing'])
+    killstreaks = {}
     for killstreak in log.get('killstreaks', ()):
         try:
-            steamid = SteamID(killstreak['steamid'])
+            steamid = str(SteamID(killstreak['steamid']))
         except ValueError:
             continue
 
-        try:
-            c.execute("SAVEPOINT before_killstreak;")
-            c.execute("""INSERT INTO killstreak (
-                             logid, playerid, time, kills
-                         ) VALUES (
-                            %s, (SELECT playerid FROM player WHERE steamid64 = %s), %s, %s
-                         ) ON CONFLICT DO NOTHING;""",
-                      (logid, steamid, killstreak['time'], killstreak['streak']))
-        except (psycopg2.errors.ForeignKeyViolation, psycopg2.errors.NotNullViolation):
+        if steamid not in has_stats:
             logging.warning("%s is only present in killstreak for log %s", steamid, logid)
-            c.execute("ROLLBACK TO SAVEPOINT before_killstreak;")
+            continue
+        killstreaks.setdefault((steamid, killstreak['time']), killstreak['streak'])
+    stats['killstreak'] = [(steamid, when, kills)
+                           for (steamid, when), kills in killstreaks.items()]
 
     for (seq, msg) in enumerate(log['chat']):
         try:
-            steamid = SteamID(msg['steamid']) if msg['steamid'] != 'Console' else None
+            steamid = str(SteamID(msg['steamid'])) if msg['steamid'] != 'Console' else None
         except ValueError:
             continue
 
-        c.execute("INSERT INTO name (name) VALUES (%(name)s) ON CONFLICT DO NOTHING;", msg)
+        stats['names'].append(msg['name'])
         if steamid:
-            c.execute("""INSERT INTO player (steamid64, nameid) VALUES (
-                             %s, (SELECT nameid FROM name WHERE name = %s)
-                         ) ON CONFLICT (steamid64) DO NOTHING;""", (steamid, msg['name']))
-        c.execute("""INSERT INTO chat (logid, playerid, seq, msg)
-                     VALUES (
-                         %s, (SELECT playerid FROM player WHERE steamid64 = %s), %s, %s
-                     );""", (logid, steamid, seq, msg['msg']))
+            stats['players'].setdefault(steamid, msg['name'])
+        stats['chat'].append((steamid, seq, msg['msg']))
 
+    heal_stats = {}
     for (healer, healees) in log['healspread'].items():
         try:
-            healer = SteamID(healer)
+            healer = str(SteamID(healer))
         except ValueError:
             continue
 
         for (healee, healing) in healees.items():
             try:
-                healee = SteamID(healee)
+                healee = str(SteamID(healee))
             except ValueError:
                 continue
 
-            try:
-                # Sometimes we get the same row more than once (e.g. with different text
-                # representations of the same steamid). It appears that later rows are a result of
-                # healing being logged more than once, and aren't distinct instances of healing.
-                c.execute("SAVEPOINT before_heal_stats;")
-                c.execute("""INSERT INTO heal_stats (logid, healer, healee, healing)
-                             VALUES (
-                                 %s, (SELECT playerid FROM player WHERE steamid64 = %s),
-                                 (SELECT playerid FROM player WHERE steamid64 = %s), %s
-                             ) ON CONFLICT DO NOTHING;""",
-                          (logid, healer, healee, healing))
-            # Sometimes a player only shows up in rounds and healspread...
-            except (psycopg2.errors.ForeignKeyViolation, psycopg2.errors.NotNullViolation):
+            if healer not in has_stats or healee not in has_stats:
                 logging.warning("Either %s or %s is only present in healspread for log %s",
                                 healer, healee, logid)
-                c.execute("ROLLBACK TO SAVEPOINT before_heal_stats;")
+                continue
+
+            # Sometimes we get the same row more than once (e.g. with different text
+            # representations of the same steamid). It appears that later rows are a result of
+            # healing being logged more than once, and aren't distinct instances of healing.
+            heal_stats.setdefault((healer, healee), healing)
+    stats['heal_stats'] = [(healer, healee, healing)
+                           for (healer, healee), healing in heal_stats.items()]
+
+    def halve(ubers):
+        # Round like postgres does when converting to an integer
+        return int((decimal.Decimal(ubers) / 2).to_integral_value(decimal.ROUND_HALF_UP))
 
-    for (seq, round) in enumerate(rounds):
+    for (seq, round) in enumerate(parsed['rounds']):
         teams = round.get('team', round)
         red = teams['Red']
         blue = teams['Blue']
@@ -452,17 +658,236 @@ def import_log(c, logid, log):
         round['red_ubers'] = red['ubers']
         round['blue_ubers'] = blue['ubers']
         if doubled_ubers:
-            round['red_ubers'] /= 2
-            round['blue_ubers'] /= 2
-
-        c.execute("""INSERT INTO round (
-                         logid, seq, duration, time, winner, firstcap, red_score, blue_score,
-                         red_kills, blue_kills, red_dmg, blue_dmg, red_ubers, blue_ubers
-                     ) VALUES (
-                         %(logid)s, %(seq)s, %(length)s, %(time)s, %(winner)s, %(firstcap)s,
-                         %(red_score)s, %(blue_score)s, %(red_kills)s, %(blue_kills)s, %(red_dmg)s,
-                         %(blue_dmg)s, %(red_ubers)s, %(blue_ubers)s
-                     );""", round)
+            round['red_ubers'] = halve(round['red_ubers'])
+            round['blue_ubers'] = halve(round['blue_ubers'])
+
+        stats['round'].append(round)
+
+    parsed['stats'] = stats
+
+def write_logs(c, logs, ids, copy=False, codec=None):
+    """Write parsed logs to the database
+
+    Each table is written with a single statement, no matter how many logs there are. Logs
+    without stats (or which were uploaded by banned players) only have their log and log_json
+    rows written.
+
+    :param c: The database cursor
+    :param logs: The parsed logs
+    :type logs: iterable of dicts returned by :func:`parse_info`
+    :param IdCache ids: Cached ids
+    :param bool copy: Whether to use ``COPY`` instead of ``INSERT``. This is faster, but may fail
+                      for logs with unusual values.
+    :param LogCodec codec: The codec to compress the original json with. If this is ``None``, the
+                           json is stored uncompressed.
+    :raises psycopg2.Error: if there was a problem accessing the database
+    """
+
+    logs = list(logs)
+    if not logs:
+        return
+
+    # Ignore logs from banned players
+    c.execute("SELECT steamid64 FROM player WHERE banned AND steamid64 IN %s;",
+              (tuple(parsed['info']['uploader_steamid'] for parsed in logs),))
+    banned = set(str(row[0]) for row in c)
+    for parsed in logs:
+        if parsed['info']['uploader_steamid'] in banned:
+            parsed['stats'] = None
+
+    # Resolve all the ids we need up front
+    names = []
+    players = {}
+    weapons = []
+    for parsed in logs:
+        info = parsed['info']
+        names.append(info['uploader_name'])
+        players.setdefault(info['uploader_steamid'], [info['uploader_name'], None])
+
+        stats = parsed['stats']
+        if not stats:
+            continue
+
+        names.extend(stats['names'])
+        for steamid, name in stats['players'].items():
+            players.setdefault(steamid, [name, None])
+        for player in stats['player_stats_backing']:
+            last_active = players[player['steamid']][1]
+            players[player['steamid']][1] = max(last_active or 0, info['date'])
+        weapons.extend(weapon['name'] for weapon in stats['weapon_stats'])
+
+    mapids = upsert_ids(c, 'map', (parsed['info']['map'] for parsed in logs), ids)
+    nameids = upsert_ids(c, 'name', names, ids)
+    weaponids = upsert_ids(c, 'weapon', sorted(set(weapons)), ids)
+    playerids = upsert_players(c, ((steamid, nameids[name], last_active)
+                                   for steamid, (name, last_active) in players.items()), ids)
+    classids = ids.table(c, 'class')
+    eventids = ids.table(c, 'event')
+
+    rows = { table: [] for table in log_columns }
+    updated = int(time.time())
+    for parsed in logs:
+        info = parsed['info']
+        logid = info['logid']
+        rows['log'].append((logid, info['date'], info['duration'], info['title'],
+                            mapids[info['map']], info['red_score'], info['blue_score'],
+                            info['AD_scoring'], playerids[info['uploader_steamid']],
+                            nameids[info['uploader_name']], max(updated, info['date'])))
+        if not codec:
+            rows['log_json'].append((logid, parsed['json'], None, None))
+
+        stats = parsed['stats']
+        if not stats:
+            continue
+
+        rows['round'].extend((logid, round['seq'], round['length'], round['time'],
+                              round['winner'], round['firstcap'], round['red_score'],
+                              round['blue_score'], round['red_kills'], round['blue_kills'],
+                              round['red_dmg'], round['blue_dmg'], round['red_ubers'],
+                              round['blue_ubers'])
+                             for round in stats['round'])
+        rows['player_stats_backing'].extend((logid, playerids[player['steamid']], player['team'],
+                                             nameids[player['name']], player['kills'],
+                                             player['assists'], player['deaths'], player['dmg'],
+                                             player['dt'])
+                                            for player in stats['player_stats_backing'])
+        rows['player_stats_extra'].extend((logid, playerids[player['steamid']],
+                                           player['suicides'], player['dmg_real'],
+                                           player['dt_real'], player['hr'], player['lks'],
+                                           player['as'], player['medkits'], player['medkits_hp'],
+                                           player['backstabs'], player['headshots'],
+                                           player['headshots_hit'], player['sentries'],
+                                           player['heal'], player['cpc'], player['ic'])
+                                          for player in stats['player_stats_extra'])
+        rows['killstreak'].extend((logid, playerids[steamid], when, kills)
+                                  for steamid, when, kills in stats['killstreak'])
+        rows['medic_stats'].extend((logid, playerids[medic['steamid']], medic['ubers'],
+                                    medic['medigun_ubers'], medic['kritz_ubers'],
+                                    medic['other_ubers'], medic['drops'],
+                                    medic['advantages_lost'], medic['biggest_advantage_lost'],
+                                    medic['avg_time_before_healing'],
+                                    medic['avg_time_before_using'], medic['avg_time_to_build'],
+                                    medic['avg_uber_length'],
+                                    medic['deaths_within_20s_after_uber'],
+                                    medic['deaths_with_95_99_uber'])
+                                   for medic in stats['medic_stats'])
+        rows['heal_stats'].extend((logid, playerids[healer], playerids[healee], healing)
+                                  for healer, healee, healing in stats['heal_stats'])
+        rows['class_stats'].extend((logid, playerids[cls['steamid']], classids[cls['type']],
+                                    cls['kills'], cls['assists'], cls['deaths'], cls['dmg'],
+                                    cls['total_time'])
+                                   for cls in stats['class_stats'])
+        rows['weapon_stats'].extend((logid, playerids[weapon['steamid']],
+                                     classids[weapon['class']], weaponids[weapon['name']],
+                                     weapon['kills'], weapon['dmg'], weapon['avg_dmg'],
+                                     weapon['shots'], weapon['hits'])
+                                    for weapon in stats['weapon_stats'])
+        rows['event_stats'].extend((logid, playerids[events['steamid']],
+                                    eventids[events['event']],
+                                    *(events[cls] for cls in util.classes))
+                                   for events in stats['event_stats'])
+        rows['chat'].extend((logid, playerids[steamid] if steamid else None, seq, msg)
+                            for steamid, seq, msg in stats['chat'])
+
+    if codec:
+        rows['log_json'] = codec.encode(c, [(parsed['info']['logid'], parsed['json'])
+                                            for parsed in logs])
+
+    for table, _ in log_tables:
+        columns = log_columns[table]
+        if copy:
+            copy_rows(c, table, columns, rows[table])
+        else:
+            insert_values(c, "INSERT INTO {} ({}) VALUES %s;".format(table, ", ".join(columns)),
+                          rows[table])
+
+        if table == 'log_json':
+            # From here on in we want to keep our log and log_json rows
+            c.execute("SAVEPOINT import;")
+
+def import_log(c, logid, log, ids, codec=None):
+    """Import a log into the database.
+
+    :param c: The database cursor
+    :param int logid: The id of the log
+    :param log: A log parsed from json
+    :param IdCache ids: Cached ids
+    :param LogCodec codec: The codec to compress the original json with
+    :raises TypeError: if a required property is missing
+    :raises KeyError: if a required property is missing
+    :raised IndexError: if there are no rounds in the log
+    :raises psycopg2.Error: if there was a problem accessing the database
+    """
+
+    parsed = parse_info(logid, log)
+    try:
+        parse_stats(parsed, log)
+    finally:
+        # Even if we can't parse the stats, keep the log around so we don't try to import it again
+        write_logs(c, (parsed,), ids, codec=codec)
+
+def import_batch(c, logs, ids, codec=None):
+    """Import a batch of logs into the database using ``COPY``.
+
+    Unlike :func:`import_log`, errors parsing logs are handled by adding them to ``to_delete``. If
+    the batch cannot be copied into the database, the logs are inserted one at a time instead.
+
+    :param c: The database cursor
+    :param logs: The logs to import
+    :type logs: iterable of (logid, log)
+    :param IdCache ids: Cached ids
+    :param LogCodec codec: The codec to compress the original json with
+    :return: The number of logs imported
+    :rtype: int
+    :raises psycopg2.Error: if there was a problem accessing the database
+    """
+
+    parsed_logs = []
+    failed = set()
+    for logid, log in logs:
+        try:
+            parsed = parse_info(logid, log)
+        except parse_errors:
+            logging.exception("Could not parse log %s", logid)
+            failed.add(logid)
+            continue
+
+        try:
+            parse_stats(parsed, log)
+        except parse_errors:
+            logging.exception("Could not parse log %s", logid)
+            failed.add(logid)
+        parsed_logs.append(parsed)
+
+    insert_values(c, "INSERT INTO to_delete (logid) VALUES %s;", [(logid,) for logid in failed])
+    c.execute("SAVEPOINT batch;")
+    try:
+        write_logs(c, parsed_logs, ids, copy=True, codec=codec)
+    except psycopg2.Error:
+        logging.warning("Could not copy batch; falling back to inserting logs individually",
+                        exc_info=True)
+        c.execute("ROLLBACK TO SAVEPOINT batch;")
+        ids.rollback()
+    else:
+        return len(parsed_logs) - len(failed)
+
+    count = 0
+    for parsed in parsed_logs:
+        logid = parsed['info']['logid']
+        c.execute("SAVEPOINT import;")
+        try:
+            write_logs(c, (parsed,), ids, codec=codec)
+        except psycopg2.errors.NumericValueOutOfRange:
+            logging.exception("Could not parse log %s", logid)
+            c.execute("ROLLBACK TO SAVEPOINT import;")
+            ids.rollback()
+            c.execute("INSERT INTO to_delete VALUES (%s) ON CONFLICT DO NOTHING;", (logid,))
+        except psycopg2.Error:
+            logging.error("Could not import log %s", logid)
+            raise
+        else:
+            count += logid not in failed
+    return count
 
 def delete_dup_logs(c):
     """Delete duplicate logs
@@ -479,6 +904,10 @@ def delete_dup_logs(c):
     """
 
     cur = c.cursor()
+    # Temporary tables are never analyzed automatically. Without statistics, the planner may not
+    # realize that it is cheaper to look up each new round using the round_time and round_stats
+    # indices than to scan every round in the window.
+    cur.execute("ANALYZE round;")
     cur.execute("""SELECT
                        min(logid)
                    FROM combined_logs
@@ -528,7 +957,7 @@ def delete_dup_logs(c):
     cur.execute("DROP TABLE dupes_time;")
     cur.execute("DROP TABLE dupes_stats;")
 
-def delete_bogus_logs(c):
+def delete_bogus_logs(c, bounds=None):
     """Delete bogus logs
 
     In some logs, players have negative damage. There are not very many, so just delete them.
@@ -538,14 +967,18 @@ def delete_bogus_logs(c):
                     DISTINCT logid
                  FROM weapon_stats
                  WHERE dmg < 0
-                 ON CONFLICT DO NOTHING;""")
+                     {}
+                 ON CONFLICT DO NOTHING;"""
+              .format("AND logid BETWEEN %s AND %s" if bounds else ""), bounds)
 
-def delete_dup_rounds(c):
+def delete_dup_rounds(c, bounds=None):
     """Delete duplicate rounds
 
     Some logs have duplicate rounds. Delete them.
 
     :param sqlite.Connection c: The database connection:
+    :param bounds: The (inclusive) range of logids to process, or ``None`` for all logs
+    :type bounds: tuple of (int, int)
     """
 
     c.execute("""CREATE TABLE dupes AS SELECT
@@ -555,17 +988,20 @@ def delete_dup_rounds(c):
                  JOIN round AS r2 USING (
                      logid, time, duration, winner, firstcap, red_score, blue_score, red_dmg,
                      blue_dmg, red_kills, blue_kills, red_ubers, blue_ubers
-                 ) WHERE r1.seq > r2.seq;""")
+                 ) WHERE r1.seq > r2.seq
+                     {};""".format("AND logid BETWEEN %s AND %s" if bounds else ""), bounds)
 
     c.execute("DELETE FROM round WHERE (logid, seq) IN (SELECT * FROM dupes);")
     c.execute("DROP TABLE dupes;")
 
-def update_stalemates(c):
+def update_stalemates(c, bounds=None):
     """Find stalemates and mark the winner as NULL
 
     This should be run after removing duplicate rounds
 
     :param sqlite.Connection c: The database connection:
+    :param bounds: The (inclusive) range of logids to process, or ``None`` for all logs
+    :type bounds: tuple of (int, int)
     """
 
     c.execute("""UPDATE round
@@ -575,16 +1011,19 @@ def update_stalemates(c):
                          max(seq)
                      FROM log
                      JOIN round USING (logid)
+                     {}
                      GROUP BY logid, log.red_score, log.blue_score
                      HAVING count(winner) > (log.red_score + log.blue_score)
-                 );""")
+                 );""".format("WHERE logid BETWEEN %s AND %s" if bounds else ""), bounds)
 
-def update_formats(c):
+def update_formats(c, bounds=()):
     """Set the format for all logs
 
     See the SQL comments for details on this heuristic.
 
     :param sqlite.Connection c: The database connection:
+    :param bounds: The (inclusive) range of logids to process, or ``()`` for all logs
+    :type bounds: tuple of (int, int)
     """
 
     c.execute("""UPDATE log
@@ -614,6 +1053,7 @@ def update_formats(c):
                                  count(DISTINCT playerid) AS total_players,
                                  total(duration) as total_duration
                              FROM class_stats
+                             {0}
                              GROUP BY logid
                          ) AS counts USING (logid)
                          -- Only set the format if it isn't already set
@@ -629,9 +1069,10 @@ def update_formats(c):
                          fo.format = 'other'
                      )
                  ) AS new
-                 WHERE log.logid = new.logid;""")
+                 WHERE log.logid = new.logid;"""
+              .format("WHERE logid BETWEEN %s AND %s" if bounds else ""), bounds)
 
-def update_wlt(c):
+def update_wlt(c, bounds=()):
     c.execute("""UPDATE player_stats_backing AS ps
                  SET wins = CASE new.team
                          WHEN 'Red' THEN new.red_score
@@ -671,11 +1112,14 @@ def update_wlt(c):
                              sum((round.winner = 'Blue')::INT) AS blue_score,
                              sum((round.winner ISNULL AND round.duration >= 60)::INT) AS ties
                          FROM round
+                         {0}
                          GROUP BY logid
                      ) AS round USING (logid)
+                     {0}
                  ) AS new
                  WHERE ps.logid = new.logid
-                     AND ps.playerid = new.playerid""")
+                     AND ps.playerid = new.playerid"""
+              .format("WHERE logid BETWEEN %s AND %s" if bounds else ""), (*bounds, *bounds))
 
 def update_player_classes(cur, bounds=None):
     cur.execute("""UPDATE player_stats_backing AS ps SET
@@ -765,7 +1209,7 @@ def update_healing(cur, bounds=()):
                        AND ps.playerid = new.playerid;"""
                  .format("WHERE logid BETWEEN %s AND %s" if bounds else ""), (*bounds, *bounds))
 
-def update_ks(cur):
+def update_ks(cur, bounds=None):
     cur.execute("""UPDATE player_stats_extra AS pse SET
                        mks = new.mks
                    FROM (SELECT
@@ -773,10 +1217,12 @@ def update_ks(cur):
                            playerid,
                            max(kills) AS mks
                        FROM killstreak
+                       {}
                        GROUP BY logid, playerid
                    ) AS new
                    WHERE pse.logid = new.logid
-                       AND pse.playerid = new.playerid;""")
+                       AND pse.playerid = new.playerid;"""
+                .format("WHERE logid BETWEEN %s AND %s" if bounds else ""), bounds)
 
 def prepare_purge(cur):
     cur.execute("INSERT INTO cache_purge_log (logid) SELECT logid FROM log;")
@@ -786,6 +1232,35 @@ def prepare_purge(cur):
                    JOIN player USING (playerid)
                    GROUP BY steamid64;""")
 
+def prepare_cubes(cur):
+    """Find the logs which need to be added to the leaderboard cubes
+
+    New logs can be added to the cubes directly, but logs which are being imported again were
+    already added. Recalculate their players from scratch instead.
+
+    :param cur: The database cursor
+    :return: The new logs
+    :rtype: list of int
+    """
+
+    cur.execute("""INSERT INTO cube_dirty (playerid)
+                   SELECT playerid
+                   FROM public.player_stats_backing
+                   WHERE logid IN (SELECT logid FROM log)
+                   UNION
+                   SELECT playerid
+                   FROM player_stats_backing
+                   WHERE logid IN (SELECT logid FROM public.log)
+                   ON CONFLICT DO NOTHING;""")
+    cur.execute("""SELECT logid
+                   FROM log
+                   WHERE NOT EXISTS (SELECT
+                           *
+                       FROM public.log
+                       WHERE public.log.logid = log.logid
+                   );""")
+    return [row[0] for row in cur]
+
 def create_logs_parser(sub):
     class LogAction(argparse.Action):
         def __init__(self, option_strings, dest, **kwargs):
@@ -837,12 +1312,23 @@ def create_logs_parser(sub):
                    help="Database to import logs from")
     logs.add_argument("-u", "--update-only", action='store_true',
                       help="Only update logs already in the database")
+    logs.add_argument("--no-compress", action='store_false', dest='compress',
+                      help="Store the original json without compressing it")
+    logs.set_defaults(jobs=1, batch_size=None)
+    for fetcher in (b, l, r):
+        fetcher.add_argument("-j", "--jobs", type=int, default=1,
+                             help="Fetch up to JOBS logs concurrently")
+    f.add_argument("-b", "--batch-size", type=int, default=None, metavar="SIZE",
+                   help="Import logs in batches of SIZE using COPY")
+    c.add_argument("-b", "--batch-size", type=int, default=1000, metavar="SIZE",
+                   help="Import logs in batches of SIZE using COPY, defaults to 1000")
 
 def import_logs_cli(args, c, mc):
     with sentry_sdk.start_transaction(op="import", name="logs"):
-        return import_logs(c, mc, args.fetcher(**vars(args)), args.update_only)
+        return import_logs(c, mc, args.fetcher(**vars(args)), args.update_only, args.jobs,
+                           args.batch_size, args.compress)
 
-def import_logs(c, mc, fetcher, update_only):
+def import_logs(c, mc, fetcher, update_only, jobs=1, batch_size=None, compress=True):
     cur = c.cursor()
     wd = systemd_watchdog.watchdog()
 
@@ -864,8 +1350,12 @@ def import_logs(c, mc, fetcher, update_only):
                        REFERENCES player_stats_backing (logid, playerid);""")
     # We need this index to calculate formats efficiently
     cur.execute("CREATE INDEX class_stats_logid ON class_stats (logid);")
-    # And this index to limit dupes
+    # And these indices to find dupes
     cur.execute("CREATE INDEX log_time ON log (time);")
+    cur.execute("CREATE INDEX round_time ON round (time, duration) INCLUDE (logid);")
+    cur.execute("""CREATE INDEX round_stats
+                   ON round (duration, red_dmg, blue_dmg, red_kills, blue_kills)
+                   INCLUDE (logid);""")
     # Finally, add some convenience views
     cur.execute("""CREATE TEMP VIEW combined_logs AS
                    SELECT * FROM log
@@ -879,31 +1369,74 @@ def import_logs(c, mc, fetcher, update_only):
     def commit():
         with sentry_sdk.start_span(op='db.transaction', description="commit"):
             cur.execute("BEGIN;")
+            # Only look at the logs we just imported. The temp tables are emptied after every
+            # commit, but the dead rows stick around (temp tables are never vacuumed), so this
+            # lets us use the primary keys instead of scanning everything.
+            cur.execute("SELECT min(logid), max(logid) FROM log;")
+            bounds = tuple(cur.fetchone())
+
             delete_dup_logs(c)
-            delete_bogus_logs(cur)
+            delete_bogus_logs(cur, bounds)
             delete_logs(cur)
 
-            delete_dup_rounds(cur)
-            update_stalemates(cur)
-            update_formats(cur)
-            update_wlt(cur)
-            update_player_classes(cur)
-            update_acc(cur)
-            update_healing(cur)
-            update_ks(cur)
+            delete_dup_rounds(cur, bounds)
+            update_stalemates(cur, bounds)
+            update_formats(cur, bounds)
+            update_wlt(cur, bounds)
+            update_player_classes(cur, bounds)
+            update_acc(cur, bounds)
+            update_healing(cur, bounds)
+            update_ks(cur, bounds)
             prepare_purge(cur)
+            logids = prepare_cubes(cur)
             publicize(c, log_tables)
+            add_logs(c, logids)
+            update_summaries(c)
             cur.execute("COMMIT;")
             logging.info("Committed %s imported log(s)...", count)
         purge_logs(c, mc)
         purge_players(c, mc)
+        update_cubes(c, mc)
 
     count = 0
     start = datetime.now()
-    wd.ready()
-    for logid in filter_logids(c, fetcher.get_ids(), update_only=update_only):
+    ids = IdCache()
+    codec = LogCodec() if compress else None
+
+    def maybe_commit():
+        nonlocal count, start
+
+        now = datetime.now()
+        if (now - start).total_seconds() > 60 or count > 500:
+            commit()
+            cur.execute("BEGIN;")
+            count = 0
+            # Committing may take a while, so start the timer when we can actually import stuff
+            start = datetime.now()
         wd.ping()
-        log = fetcher.get_data(logid)
+
+    wd.ready()
+    logids = filter_logids(c, fetcher.get_ids(), update_only=update_only)
+    if batch_size:
+        for logids in chunk(logids, batch_size):
+            wd.ping()
+            logs = fetcher.get_batch(list(logids))
+            if not logs:
+                continue
+
+            wd.ping()
+            with sentry_sdk.start_span(op='db.transaction',
+                                       description=f"import {len(logs)} logs"), \
+                 disable_tracing():
+                cur.execute("BEGIN;")
+                count += import_batch(c.cursor(), logs.items(), ids, codec)
+                cur.execute("COMMIT;")
+                ids.commit()
+            maybe_commit()
+        commit()
+        return
+
+    for logid, log in prefetch(fetcher, logids, jobs, wd.ping):
         if log is None:
             continue
 
@@ -913,10 +1446,11 @@ def import_logs(c, mc, fetcher, update_only):
             cur.execute("BEGIN;")
             cur.execute("SAVEPOINT import;")
             try:
-                import_log(c.cursor(), logid, log)
-            except (IndexError, KeyError, psycopg2.errors.NumericValueOutOfRange):
+                import_log(c.cursor(), logid, log, ids, codec)
+            except (*parse_errors, psycopg2.errors.NumericValueOutOfRange):
                 logging.exception("Could not parse log %s", logid)
                 cur.execute("ROLLBACK TO SAVEPOINT import;")
+                ids.rollback()
                 cur.execute("INSERT INTO to_delete VALUES (%s);", (logid,))
             except psycopg2.Error:
                 logging.error("Could not import log %s", logid)
@@ -924,14 +1458,7 @@ def import_logs(c, mc, fetcher, update_only):
             else:
                 count += 1
             cur.execute("COMMIT;")
-
-        now = datetime.now()
-        if (now - start).total_seconds() > 60 or count > 500:
-            commit()
-            cur.execute("BEGIN;")
-            count = 0
-            # Committing may take a while, so start the timer when we can actually import stuff
-            start = datetime.now()
-        wd.ping()
+            ids.commit()
+        maybe_commit()
 
     commit()
@@ -1,8 +1,8 @@
 # SPDX-License-Identifier: AGPL-3.0-only
 # Copyright (C) 2021 Sean Anderson <seanga2@gmail.com>
 
-import json
 import logging
+import threading
 import time
 
 import requests, requests.adapters
@@ -10,112 +10,206 @@ import psycopg2, psycopg2.extras
 import urllib3.util
 
 from ..cache import purge_players
+from ..util import chunk
+from .fetch import prefetch
 
 def get_steamids_full(c):
-    last_steamid = 0
-    cur = c.cursor()
-    while True:
+    # Refresh the players most likely to be looked at first
+    with c.cursor(name='players', withhold=True) as cur:
+        cur.itersize = 10000
         cur.execute("""SELECT
                            steamid64
                        FROM player
-                       WHERE steamid64 > %s
-                       ORDER BY steamid64 ASC
-                       LIMIT 100;""", (last_steamid,))
-        if not cur.rowcount:
-            break
-        steamids = cur.fetchall()
-        last_steamid = steamids[-1][0]
-        yield steamids
+                       ORDER BY last_active DESC NULLS LAST, steamid64;""")
+        for steamids in chunk(cur, 100):
+            yield [row[0] for row in steamids]
 
 def get_steamids_random(c):
     cur = c.cursor()
     while True:
         cur.execute("SELECT steamid64 FROM player TABLESAMPLE SYSTEM_ROWS(100);")
-        yield cur.fetchall()
+        yield [row[0] for row in cur]
 
 def create_players_parser(sub):
     players = sub.add_parser("players", help="Import players")
     players.set_defaults(importer=import_players)
     player_sub = players.add_subparsers()
-    full = player_sub.add_parser("full", help="Import all players in order")
+    full = player_sub.add_parser("full", help="Import all players, most recently active first")
     full.set_defaults(get_steamids=get_steamids_full)
     random = player_sub.add_parser("random", help="Import 100 random players each request")
     random.set_defaults(get_steamids=get_steamids_random)
     players.add_argument("-k", "--key", type=str, metavar="KEY", help="Steam API key")
-    players.add_argument("-w", "--wait", type=int, metavar="DELAY",
-                         help="Seconds to wait between API requests")
+    players.add_argument("-r", "--rate", type=float, metavar="RATE",
+                         help="Maximum API requests per second. Defaults to 10 for full imports "
+                              "and 1 for random imports")
+    players.add_argument("-j", "--jobs", type=int, default=4,
+                         help="Make up to JOBS API requests concurrently")
+    players.add_argument("-b", "--batch-size", type=int, default=5000, metavar="SIZE",
+                         help="Update players in batches of SIZE, defaults to 5000")
 
-retries = urllib3.util.Retry(backoff_factor=1, status_forcelist=(requests.codes.too_many,))
+class RateLimiter:
+    """An adaptive token bucket
 
-def import_players(args, c, mc):
-    if args.wait is None:
-        if args.get_steamids == get_steamids_full:
-            args.wait = 0
-        else:
-            args.wait = 1
+    Callers are spaced out so that no more than ``rate`` of them proceed each second. When the
+    server tells us to slow down, the rate is halved; after each success it creeps back up towards
+    ``max_rate``. This is thread-safe.
 
-    s = requests.session()
-    s.mount("https://", requests.adapters.HTTPAdapter(max_retries=retries))
-    cur = c.cursor()
-    successes = 0
-    for steamids in args.get_steamids(c):
+    :param float max_rate: The maximum rate, in calls per second
+    :param float min_rate: The minimum rate, in calls per second
+    :param float increase: How much to increase the rate by after each success, as a fraction of
+                           ``max_rate``
+    """
+
+    def __init__(self, max_rate, min_rate=0.01, increase=0.05):
+        self.max_rate = max_rate
+        self.min_rate = min(min_rate, max_rate)
+        self.increase = increase * max_rate
+        self.rate = max_rate
+        self.lock = threading.Lock()
+        self.next = time.monotonic()
+
+    def acquire(self):
+        """Wait until we may make another call"""
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next - now
+            self.next = max(self.next, now) + 1 / self.rate
+        if delay > 0:
+            time.sleep(delay)
+
+    def throttle(self):
+        """Slow down after being rate-limited"""
+        with self.lock:
+            self.rate = max(self.rate / 2, self.min_rate)
+            self.next = max(self.next, time.monotonic() + 1 / self.rate)
+
+    def succeed(self):
+        """Speed back up after a successful call"""
+        with self.lock:
+            self.rate = min(self.rate + self.increase, self.max_rate)
+
+retries = urllib3.util.Retry(backoff_factor=1)
+
+class PlayerFetcher:
+    """Fetch player summaries from the Steam API
+
+    :param str key: The Steam API key
+    :param RateLimiter limiter: The rate limiter shared by all requests
+    :param int tries: How many times to try each request before giving up
+    """
+
+    def __init__(self, key, limiter, tries=10):
+        self.key = key
+        self.limiter = limiter
+        self.tries = tries
+        # Sessions aren't thread-safe, so use one per thread
+        self.local = threading.local()
+
+    @property
+    def s(self):
         try:
-            url = "https://api.steampowered.com/ISteamUser/GetPlayerSummaries/v0002/"
-            params = {
-                'key': args.key,
-                'steamids': ','.join(str(row[0]) for row in steamids),
-            }
-            resp = s.get(url, params=params)
-            resp.raise_for_status()
-            player_info = resp.json()
-
-            cur.execute("BEGIN;")
-            psycopg2.extras.execute_values(cur, """CREATE TEMP TABLE player_update (
-                                                       steamid64,
-                                                       name,
-                                                       avatarhash
-                                                   ) ON COMMIT DROP
-                                                   AS VALUES %s;""",
-                                           player_info['response']['players'],
-                                           "(%(steamid)s, %(personaname)s, %(avatarhash)s)")
-            cur.execute("""INSERT INTO name (name)
-                           SELECT
-                               name
-                           FROM player_update
-                           ON CONFLICT DO NOTHING;""")
-            cur.execute("""WITH player AS (UPDATE player
-                               SET
-                                  nameid = (SELECT nameid
-                                      FROM name
-                                      WHERE name = player_update.name
-                                  ),
-                                  avatarhash = player_update.avatarhash
-                               FROM player_update
-                               WHERE player_update.steamid64::BIGINT = player.steamid64
-                               RETURNING player.steamid64
-                           ) INSERT INTO cache_purge_player (steamid64)
-                           SELECT steamid64
-                           FROM player;""")
-            cur.execute("COMMIT;")
-            # Technically we should purge logs as well, but I don't think it matters too much
-            purge_players(c, mc)
-            successes += 1
-            logging.info("ok")
+            return self.local.s
+        except AttributeError:
+            self.local.s = requests.session()
+            self.local.s.mount("https://", requests.adapters.HTTPAdapter(max_retries=retries))
+            return self.local.s
+
+    def get_data(self, steamids):
+        url = "https://api.steampowered.com/ISteamUser/GetPlayerSummaries/v0002/"
+        params = {
+            'key': self.key,
+            'steamids': ','.join(str(steamid) for steamid in steamids),
+        }
+
+        try:
+            for _ in range(self.tries):
+                self.limiter.acquire()
+                resp = self.s.get(url, params=params)
+                if resp.status_code == requests.codes.too_many:
+                    self.limiter.throttle()
+                    continue
+                resp.raise_for_status()
+                self.limiter.succeed()
+                return resp.json()['response']['players']
+            logging.warning("Being rate-limited (%s 429 responses!), rate=%.2f", self.tries,
+                            self.limiter.rate)
         except requests.exceptions.HTTPError as e:
             # Bail on client errors
             if e.response.status_code < 500:
                 raise
-            else:
-                # Otherwise just log and try again later
-                logging.exception("Could not fetch player info")
-        except requests.exceptions.RetryError:
-            logging.warning(f"Being rate-limited (Ten 429 responses!), {successes=}")
-            successes = 0
+            # Otherwise just log and try again later
+            logging.exception("Could not fetch player info")
         except OSError:
             logging.exception("Could not fetch player info")
         except (ValueError, KeyError):
             logging.exception("Could not parse player info")
-        except psycopg2.Error:
-            logging.exception("Could not import players")
 
-        time.sleep(args.wait)
+def update_players(c, mc, players):
+    """Update the names and avatars of some players
+
+    :param c: The database connection
+    :param mc: The memcached client
+    :param players: Player summaries from the Steam API
+    :type players: list of dict
+    """
+
+    if not players:
+        return
+
+    cur = c.cursor()
+    try:
+        cur.execute("BEGIN;")
+        psycopg2.extras.execute_values(cur, """CREATE TEMP TABLE player_update (
+                                                   steamid64,
+                                                   name,
+                                                   avatarhash
+                                               ) ON COMMIT DROP
+                                               AS VALUES %s;""",
+                                       players, "(%(steamid)s, %(personaname)s, %(avatarhash)s)",
+                                       page_size=len(players))
+        cur.execute("""INSERT INTO name (name)
+                       SELECT
+                           name
+                       FROM player_update
+                       ON CONFLICT DO NOTHING;""")
+        cur.execute("""WITH player AS (UPDATE player
+                           SET
+                              nameid = (SELECT nameid
+                                  FROM name
+                                  WHERE name = player_update.name
+                              ),
+                              avatarhash = player_update.avatarhash
+                           FROM player_update
+                           WHERE player_update.steamid64::BIGINT = player.steamid64
+                           RETURNING player.steamid64
+                       ) INSERT INTO cache_purge_player (steamid64)
+                       SELECT steamid64
+                       FROM player;""")
+        cur.execute("COMMIT;")
+    except psycopg2.Error:
+        logging.exception("Could not import players")
+        cur.execute("ROLLBACK;")
+        return
+
+    # Technically we should purge logs as well, but I don't think it matters too much
+    purge_players(c, mc)
+    logging.info("Updated %s player(s)", len(players))
+
+def import_players(args, c, mc):
+    if args.rate is None:
+        if args.get_steamids == get_steamids_full:
+            args.rate = 10
+        else:
+            args.rate = 1
+
+    fetcher = PlayerFetcher(args.key, RateLimiter(args.rate))
+    players = []
+    start = time.monotonic()
+    for steamids, info in prefetch(fetcher, args.get_steamids(c), args.jobs):
+        players.extend(info or ())
+        # Don't sit on updates for too long when importing random players
+        if len(players) >= args.batch_size or time.monotonic() - start > 60:
+            update_players(c, mc, players)
+            players = []
+            start = time.monotonic()
+    update_players(c, mc, players)
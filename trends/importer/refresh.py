@@ -4,25 +4,184 @@
 from datetime import datetime, timedelta
 import logging
 
+import pylibmc
+
+from ..sql import table_columns
+
+# Tables which are maintained incrementally, and the columns which identify each row. When
+# rebuilding a table, its rows are inserted in this order.
+cubes = {
+    'leaderboard_cube': ('mapid', 'classid', 'formatid', 'playerid', 'league', 'grouping'),
+    'medic_cube': ('mapid', 'formatid', 'playerid', 'league', 'grouping'),
+    'peer_stats': ('playerid', 'peerid', 'league', 'formatid', 'classid'),
+    'map_stats': ('playerid', 'mapid', 'league', 'formatid', 'classid'),
+    'player_summary': ('playerid', 'league', 'formatid', 'classid', 'duplicate'),
+    'player_alias': ('playerid', 'nameid'),
+}
+
+# How to combine the old and new values of a column when adding logs. Other columns are summed.
+merge = {
+    ('player_alias', 'last_seen'): "greatest({0}, {1})",
+}
+
 def create_refresh_parser(sub):
     link = sub.add_parser("refresh", help="Refresh materialized views")
     link.set_defaults(importer=refresh)
+    link.add_argument("-f", "--full", action='store_true',
+                      help="Rebuild the leaderboards from scratch, instead of only recalculating "
+                           "players whose logs have changed")
 
-def refresh(args, c, mc):
+def purge_views(mc, views):
+    for view in views:
+        for _ in range(10):
+            try:
+                mc.delete(f"view_{view}")
+                break
+            except pylibmc.Error:
+                pass
+
+def lock_cubes(cur):
+    # Don't use the cubes' own locks, since view_updated would report them as unavailable
+    cur.execute("SELECT pg_advisory_xact_lock('cube_dirty'::REGCLASS::BIGINT);")
+
+def touch_cubes(cur):
+    cur.execute("""UPDATE materialized_view
+                   SET last_updated = now()
+                   WHERE oid = ANY(%s::REGCLASS[]);""", (list(cubes),))
+
+def add_logs(c, logids):
+    """Add new logs to the cubes
+
+    This should be called in the same transaction which adds the logs. Logs which were already
+    added must not be added again; mark their players in ``cube_dirty`` instead.
+
+    :param c: The database connection
+    :param logids: The logs to add
+    :type logids: list of int
+    """
+
+    if not logids:
+        return
+
+    cur = c.cursor()
+    lock_cubes(cur)
+    for cube, key in cubes.items():
+        def combine(col):
+            expr = merge.get((cube, col), "coalesce({0} + {1}, {0}, {1})")
+            return expr.format(f"{cube}.{col}", f"EXCLUDED.{col}")
+
+        set_clause = ", ".join(f"{col} = {combine(col)}"
+                               for col in table_columns(c, cube) if col not in key)
+        cur.execute(f"""INSERT INTO {cube}
+                        SELECT *
+                        FROM {cube}_rows(%s)
+                        ON CONFLICT ({", ".join(key)}) DO UPDATE
+                        SET {set_clause};""", (logids,))
+    touch_cubes(cur)
+
+def recalculate_cubes(cur, playerids, names=cubes):
+    for cube in names:
+        cur.execute(f"DELETE FROM {cube} WHERE playerid = ANY(%s);", (playerids,))
+        cur.execute(f"INSERT INTO {cube} SELECT * FROM {cube}_rows(playerids => %s);",
+                    (playerids,))
+
+def update_summaries(c):
+    """Recalculate ``player_summary`` for the players in ``cube_dirty``
+
+    The player overviews are purged as soon as their logs are committed, so ``player_summary``
+    can't wait for :py:func:`update_cubes`. This should be called in the same transaction which
+    marks the players (after :py:func:`add_logs`). The players are left in ``cube_dirty`` so the
+    rest of the cubes are updated later.
+
+    :param c: The database connection
+    """
+
+    cur = c.cursor()
+    lock_cubes(cur)
+    cur.execute("SELECT array_agg(playerid) FROM cube_dirty;")
+    if playerids := cur.fetchone()[0]:
+        recalculate_cubes(cur, playerids, ('player_summary',))
+
+def update_cubes(c, mc, batch_size=1000):
+    """Recalculate the cubes for the players in ``cube_dirty``
+
+    :param c: The database connection
+    :param mc: The memcached client
+    :param int batch_size: The number of players to recalculate in each transaction
+    """
+
+    updated = 0
     with c.cursor() as cur:
-        for view in ('leaderboard_cube', 'medic_cube', 'map_popularity'):
-            logging.info(f"REFRESH {view}")
+        while True:
             cur.execute("BEGIN;")
-            cur.execute("SELECT pg_advisory_xact_lock(%s::REGCLASS::BIGINT);", (view,))
-            cur.execute(
-                f"""UPDATE materialized_view
-                    SET last_updated = now()
-                    WHERE oid = %s::REGCLASS;""", (view,))
-            cur.execute(f"REFRESH MATERIALIZED VIEW {view}")
+            lock_cubes(cur)
+            cur.execute("""DELETE FROM cube_dirty
+                           WHERE playerid IN (SELECT
+                                   playerid
+                               FROM cube_dirty
+                               LIMIT %s
+                           ) RETURNING playerid;""", (batch_size,))
+            playerids = [row[0] for row in cur]
+            if not playerids:
+                cur.execute("COMMIT;")
+                break
+
+            recalculate_cubes(cur, playerids)
+            touch_cubes(cur)
             cur.execute("COMMIT;")
-            for _ in range(10):
-                try:
-                    mc.delete(f"view_{view}")
-                    break
-                except pylibmc.Error:
-                    pass
+            updated += len(playerids)
+
+    if updated:
+        logging.info("Recalculated cubes for %s player(s)", updated)
+    purge_views(mc, cubes)
+
+def rebuild_cubes(c, mc):
+    """Rebuild the cubes from scratch
+
+    The old contents of the cubes remain visible until the new ones are committed.
+
+    :param c: The database connection
+    :param mc: The memcached client
+    """
+
+    with c.cursor() as cur:
+        cur.execute("BEGIN;")
+        lock_cubes(cur)
+        cur.execute("DELETE FROM cube_dirty;")
+        for cube, order in cubes.items():
+            logging.info(f"REBUILD {cube}")
+            cur.execute(f"DELETE FROM {cube};")
+            cur.execute(f"""INSERT INTO {cube}
+                            SELECT *
+                            FROM {cube}_rows()
+                            ORDER BY {", ".join(order)};""")
+        touch_cubes(cur)
+        cur.execute("COMMIT;")
+    purge_views(mc, cubes)
+
+def refresh(args, c, mc):
+    if args and args.full:
+        rebuild_cubes(c, mc)
+    else:
+        update_cubes(c, mc)
+
+    view = 'map_popularity'
+    with c.cursor() as cur:
+        cur.execute("BEGIN;")
+        cur.execute("SELECT relispopulated FROM pg_class WHERE oid = %s::REGCLASS;", (view,))
+        if cur.fetchone()[0]:
+            # The old contents remain visible until we commit, so there's no need to lock out
+            # readers.
+            concurrently = "CONCURRENTLY"
+        else:
+            # There are no old contents to show, so have view_updated turn readers away
+            cur.execute("SELECT pg_advisory_xact_lock(%s::REGCLASS::BIGINT);", (view,))
+            concurrently = ""
+        logging.info(f"REFRESH {view} {concurrently}")
+        cur.execute(
+            f"""UPDATE materialized_view
+                SET last_updated = now()
+                WHERE oid = %s::REGCLASS;""", (view,))
+        cur.execute(f"REFRESH MATERIALIZED VIEW {concurrently} {view}")
+        cur.execute("COMMIT;")
+    purge_views(mc, (view,))
@@ -12,7 +12,7 @@ import time
 from psycopg2.extras import NumericRange
 import sentry_sdk
 
-from ..cache import purge_comps, purge_matches, purge_players, purge_teams
+from ..cache import Purger, purge_comps, purge_matches, purge_players, purge_teams
 from .fetch import FetchError, RGLBulkFetcher, RGLFileFetcher, RGLListFetcher
 from .league import *
 from ..sql import db_connect
@@ -187,78 +187,79 @@ def import_rgl(c, mc, fetcher, filter=filter_matchids):
 
     cur = c.cursor()
     count = 0
-    for matchid in filter(c, fetcher.get_matchids()):
-        try:
-            result = fetcher.get_match(matchid)
-            res = parse_match(result)
-            if res['teams'][0]['score'] is None and res['teams'][1]['score'] is None:
-                continue
+    with Purger(c, mc) as purger:
+        for matchid in filter(c, fetcher.get_matchids()):
+            try:
+                result = fetcher.get_match(matchid)
+                res = parse_match(result)
+                if res['teams'][0]['score'] is None and res['teams'][1]['score'] is None:
+                    continue
 
-            if res['divid'] == 558:
-                logging.info("Skipping inter-division match")
-                continue
+                if res['divid'] == 558:
+                    logging.info("Skipping inter-division match")
+                    continue
 
-            cur.execute("""SELECT 1
-                           FROM division
-                           WHERE league = 'rgl'
-                               AND compid = %(compid)s
-                               AND divid = %(divid)s""", res)
-            for _ in cur:
-                season = None
-                break
-            else:
-                season = get_season(res['compid'])
-                res['format'] = season['format']
-                res['tier'] = season['div_tiers'][res['divid']]
+                cur.execute("""SELECT 1
+                               FROM division
+                               WHERE league = 'rgl'
+                                   AND compid = %(compid)s
+                                   AND divid = %(divid)s""", res)
+                for _ in cur:
+                    season = None
+                    break
+                else:
+                    season = get_season(res['compid'])
+                    res['format'] = season['format']
+                    res['tier'] = season['div_tiers'][res['divid']]
 
-            for team in res['teams']:
-                cur.execute(
-                    """SELECT teamid, coalesce(fetched, 0)
-                       FROM team_comp_backing
-                       WHERE rgl_teamid = %(rgl_teamid)s
-                       UNION ALL
-                       SELECT NULL::INT, 0;""", team)
-                row = cur.fetchone()
+                for team in res['teams']:
+                    cur.execute(
+                        """SELECT teamid, coalesce(fetched, 0)
+                           FROM team_comp_backing
+                           WHERE rgl_teamid = %(rgl_teamid)s
+                           UNION ALL
+                           SELECT NULL::INT, 0;""", team)
+                    row = cur.fetchone()
 
-                if row[0] is None or row[1] <= (res['scheduled'] or 0) + 12 * 60 * 60:
-                    team |= parse_team(fetcher.get_team(team['rgl_teamid']))
-                    # FIXME broken divs!
-                    if team['divid'] != res['divid']:
-                        logging.info("Bad team division %s for team %s; should be %s",
-                                     team['divid'], team['rgl_teamid'], res['divid'])
-                    team['divid'] = res['divid']
-                else:
-                    team['teamid'] = row[0]
+                    if row[0] is None or row[1] <= (res['scheduled'] or 0) + 12 * 60 * 60:
+                        team |= parse_team(fetcher.get_team(team['rgl_teamid']))
+                        # FIXME broken divs!
+                        if team['divid'] != res['divid']:
+                            logging.info("Bad team division %s for team %s; should be %s",
+                                         team['divid'], team['rgl_teamid'], res['divid'])
+                        team['divid'] = res['divid']
+                    else:
+                        team['teamid'] = row[0]
 
-            with sentry_sdk.start_span(op='db.transaction', description=f"import {matchid}"):
-                cur.execute("BEGIN;")
-                if season:
-                    import_compdiv(cur, res)
+                with sentry_sdk.start_span(op='db.transaction', description=f"import {matchid}"):
+                    cur.execute("BEGIN;")
+                    if season:
+                        import_compdiv(cur, res)
 
-                for team in res['teams']:
-                    if 'league' in team:
-                        import_team(cur, team)
+                    for team in res['teams']:
+                        if 'league' in team:
+                            import_team(cur, team)
 
-                if res['teams'][0]['teamid'] > res['teams'][1]['teamid']:
-                    res['teams'] = (res['teams'][1], res['teams'][0])
-                res['teamid1'] = res['teams'][0]['teamid']
-                res['teamid2'] = res['teams'][1]['teamid']
-                res['score1'] = res['teams'][0]['score']
-                res['score2'] = res['teams'][1]['score']
-                import_match(cur, res)
-                purge_comps(c, mc, 'rgl')
-                purge_teams(c, mc, 'rgl')
-                purge_matches(c, mc, 'rgl')
-                purge_players(c, mc)
-                cur.execute("COMMIT;")
-        except FetchError:
-            continue
-        except (IndexError, KeyError, psycopg2.errors.UniqueViolation):
-            logging.exception("Could not parse match %s", matchid)
-            cur.execute("ROLLBACK;")
-        except psycopg2.Error:
-            logging.error("Could not import match %s", matchid)
-            raise
-        else:
-            count += 1
+                    if res['teams'][0]['teamid'] > res['teams'][1]['teamid']:
+                        res['teams'] = (res['teams'][1], res['teams'][0])
+                    res['teamid1'] = res['teams'][0]['teamid']
+                    res['teamid2'] = res['teams'][1]['teamid']
+                    res['score1'] = res['teams'][0]['score']
+                    res['score2'] = res['teams'][1]['score']
+                    import_match(cur, res)
+                    cur.execute("COMMIT;")
+                purger.add(purge_comps, 'rgl')
+                purger.add(purge_teams, 'rgl')
+                purger.add(purge_matches, 'rgl')
+                purger.add(purge_players)
+            except FetchError:
+                continue
+            except (IndexError, KeyError, psycopg2.errors.UniqueViolation):
+                logging.exception("Could not parse match %s", matchid)
+                cur.execute("ROLLBACK;")
+            except psycopg2.Error:
+                logging.error("Could not import match %s", matchid)
+                raise
+            else:
+                count += 1
     logging.info("Imported %s matches", count)
@@ -0,0 +1,34 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+# Copyright (C) 2025 Sean Anderson <seanga2@gmail.com>
+
+import logging
+import sys
+
+from ..cache import mc_connect
+from ..sql import db_connect, db_schema
+from ..importer.cli import init_logging
+from ..importer.refresh import rebuild_cubes
+
+views = ('leaderboard_cube', 'medic_cube')
+
+def migrate():
+    init_logging(logging.DEBUG)
+    mc = mc_connect(sys.argv[2])
+    with db_connect(sys.argv[1]) as c:
+        logging.info("BEGIN")
+        cur = c.cursor()
+        cur.execute("BEGIN;")
+        cur.execute("DELETE FROM materialized_view WHERE oid = ANY(%s::REGCLASS[]);",
+                    (list(views),))
+        for cube in views:
+            cur.execute(f"DROP MATERIALIZED VIEW {cube};")
+        cur.execute("COMMIT;")
+        logging.info("DROP MATERIALIZED VIEW")
+
+        db_schema(cur)
+        logging.info("CREATE TABLE")
+
+        rebuild_cubes(c, mc)
+
+if __name__ == "__main__":
+    migrate()
@@ -0,0 +1,35 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+# Copyright (C) 2025 Sean Anderson <seanga2@gmail.com>
+
+import logging
+import sys
+
+from ..sql import db_connect, db_schema
+from ..importer.cli import init_logging
+from ..importer.compress import compress
+
+def migrate():
+    init_logging(logging.DEBUG)
+    with db_connect(sys.argv[1]) as c:
+        logging.info("BEGIN")
+        cur = c.cursor()
+        cur.execute("BEGIN;")
+        db_schema(cur)
+        logging.info("CREATE TABLE log_json_dict")
+        # Drop the constraints first so this can be rerun if compress fails
+        cur.execute("""ALTER TABLE log_json
+                       ALTER data DROP NOT NULL,
+                       ADD COLUMN IF NOT EXISTS zdata BYTEA,
+                       ADD COLUMN IF NOT EXISTS dictid INT REFERENCES log_json_dict (dictid),
+                       DROP CONSTRAINT IF EXISTS compressed,
+                       DROP CONSTRAINT IF EXISTS dictionary,
+                       ADD CONSTRAINT compressed CHECK ((data ISNULL) <> (zdata ISNULL)),
+                       ADD CONSTRAINT dictionary CHECK (dictid ISNULL OR zdata NOTNULL);""")
+        logging.info("ALTER TABLE log_json")
+        cur.execute("COMMIT;")
+        logging.info("COMMIT")
+
+        compress(None, c, None)
+
+if __name__ == "__main__":
+    migrate()
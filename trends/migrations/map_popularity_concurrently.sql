@@ -0,0 +1 @@
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS map_popularity_pkey ON map_popularity (mapid);
@@ -0,0 +1,13 @@
+-- Run after schema.sql, which creates map_stats and map_stats_rows
+BEGIN;
+ALTER TABLE map ADD COLUMN IF NOT EXISTS
+	parts TEXT[] GENERATED ALWAYS AS (map_parts(map)) STORED;
+-- Keep add_logs from merging into map_stats until it is filled
+SELECT pg_advisory_xact_lock('cube_dirty'::REGCLASS::BIGINT);
+DELETE FROM map_stats;
+INSERT INTO map_stats
+SELECT *
+FROM map_stats_rows()
+ORDER BY playerid, mapid, league, formatid, classid;
+COMMIT;
+ANALYZE VERBOSE map_stats;
@@ -0,0 +1,5 @@
+CREATE INDEX CONCURRENTLY name_tgrm2 ON name USING GIST (name gist_trgm_ops);
+BEGIN;
+DROP INDEX name_tgrm;
+ALTER INDEX name_tgrm2 RENAME TO name_tgrm;
+COMMIT;
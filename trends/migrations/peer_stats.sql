@@ -0,0 +1,11 @@
+-- Run after schema.sql, which creates peer_stats and peer_stats_rows
+BEGIN;
+-- Keep add_logs from merging into peer_stats until it is filled
+SELECT pg_advisory_xact_lock('cube_dirty'::REGCLASS::BIGINT);
+DELETE FROM peer_stats;
+INSERT INTO peer_stats
+SELECT *
+FROM peer_stats_rows()
+ORDER BY playerid, peerid, league, formatid, classid;
+COMMIT;
+ANALYZE VERBOSE peer_stats;
@@ -0,0 +1,11 @@
+-- Run after schema.sql, which creates player_alias and player_alias_rows
+BEGIN;
+-- Keep add_logs from merging into player_alias until it is filled
+SELECT pg_advisory_xact_lock('cube_dirty'::REGCLASS::BIGINT);
+DELETE FROM player_alias;
+INSERT INTO player_alias
+SELECT *
+FROM player_alias_rows()
+ORDER BY playerid, nameid;
+COMMIT;
+ANALYZE VERBOSE player_alias;
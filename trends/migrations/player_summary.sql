@@ -0,0 +1,11 @@
+-- Run after schema.sql, which creates player_summary and player_summary_rows
+BEGIN;
+-- Keep add_logs from merging into player_summary until it is filled
+SELECT pg_advisory_xact_lock('cube_dirty'::REGCLASS::BIGINT);
+DELETE FROM player_summary;
+INSERT INTO player_summary
+SELECT *
+FROM player_summary_rows()
+ORDER BY playerid, league, formatid, classid, duplicate;
+COMMIT;
+ANALYZE VERBOSE player_summary;
@@ -0,0 +1,3 @@
+CREATE INDEX CONCURRENTLY IF NOT EXISTS round_time ON round (time, duration) INCLUDE (logid);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS round_stats
+	ON round (duration, red_dmg, blue_dmg, red_kills, blue_kills) INCLUDE (logid);
@@ -56,7 +56,8 @@ CREATE TABLE IF NOT EXISTS name (
 	name TEXT NOT NULL UNIQUE
 );
 
-CREATE INDEX IF NOT EXISTS name_tgrm ON name USING GIN (name gin_trgm_ops);
+-- GiST so that player searches can find the closest names first
+CREATE INDEX IF NOT EXISTS name_tgrm ON name USING GIST (name gist_trgm_ops);
 
 CREATE TABLE IF NOT EXISTS player (
 	playerid SERIAL PRIMARY KEY,
@@ -97,9 +98,17 @@ ALTER TYPE TEAM ADD VALUE IF NOT EXISTS 'Red';
 ALTER TYPE TEAM ADD VALUE IF NOT EXISTS 'Blue';
 COMMIT;
 
+-- Split a map name into alphanumeric parts, for grouping maps by prefix
+CREATE OR REPLACE FUNCTION map_parts(TEXT) RETURNS TEXT[]
+	AS 'SELECT array_agg(part)
+	    FROM unnest(regexp_split_to_array(lower($1), ''[^a-z0-9]+'')) AS part
+	    WHERE part != '''''
+	LANGUAGE SQL IMMUTABLE STRICT PARALLEL SAFE;
+
 CREATE TABLE IF NOT EXISTS map (
 	mapid SERIAL PRIMARY KEY,
-	map TEXT NOT NULL UNIQUE
+	map TEXT NOT NULL UNIQUE,
+	parts TEXT[] GENERATED ALWAYS AS (map_parts(map)) STORED
 );
 
 CREATE INDEX IF NOT EXISTS map_names ON map USING gin (map gin_trgm_ops);
@@ -497,10 +506,25 @@ JOIN (SELECT
 ORDER BY popularity DESC, mapid ASC
 WITH NO DATA;
 
--- The original json, zstd compressed
+-- For REFRESH MATERIALIZED VIEW CONCURRENTLY
+CREATE UNIQUE INDEX IF NOT EXISTS map_popularity_pkey ON map_popularity (mapid);
+
+-- Trained zstd dictionaries for log_json. Each dictionary is trained on the partition starting
+-- at lower, and is used for every log from there until the next dictionary.
+CREATE TABLE IF NOT EXISTS log_json_dict (
+	dictid SERIAL PRIMARY KEY,
+	lower INT NOT NULL UNIQUE,
+	data BYTEA NOT NULL
+);
+
+-- The original json, either as-is or zstd compressed (with a dictionary, if dictid is set)
 CREATE TABLE IF NOT EXISTS log_json (
 	logid INTEGER PRIMARY KEY REFERENCES log (logid),
-	data JSON NOT NULL
+	data JSON,
+	zdata BYTEA,
+	dictid INT REFERENCES log_json_dict (dictid),
+	CONSTRAINT compressed CHECK ((data ISNULL) <> (zdata ISNULL)),
+	CONSTRAINT dictionary CHECK (dictid ISNULL OR zdata NOTNULL)
 ) PARTITION BY RANGE (logid);
 
 CREATE TABLE IF NOT EXISTS log_json_default
@@ -526,6 +550,11 @@ CREATE TABLE IF NOT EXISTS round (
 	PRIMARY KEY (logid, seq)
 );
 
+-- For finding duplicate logs (see delete_dup_logs)
+CREATE INDEX IF NOT EXISTS round_time ON round (time, duration) INCLUDE (logid);
+CREATE INDEX IF NOT EXISTS round_stats ON round (duration, red_dmg, blue_dmg, red_kills, blue_kills)
+	INCLUDE (logid);
+
 CREATE TABLE IF NOT EXISTS class (
 	classid SERIAL PRIMARY KEY,
 	class TEXT NOT NULL UNIQUE
@@ -694,7 +723,34 @@ CREATE STATISTICS IF NOT EXISTS class_stats (ndistinct)
 ON logid, playerid
 FROM class_stats;
 
-CREATE MATERIALIZED VIEW IF NOT EXISTS leaderboard_cube AS SELECT
+-- Maintained incrementally by the importer (see trends/importer/refresh.py)
+CREATE TABLE IF NOT EXISTS leaderboard_cube (
+	playerid INT NOT NULL,
+	league LEAGUE,
+	formatid INT,
+	classid INT,
+	mapid INT,
+	grouping INT NOT NULL,
+	duration BIGINT,
+	wins BIGINT,
+	ties BIGINT,
+	losses BIGINT,
+	kills BIGINT,
+	deaths BIGINT,
+	assists BIGINT,
+	dmg BIGINT,
+	dt BIGINT,
+	shots BIGINT,
+	hits BIGINT
+);
+
+-- The rows of leaderboard_cube, optionally limited to some logs or players. The contents of
+-- leaderboard_cube are the sum of this function over any partition of the logs. Like a view, the
+-- body is bound when it is created, so the importer's temporary tables do not shadow it.
+CREATE OR REPLACE FUNCTION leaderboard_cube_rows(logids INT[] = NULL, playerids INT[] = NULL)
+RETURNS SETOF leaderboard_cube LANGUAGE SQL STABLE
+BEGIN ATOMIC
+SELECT
 	playerid,
 	league,
 	formatid,
@@ -714,9 +770,14 @@ CREATE MATERIALIZED VIEW IF NOT EXISTS leaderboard_cube AS SELECT
 	sum(hits) AS hits
 FROM log_nodups AS log
 JOIN player_stats USING (logid)
-GROUP BY playerid, CUBE (league, formatid, classid, mapid)
-ORDER BY mapid, classid, formatid, playerid, league
-WITH NO DATA;
+WHERE (logids ISNULL OR logid = ANY(logids))
+	AND (playerids ISNULL OR playerid = ANY(playerids))
+GROUP BY playerid, CUBE (league, formatid, classid, mapid);
+END;
+
+-- For adding new logs
+CREATE UNIQUE INDEX IF NOT EXISTS leaderboard_pkey
+	ON leaderboard_cube (playerid, league, formatid, classid, mapid, grouping) NULLS NOT DISTINCT;
 
 -- To help out the query planner
 CREATE STATISTICS IF NOT EXISTS leaderboard_stats (dependencies, ndistinct, mcv)
@@ -757,7 +818,46 @@ CREATE INDEX IF NOT EXISTS leaderboard_bloom ON leaderboard_cube
 	USING bloom (grouping, mapid, classid, formatid, league)
 	WITH (col1=1, col2=1, col3=1, col4=1, col5=1);
 
-CREATE MATERIALIZED VIEW IF NOT EXISTS medic_cube AS SELECT
+CREATE TABLE IF NOT EXISTS medic_cube (
+	playerid INT NOT NULL,
+	league LEAGUE,
+	formatid INT,
+	mapid INT,
+	grouping INT NOT NULL,
+	logs BIGINT,
+	duration BIGINT,
+	ubers BIGINT,
+	medigun_ubers BIGINT,
+	kritz_ubers BIGINT,
+	other_ubers BIGINT,
+	drops BIGINT,
+	advantages_lost BIGINT,
+	time_before_using DOUBLE PRECISION,
+	ubers_before_using BIGINT,
+	time_to_build DOUBLE PRECISION,
+	builds BIGINT,
+	uber_duration DOUBLE PRECISION,
+	ubers_duration BIGINT,
+	healing_duration BIGINT,
+	healing NUMERIC,
+	healing_scout NUMERIC,
+	healing_soldier NUMERIC,
+	healing_pyro NUMERIC,
+	healing_demoman NUMERIC,
+	healing_engineer NUMERIC,
+	healing_heavyweapons NUMERIC,
+	healing_medic NUMERIC,
+	healing_sniper NUMERIC,
+	healing_spy NUMERIC,
+	healing_enemy NUMERIC,
+	healing_other NUMERIC
+);
+
+-- Like leaderboard_cube_rows
+CREATE OR REPLACE FUNCTION medic_cube_rows(logids INT[] = NULL, playerids INT[] = NULL)
+RETURNS SETOF medic_cube LANGUAGE SQL STABLE
+BEGIN ATOMIC
+SELECT
 	playerid,
 	league,
 	formatid,
@@ -815,11 +915,17 @@ LEFT JOIN (SELECT
 	LEFT JOIN class ON (classid=healee_stats.primary_classid)
 	WHERE healer_stats.playerid = healer
 		AND healee_stats.playerid = healee
+		AND (logids ISNULL OR logid = ANY(logids))
+		AND (playerids ISNULL OR healer = ANY(playerids))
 	GROUP BY logid, healer
 ) AS heal_stats USING (logid, playerid)
-GROUP BY playerid, CUBE (league, formatid, mapid)
-ORDER BY mapid, formatid, playerid, league
-WITH NO DATA;
+WHERE (logids ISNULL OR logid = ANY(logids))
+	AND (playerids ISNULL OR playerid = ANY(playerids))
+GROUP BY playerid, CUBE (league, formatid, mapid);
+END;
+
+CREATE UNIQUE INDEX IF NOT EXISTS medic_pkey
+	ON medic_cube (playerid, league, formatid, mapid, grouping) NULLS NOT DISTINCT;
 
 -- To help out the query planner
 CREATE STATISTICS IF NOT EXISTS medic_cube_stats (dependencies, ndistinct, mcv)
@@ -851,6 +957,255 @@ CREATE INDEX IF NOT EXISTS medic_bloom ON medic_cube
 	USING bloom (grouping, mapid, formatid, league)
 	WITH (col1=1, col2=1, col3=1, col5=1);
 
+-- Totals for each pair of players who have played in the same log, for the peers page. Unlike the
+-- cubes, we only split these up by the filters which don't depend on the individual logs.
+CREATE TABLE IF NOT EXISTS peer_stats (
+	playerid INT NOT NULL,
+	peerid INT NOT NULL,
+	league LEAGUE,
+	formatid INT,
+	classid INT, -- playerid's primary class
+	logs BIGINT NOT NULL,
+	logs_with BIGINT NOT NULL,
+	logs_against BIGINT NOT NULL,
+	wins_with BIGINT,
+	ties_with BIGINT,
+	wins_against BIGINT,
+	ties_against BIGINT,
+	duration_with BIGINT,
+	duration_against BIGINT,
+	dmg_with BIGINT,
+	dt_with BIGINT,
+	healing_to BIGINT,
+	healing_from BIGINT
+);
+
+-- Like leaderboard_cube_rows
+CREATE OR REPLACE FUNCTION peer_stats_rows(logids INT[] = NULL, playerids INT[] = NULL)
+RETURNS SETOF peer_stats LANGUAGE SQL STABLE
+BEGIN ATOMIC
+SELECT
+	p1.playerid,
+	p2.playerid AS peerid,
+	log.league,
+	log.formatid,
+	p1.primary_classid AS classid,
+	count(*) AS logs,
+	sum((p1.team = p2.team)::INT) AS logs_with,
+	sum((p1.team != p2.team)::INT) AS logs_against,
+	sum(CASE WHEN p1.team = p2.team THEN (p1.wins > p1.losses)::INT END) AS wins_with,
+	sum(CASE WHEN p1.team = p2.team THEN (p1.wins = p1.losses)::INT END) AS ties_with,
+	sum(CASE WHEN p1.team != p2.team THEN (p1.wins > p1.losses)::INT END) AS wins_against,
+	sum(CASE WHEN p1.team != p2.team THEN (p1.wins = p1.losses)::INT END) AS ties_against,
+	sum(CASE WHEN p1.team = p2.team THEN nullif(log.duration, 0) END) AS duration_with,
+	sum(CASE WHEN p1.team != p2.team THEN nullif(log.duration, 0) END) AS duration_against,
+	sum(CASE WHEN p1.team = p2.team THEN p1.dmg END) AS dmg_with,
+	sum(CASE WHEN p1.team = p2.team THEN p1.dt END) AS dt_with,
+	sum(CASE WHEN p1.team = p2.team THEN hs1.healing END) AS healing_to,
+	sum(CASE WHEN p1.team = p2.team THEN hs2.healing END) AS healing_from
+FROM log_nodups AS log
+JOIN player_stats AS p1 USING (logid)
+JOIN player_stats AS p2 USING (logid)
+LEFT JOIN heal_stats AS hs1 ON (
+	hs1.healer = p1.playerid
+	AND hs1.healee = p2.playerid
+	AND hs1.logid = log.logid
+) LEFT JOIN heal_stats AS hs2 ON (
+	hs2.healer = p2.playerid
+	AND hs2.healee = p1.playerid
+	AND hs2.logid = log.logid
+) WHERE p2.playerid != p1.playerid
+	AND (logids ISNULL OR log.logid = ANY(logids))
+	AND (playerids ISNULL OR p1.playerid = ANY(playerids))
+GROUP BY p1.playerid, p2.playerid, log.league, log.formatid, p1.primary_classid;
+END;
+
+CREATE UNIQUE INDEX IF NOT EXISTS peer_stats_pkey
+	ON peer_stats (playerid, peerid, league, formatid, classid) NULLS NOT DISTINCT;
+
+-- Per-map totals for each player, for the maps page. Like peer_stats, these are only split up by
+-- the filters which don't depend on the individual logs.
+CREATE TABLE IF NOT EXISTS map_stats (
+	playerid INT NOT NULL,
+	mapid INT NOT NULL,
+	league LEAGUE,
+	formatid INT,
+	classid INT, -- primary class
+	logs BIGINT NOT NULL,
+	round_wins BIGINT NOT NULL,
+	round_losses BIGINT NOT NULL,
+	round_ties BIGINT NOT NULL,
+	wins BIGINT NOT NULL,
+	losses BIGINT NOT NULL,
+	ties BIGINT NOT NULL,
+	duration BIGINT NOT NULL,
+	kills BIGINT NOT NULL,
+	deaths BIGINT NOT NULL,
+	assists BIGINT NOT NULL,
+	dmg BIGINT NOT NULL,
+	dt BIGINT,
+	hits BIGINT,
+	shots BIGINT
+);
+
+-- Like leaderboard_cube_rows
+CREATE OR REPLACE FUNCTION map_stats_rows(logids INT[] = NULL, playerids INT[] = NULL)
+RETURNS SETOF map_stats LANGUAGE SQL STABLE
+BEGIN ATOMIC
+SELECT
+	playerid,
+	mapid,
+	league,
+	formatid,
+	primary_classid AS classid,
+	count(*) AS logs,
+	sum(wins) AS round_wins,
+	sum(losses) AS round_losses,
+	sum(ties) AS round_ties,
+	sum((wins > losses)::INT) AS wins,
+	sum((wins < losses)::INT) AS losses,
+	sum((wins = losses)::INT) AS ties,
+	sum(duration) AS duration,
+	sum(kills) AS kills,
+	sum(deaths) AS deaths,
+	sum(assists) AS assists,
+	sum(dmg) AS dmg,
+	sum(dt) AS dt,
+	sum(hits) AS hits,
+	sum(shots) AS shots
+FROM log_nodups AS log
+JOIN player_stats AS ps USING (logid)
+WHERE (logids ISNULL OR log.logid = ANY(logids))
+	AND (playerids ISNULL OR ps.playerid = ANY(playerids))
+GROUP BY playerid, mapid, league, formatid, primary_classid;
+END;
+
+CREATE UNIQUE INDEX IF NOT EXISTS map_stats_pkey
+	ON map_stats (playerid, mapid, league, formatid, classid) NULLS NOT DISTINCT;
+
+-- Totals for each player, for the overview and totals pages. Duplicate logs are only included in
+-- the overview.
+CREATE TABLE IF NOT EXISTS player_summary (
+	playerid INT NOT NULL,
+	league LEAGUE,
+	formatid INT,
+	classid INT, -- primary class
+	duplicate BOOL NOT NULL,
+	logs BIGINT NOT NULL,
+	round_wins BIGINT NOT NULL,
+	round_losses BIGINT NOT NULL,
+	round_ties BIGINT NOT NULL,
+	wins BIGINT NOT NULL,
+	losses BIGINT NOT NULL,
+	ties BIGINT NOT NULL,
+	duration BIGINT NOT NULL,
+	kills BIGINT NOT NULL,
+	deaths BIGINT NOT NULL,
+	assists BIGINT NOT NULL,
+	dmg BIGINT NOT NULL,
+	dt BIGINT,
+	hr BIGINT,
+	airshots BIGINT,
+	medkits BIGINT,
+	medkits_hp BIGINT,
+	backstabs BIGINT,
+	headshots BIGINT,
+	headshots_hit BIGINT,
+	sentries BIGINT,
+	cpc BIGINT,
+	ic BIGINT,
+	healing BIGINT,
+	ubers BIGINT,
+	drops BIGINT,
+	advantages_lost BIGINT,
+	deaths_after_uber BIGINT,
+	deaths_before_uber BIGINT
+);
+
+-- Like leaderboard_cube_rows
+CREATE OR REPLACE FUNCTION player_summary_rows(logids INT[] = NULL, playerids INT[] = NULL)
+RETURNS SETOF player_summary LANGUAGE SQL STABLE
+BEGIN ATOMIC
+SELECT
+	ps.playerid,
+	log.league,
+	log.formatid,
+	ps.primary_classid AS classid,
+	log.duplicate_of NOTNULL AS duplicate,
+	count(*) AS logs,
+	sum(ps.wins) AS round_wins,
+	sum(ps.losses) AS round_losses,
+	sum(ps.ties) AS round_ties,
+	sum((ps.wins > ps.losses)::INT) AS wins,
+	sum((ps.wins < ps.losses)::INT) AS losses,
+	sum((ps.wins = ps.losses)::INT) AS ties,
+	sum(log.duration) AS duration,
+	sum(ps.kills) AS kills,
+	sum(ps.deaths) AS deaths,
+	sum(ps.assists) AS assists,
+	sum(ps.dmg) AS dmg,
+	sum(ps.dt) AS dt,
+	sum(pse.hr) AS hr,
+	sum(pse.airshots) AS airshots,
+	sum(pse.medkits) AS medkits,
+	sum(pse.medkits_hp) AS medkits_hp,
+	sum(pse.backstabs) AS backstabs,
+	sum(pse.headshots) AS headshots,
+	sum(pse.headshots_hit) AS headshots_hit,
+	sum(pse.sentries) AS sentries,
+	sum(pse.cpc) AS cpc,
+	sum(pse.ic) AS ic,
+	sum(hs.healing) AS healing,
+	sum(ms.ubers) AS ubers,
+	sum(ms.drops) AS drops,
+	sum(ms.advantages_lost) AS advantages_lost,
+	sum(ms.deaths_after_uber) AS deaths_after_uber,
+	sum(ms.deaths_before_uber) AS deaths_before_uber
+FROM log
+JOIN player_stats AS ps USING (logid)
+LEFT JOIN player_stats_extra AS pse USING (logid, playerid)
+LEFT JOIN medic_stats AS ms USING (logid, playerid)
+LEFT JOIN LATERAL (SELECT
+		sum(healing) AS healing
+	FROM heal_stats
+	WHERE logid = log.logid
+		AND healer = ps.playerid
+) AS hs ON TRUE
+WHERE (logids ISNULL OR log.logid = ANY(logids))
+	AND (playerids ISNULL OR ps.playerid = ANY(playerids))
+GROUP BY ps.playerid, log.league, log.formatid, ps.primary_classid, log.duplicate_of NOTNULL;
+END;
+
+CREATE UNIQUE INDEX IF NOT EXISTS player_summary_pkey
+	ON player_summary (playerid, league, formatid, classid, duplicate) NULLS NOT DISTINCT;
+
+-- Each name a player has used, for searching. Names are matched using name_tgrm.
+CREATE TABLE IF NOT EXISTS player_alias (
+	playerid INT NOT NULL,
+	nameid INT NOT NULL,
+	logs BIGINT NOT NULL,
+	last_seen BIGINT NOT NULL
+);
+
+-- Like leaderboard_cube_rows
+CREATE OR REPLACE FUNCTION player_alias_rows(logids INT[] = NULL, playerids INT[] = NULL)
+RETURNS SETOF player_alias LANGUAGE SQL STABLE
+BEGIN ATOMIC
+SELECT
+	ps.playerid,
+	ps.nameid,
+	count(*) AS logs,
+	max(log.time) AS last_seen
+FROM log
+JOIN player_stats_backing AS ps USING (logid)
+WHERE (logids ISNULL OR log.logid = ANY(logids))
+	AND (playerids ISNULL OR ps.playerid = ANY(playerids))
+GROUP BY ps.playerid, ps.nameid;
+END;
+
+CREATE UNIQUE INDEX IF NOT EXISTS player_alias_pkey ON player_alias (playerid, nameid);
+CREATE INDEX IF NOT EXISTS player_alias_names ON player_alias (nameid) INCLUDE (playerid);
+
 DO $$ BEGIN
 	CREATE TYPE SLOT AS ENUM ();
 EXCEPTION WHEN duplicate_object THEN
@@ -953,6 +1308,11 @@ INSERT INTO materialized_view (oid) VALUES
 	('map_popularity'::REGCLASS)
 ON CONFLICT DO NOTHING;
 
+-- Players whose rows in leaderboard_cube and medic_cube need to be recalculated
+CREATE TABLE IF NOT EXISTS cube_dirty (
+	playerid INT PRIMARY KEY
+);
+
 CREATE TABLE IF NOT EXISTS cache_purge_player (
 	steamid64 BIGINT NOT NULL
 );
@@ -6,7 +6,7 @@ import werkzeug.exceptions
 
 from .. import cache
 from .common import get_logs, search_players, logs_last_modified
-from .util import get_db, get_mc, get_pagination, last_modified, view_updated
+from .util import get_db, get_mc, get_pagination, last_cursor, last_modified, view_updated
 from .root import get_log
 
 api = flask.Blueprint('api', __name__)
@@ -19,13 +19,17 @@ def json_handler(error):
         'description': error.description,
     }), error.code
 
-def next_page(rows):
+def next_page(count, last):
     args = flask.request.args.to_dict(flat=False)
     args.update(flask.request.view_args)
 
     limit, offset = flask.g.page
     args['limit'] = limit
-    if len(rows) == limit:
+    if cursor := last_cursor(count, last):
+        args.pop('offset', None)
+        args['cursor'] = cursor
+        return flask.url_for(flask.request.endpoint, **args)
+    if count == limit:
         args['offset'] = offset + limit
         return flask.url_for(flask.request.endpoint, **args)
 
@@ -49,8 +53,122 @@ def logs():
         return resp
 
     view = flask.request.args.get('view', 'basic', str)
-    logs = [dict(log) for log in get_logs(view)]
-    return flask.jsonify(logs=logs, next_page=next_page(logs))
+    logs = get_logs(view, max_limit=10000, stream=True)
+
+    # Encode the logs as they are fetched, so we don't have to hold the whole page in memory
+    def generate():
+        count = 0
+        last = None
+        yield '{"logs":['
+        while rows := logs.fetchmany(100):
+            if count:
+                yield ','
+            yield ','.join(flask.json.dumps(dict(row)) for row in rows)
+            count += len(rows)
+            last = rows[-1]
+        yield f'],"next_page":{flask.json.dumps(next_page(count, last))}}}'
+
+    return flask.Response(flask.stream_with_context(generate()), mimetype='application/json')
+
+def get_logs_bulk(logids):
+    """Get the summaries, rounds, and players of several logs
+
+    :param logids: The logs to get
+    :type logids: list of int
+    :return: The logs which exist, in the same order as ``logids``
+    :rtype: list of dict
+    """
+
+    params = { 'logids': logids }
+    cur = get_db().cursor()
+    cur.execute("""SELECT
+                       logid,
+                       time,
+                       updated,
+                       title,
+                       map,
+                       format,
+                       duration,
+                       red_score,
+                       blue_score,
+                       duplicate_of,
+                       demoid,
+                       league,
+                       matchid
+                   FROM log
+                   LEFT JOIN format USING (formatid)
+                   JOIN map USING (mapid)
+                   WHERE logid = ANY(%(logids)s);""", params)
+    logs = { row['logid']: { 'summary': dict(row), 'rounds': [], 'players': [] } for row in cur }
+
+    cur.execute("""SELECT
+                       logid,
+                       seq,
+                       duration,
+                       red_score,
+                       blue_score,
+                       red_kills,
+                       blue_kills,
+                       red_dmg,
+                       blue_dmg,
+                       red_dmg * 60.0 / nullif(duration, 0) AS red_dpm,
+                       blue_dmg * 60.0 / nullif(duration, 0) AS blue_dpm,
+                       red_ubers,
+                       blue_ubers
+                   FROM round
+                   WHERE logid = ANY(%(logids)s)
+                   ORDER BY logid, seq;""", params)
+    for round in cur:
+        logs[round['logid']]['rounds'].append(dict(round))
+
+    cur.execute("""SELECT
+                       logid,
+                       steamid64::TEXT,
+                       name,
+                       avatarhash,
+                       team,
+                       classes,
+                       kills,
+                       deaths,
+                       assists,
+                       dmg,
+                       dt,
+                       hsr AS healing,
+                       lks,
+                       airshots,
+                       medkits,
+                       medkits_hp,
+                       backstabs,
+                       headshots,
+                       headshots_hit,
+                       sentries,
+                       cpc,
+                       ic
+                   FROM player_stats AS ps
+                   LEFT JOIN player_stats_extra AS pse USING (logid, playerid)
+                   JOIN name USING (nameid)
+                   JOIN player USING (playerid)
+                   WHERE logid = ANY(%(logids)s)
+                   ORDER BY logid, team, steamid64;""", params)
+    for player in cur:
+        logs[player['logid']]['players'].append(dict(player))
+
+    return [logs[logid] for logid in logids if logid in logs]
+
+@api.route('/logs/bulk')
+def logs_bulk():
+    if resp := logs_last_modified():
+        return resp
+
+    if logids := flask.request.args.getlist('logid', type=int):
+        if len(logids) > 500:
+            flask.abort(400, "At most 500 logs may be requested at once")
+        return flask.jsonify(logs=get_logs_bulk(list(dict.fromkeys(logids))), next_page=None)
+
+    # Otherwise, select logs like the logs endpoint
+    logs = get_logs('basic', max_limit=500).fetchall()
+    return flask.jsonify(logs=get_logs_bulk([log['logid'] for log in logs]),
+                         next_page=next_page(len(logs), logs[-1] if logs else None))
 
 @api.route('/maps')
 def maps():
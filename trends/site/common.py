@@ -4,15 +4,15 @@
 import flask
 
 from .. import cache
-from .util import get_db, get_filter_params, get_filter_clauses, get_mc, get_order, \
-                  get_pagination, last_modified
+from .util import dir_map, get_db, get_filter_params, get_filter_clauses, get_keyset, get_mc, \
+                  get_order, get_pagination, last_modified
 
 def logs_last_modified():
     flask.g.max_age = 30
     return last_modified(None, cache.logs_version(get_mc()))
 
-def get_logs(view):
-    limit, offset = get_pagination()
+def get_logs(view, max_limit=None, stream=False):
+    limit, offset = get_pagination(max_limit=max_limit)
     filters = get_filter_params()
     filter_clauses = get_filter_clauses(filters, 'title', 'format', 'map', 'time', 'logid',
                                         'updated', 'duplicate_of', league='log.league')
@@ -23,6 +23,16 @@ def get_logs(view):
         'date': "time",
         'updated': "updated",
 	}, 'logid')
+    keyset_clause, keyset_params = get_keyset({
+        'logid': ("log.logid", 'logid'),
+        'duration': ("log.duration", 'duration'),
+        'date': ("log.time", 'time'),
+        'updated': ("log.updated", 'updated'),
+    }, key=("log.logid", 'logid'))
+    if keyset_clause:
+        offset = 0
+    if order['sort'] != 'logid':
+        order_clause += f", logid {dir_map[order['sort_dir']]}"
 
     if view == 'players':
         extra_cols = """,
@@ -72,7 +82,8 @@ def get_logs(view):
         extra_cols = ""
         extra_tables = ""
 
-    logs = get_db().cursor()
+    # A server-side cursor lets large pages be read in batches
+    logs = get_db().cursor('logs' if stream else None)
     logs.execute(f"""SELECT
                         logid,
                         time,
@@ -91,9 +102,10 @@ def get_logs(view):
                     {extra_tables}
                     WHERE TRUE
                         {filter_clauses}
+                        {keyset_clause}
                     ORDER BY {order_clause}
                     LIMIT %(limit)s OFFSET %(offset)s;""",
-                { **filters, 'limit': limit, 'offset': offset })
+                { **filters, **keyset_params, 'limit': limit, 'offset': offset })
     return logs
 
 def search_players(q):
@@ -110,25 +122,45 @@ def search_players(q):
                aliases
            FROM (SELECT
                    playerid,
-                   array_agg(DISTINCT name) AS aliases,
-                   max(rank) AS rank
+                   steamid64,
+                   name,
+                   avatarhash,
+                   rank,
+                   last_active
                FROM (SELECT
                        playerid,
-                       name,
-                       similarity(name, %(q)s) AS rank
-                   FROM name
-                   JOIN player_stats USING (nameid)
-                   WHERE name ILIKE %(q)s
-                   ORDER BY rank DESC
+                       max(similarity(name, %(q)s)) AS rank
+                   -- Only rank the players with the closest names, so short queries which
+                   -- match many names can stop early
+                   FROM (SELECT
+                           nameid,
+                           name
+                       FROM name
+                       WHERE name ILIKE %(q)s
+                       ORDER BY name <-> %(q)s
+                       LIMIT %(names)s
+                   ) AS name
+                   JOIN player_alias USING (nameid)
+                   GROUP BY playerid
                ) AS matches
-               GROUP BY playerid
+               JOIN player USING (playerid)
+               JOIN name USING (nameid)
+               WHERE last_active NOTNULL
+               ORDER BY rank DESC, last_active DESC
+               LIMIT %(limit)s OFFSET %(offset)s
            ) AS matches
-           JOIN player USING (playerid)
-           JOIN name USING (nameid)
-           WHERE last_active NOTNULL
-           ORDER BY rank DESC, last_active DESC
-           LIMIT %(limit)s OFFSET %(offset)s;""",
-        { 'q': "%{}%".format(q), 'limit': limit, 'offset': offset})
+           -- Only look up the aliases of the players we return
+           CROSS JOIN LATERAL (SELECT
+                   array_agg(name ORDER BY last_seen DESC) AS aliases
+               FROM player_alias
+               JOIN name USING (nameid)
+               WHERE playerid = matches.playerid
+                   AND name ILIKE %(q)s
+           ) AS aliases
+           ORDER BY rank DESC, last_active DESC;""",
+        { 'q': "%{}%".format(q), 'limit': limit, 'offset': offset,
+          # Leave room for players with several matching names
+          'names': (limit + offset) * 4 })
     return results
 
 def get_matches(compid, filters, limit=100, offset=0):
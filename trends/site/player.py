@@ -1,14 +1,16 @@
 # SPDX-License-Identifier: AGPL-3.0-only
 # Copyright (C) 2020-21 Sean Anderson <seanga2@gmail.com>
 
+from array import array
 from collections import defaultdict
+from itertools import accumulate
 
 import flask
 import pylibmc
 
 from .. import cache
-from .util import get_db, get_mc, get_filter_params, get_filter_clauses, get_order, \
-                  get_pagination, last_modified, hash_object
+from .util import get_db, get_mc, get_filter_params, get_filter_clauses, get_keyset, \
+                  get_order, get_pagination, last_modified, hash_object
 from ..util import clamp, classes
 
 player = flask.Blueprint('player', __name__)
@@ -34,14 +36,14 @@ def _get_overview(mc, steamid64):
                    nullif(round_wins + round_losses + round_ties, 0) AS round_winrate
            FROM player
            CROSS JOIN LATERAL (SELECT
-                    count(*) AS logs,
-                    sum(wins) AS round_wins,
-                    sum(losses) AS round_losses,
-                    sum(ties) AS round_ties,
-                    sum((wins > losses)::INT) AS wins,
-                    sum((wins < losses)::INT) AS losses,
-                    sum((wins = losses)::INT) AS ties
-                FROM player_stats
+                    sum(logs) AS logs,
+                    sum(round_wins) AS round_wins,
+                    sum(round_losses) AS round_losses,
+                    sum(round_ties) AS round_ties,
+                    sum(wins) AS wins,
+                    sum(losses) AS losses,
+                    sum(ties) AS ties
+                FROM player_summary
                 WHERE playerid = player.playerid
            ) AS overview
            JOIN name USING (nameid)
@@ -112,12 +114,22 @@ log_order_map = {
     **log_joined_order_map,
 }
 
-def get_logs(extra=False, order_clause="logid DESC", limit=100, offset=0):
+def get_logs(extra=False, order_clause="logid DESC", limit=100, offset=0, keyset=False):
     real_offset = offset
     filters = get_filter_params()
     filter_clauses = get_filter_clauses(filters, 'primary_classid', 'league', 'formatid', 'title',
                                         'mapid', 'time', 'logid', 'duplicate_of')
+    keyset_params = {}
     if not any(col in order_clause for col in log_joined_order_map.values()):
+        if keyset:
+            keyset_clause, keyset_params = get_keyset({
+                'logid': ("logid", 'logid'),
+                'duration': ("log.duration", 'duration'),
+                'date': ("log.time", 'time'),
+            }, key_dir='desc')
+            if keyset_clause:
+                filter_clauses += "\n" + keyset_clause
+                real_offset = 0
         filter_clauses += """
             ORDER BY {} NULLS LAST, logid DESC
             LIMIT %(limit)s OFFSET %(real_offset)s
@@ -178,6 +190,7 @@ def get_logs(extra=False, order_clause="logid DESC", limit=100, offset=0):
            LIMIT %(limit)s OFFSET %(offset)s;""",
         {
             **filters,
+            **keyset_params,
             'playerid': flask.g.playerid,
             'limit': limit,
             'offset': offset,
@@ -365,11 +378,10 @@ def overview(steamid):
                    count
                FROM (SELECT
                        nameid,
-                       count(*) AS count
-                   FROM player_stats
+                       logs AS count
+                   FROM player_alias
                    WHERE playerid = %s
-                   GROUP BY nameid
-                   ORDER BY count(*) DESC
+                   ORDER BY logs DESC
                    LIMIT 10
                ) AS names
                JOIN name USING (nameid)""", (flask.g.playerid,))
@@ -384,7 +396,8 @@ def logs(steamid):
     limit, offset = get_pagination()
     filters = get_filter_params()
     order, order_clause = get_order(log_order_map, 'logid')
-    logs = get_logs(extra=True, order_clause=order_clause, limit=limit, offset=offset)
+    logs = get_logs(extra=True, order_clause=order_clause, limit=limit, offset=offset,
+                    keyset=True)
     return flask.render_template("player/logs.html", logs=logs)
 
 @player.route('/teams')
@@ -398,28 +411,80 @@ def teams(steamid):
     teams = get_teams(get_db(), get_filter_params(), order_clause, limit=limit, offset=offset)
     return flask.render_template("player/teams.html", teams=teams)
 
+peer_order_map = {
+    'logs': "count(*)",
+    'with': '"with"',
+    'against': '"against"',
+    'winrate_with': "winrate_with",
+    'winrate_against': "winrate_against",
+    'time_with': "time_with",
+    'time_against': "time_against",
+    'dpm': "dpm",
+    'dtm': "dtm",
+    'hgm': "hpm_to",
+    'hrm': "hpm_from",
+}
+
+def use_cube(filters, *params):
+    """Whether a cube can be used for some filters
+
+    Cubes are only split up by a few columns (such as league and format), so filtering on anything
+    else requires calculating stats from the logs.
+
+    :param dict filters: The filters from :func:`get_filter_params`
+    :param params: The filters which the cube can't handle
+    :return: Whether none of ``params`` are set
+    :rtype: bool
+    """
+
+    return not any(filters[param] for param in params)
+
 @player.route('/peers')
 def peers(steamid):
     limit, offset = get_pagination()
     filters = get_filter_params()
+    peers = get_db().cursor()
+
+    # peer_stats can only be filtered by the columns it is split up by
+    if use_cube(filters, 'title', 'map', 'date_from_ts', 'date_to_ts', 'players'):
+        filter_clauses = get_filter_clauses(filters, 'league', 'formatid',
+                                            primary_classid='classid')
+        order, order_clause = get_order({ **peer_order_map, 'logs': "sum(logs)" }, 'logs')
+        peers.execute(
+            """SELECT
+                   *,
+                   name,
+                   avatarhash
+               FROM (SELECT
+                       peerid AS playerid,
+                       total(logs_with) AS with,
+                       total(logs_against) AS against,
+                       (sum(wins_with) + 0.5 * sum(ties_with)) / sum(logs_with) AS winrate_with,
+                       (sum(wins_against) + 0.5 * sum(ties_against)) / sum(logs_against)
+                           AS winrate_against,
+                       sum(dmg_with) * 60.0 / sum(duration_with) AS dpm,
+                       sum(dt_with) * 60.0 / sum(duration_with) AS dtm,
+                       sum(healing_to) * 60.0 / sum(duration_with) AS hpm_to,
+                       sum(healing_from) * 60.0 / sum(duration_with) AS hpm_from,
+                       total(duration_with) AS time_with,
+                       total(duration_against) AS time_against
+                   FROM peer_stats
+                   WHERE playerid = %(playerid)s
+                       {}
+                   GROUP BY peerid
+                   ORDER BY {} NULLS LAST
+                   LIMIT %(limit)s OFFSET %(offset)s
+               ) AS peers
+               JOIN player USING (playerid)
+               JOIN name USING (nameid);""".format(filter_clauses, order_clause),
+            { 'playerid': flask.g.playerid, **filters, 'limit': limit, 'offset': offset })
+        return flask.render_template("player/peers.html", peers=peers.fetchall())
+
     filter_clauses = \
         get_filter_clauses(filters, league='log.league', formatid='log.formatid',
                            title='log.title', mapid='log.mapid', time='log.time', logid='log.logid',
                            primary_classid='p1.primary_classid')
-    order, order_clause = get_order({
-        'logs': "count(*)",
-        'with': '"with"',
-        'against': '"against"',
-        'winrate_with': "winrate_with",
-        'winrate_against': "winrate_against",
-        'time_with': "time_with",
-        'time_against': "time_against",
-        'dpm': "dpm",
-        'dtm': "dtm",
-        'hgm': "hpm_to",
-        'hrm': "hpm_from",
-    }, 'logs')
-    peers = get_db().cursor()
+    order, order_clause = get_order(peer_order_map, 'logs')
     peers.execute(
         """SELECT
                *,
@@ -489,79 +554,119 @@ def totals(steamid):
     filters = get_filter_params()
     filter_clauses = get_filter_clauses(filters, *surrogate_filter_columns)
 
+    # player_summary can only be filtered by the columns it is split up by
+    if use_cube(filters, 'title', 'map', 'date_from_ts', 'date_to_ts', 'players'):
+        stats = """SELECT
+                       coalesce(sum(logs), 0) AS logs,
+                       sum(round_wins) AS round_wins,
+                       sum(round_losses) AS round_losses,
+                       sum(round_ties) AS round_ties,
+                       sum(wins) AS wins,
+                       sum(losses) AS losses,
+                       sum(ties) AS ties,
+                       total(kills) AS kills,
+                       total(deaths) AS deaths,
+                       total(assists) AS assists,
+                       total(duration) AS duration,
+                       total(dmg) AS dmg,
+                       total(dt) AS dt,
+                       total(hr) AS hr,
+                       total(airshots) AS airshots,
+                       total(medkits) AS medkits,
+                       total(medkits_hp) AS medkits_hp,
+                       total(backstabs) AS backstabs,
+                       total(headshots) AS headshots,
+                       total(headshots_hit) AS headshots_hit,
+                       total(sentries) AS sentries,
+                       total(cpc) AS cpc,
+                       total(ic) AS ic,
+                       total(healing) AS healing,
+                       total(ubers) AS ubers,
+                       total(drops) AS drops,
+                       total(advantages_lost) AS advantages_lost,
+                       total(deaths_after_uber) AS deaths_after_uber,
+                       total(deaths_before_uber) AS deaths_before_uber
+                   FROM player_summary
+                   WHERE playerid = %(playerid)s
+                       AND NOT duplicate
+                       {}""".format(get_filter_clauses(filters, 'league', 'formatid',
+                                                       primary_classid='classid'))
+    else:
+        stats = """SELECT
+                       count(*) AS logs,
+                       sum(wins) AS round_wins,
+                       sum(losses) AS round_losses,
+                       sum(ties) AS round_ties,
+                       sum((wins > losses)::INT) AS wins,
+                       sum((wins < losses)::INT) AS losses,
+                       sum((wins = losses)::INT) AS ties,
+                       total(ps.kills) AS kills,
+                       total(ps.deaths) AS deaths,
+                       total(ps.assists) AS assists,
+                       total(log.duration) AS duration,
+                       total(ps.dmg) AS dmg,
+                       total(dt) AS dt,
+                       total(hr) AS hr,
+                       total(airshots) AS airshots,
+                       total(medkits) AS medkits,
+                       total(medkits_hp) AS medkits_hp,
+                       total(backstabs) AS backstabs,
+                       total(headshots) AS headshots,
+                       total(headshots_hit) AS headshots_hit,
+                       total(sentries) AS sentries,
+                       total(cpc) AS cpc,
+                       total(ic) AS ic,
+                       total(hs.healing) AS healing,
+                       total(ubers) AS ubers,
+                       total(drops) AS drops,
+                       total(advantages_lost) AS advantages_lost,
+                       total(deaths_after_uber) AS deaths_after_uber,
+                       total(deaths_before_uber) AS deaths_before_uber
+                   FROM player_stats AS ps
+                   LEFT JOIN player_stats_extra AS pse USING (logid, playerid)
+                   JOIN log_nodups AS log USING (logid)
+                   LEFT JOIN medic_stats AS ms USING (logid, playerid)
+                   LEFT JOIN (SELECT
+                           logid,
+                           healer AS playerid,
+                           sum(healing) AS healing
+                       FROM heal_stats
+                       GROUP BY logid, playerid
+                   ) AS hs USING (logid, playerid)
+                   WHERE ps.playerid = %(playerid)s
+                       {}""".format(filter_clauses)
+
     totals = c.cursor()
     totals.execute(
         """SELECT
-               count(*) AS logs,
-               (sum((wins > losses)::INT) + 0.5 * sum((wins = losses)::INT)) /
-                   nullif(count(*), 0) AS winrate,
-               (sum(wins) + 0.5 * sum(ties)) /
-                   nullif(sum(wins + losses + ties), 0) AS round_winrate,
-               sum(wins) AS round_wins,
-               sum(losses) AS round_losses,
-               sum(ties) AS round_ties,
-               sum((wins > losses)::INT) AS wins,
-               sum((wins < losses)::INT) AS losses,
-               sum((wins = losses)::INT) AS ties,
-               total(ps.kills) AS kills,
-               total(ps.deaths) AS deaths,
-               total(ps.assists) AS assists,
-               total(log.duration) AS duration,
-               total(ps.dmg) AS dmg,
-               total(dt) AS dt,
-               total(hr) AS hr,
-               total(airshots) AS airshots,
-               total(medkits) AS medkits,
-               total(medkits_hp) AS medkits_hp,
-               total(backstabs) AS backstabs,
-               total(headshots) AS headshots,
-               total(headshots_hit) AS headshots_hit,
-               total(sentries) AS sentries,
-               total(cpc) AS cpc,
-               total(ic) AS ic,
-               -- Medic stuff
-               total(hs.healing) AS healing,
-               total(ubers) AS ubers,
-               total(drops) AS drops,
-               total(advantages_lost) AS advantages_lost,
-               total(deaths_after_uber) AS deaths_after_uber,
-               total(deaths_before_uber) AS deaths_before_uber,
+               *,
+               (wins + 0.5 * ties) / nullif(logs, 0) AS winrate,
+               (round_wins + 0.5 * round_ties) /
+                   nullif(round_wins + round_losses + round_ties, 0) AS round_winrate,
                -- Averages
-               total(ps.kills) * 30 * 60 / nullif(total(log.duration), 0) AS k30,
-               total(ps.deaths) * 30 * 60 / nullif(total(log.duration), 0) AS d30,
-               total(ps.assists) * 30 * 60 / nullif(total(log.duration), 0) AS a30,
-               total(ps.dmg) * 60 / nullif(total(log.duration), 0) AS dpm,
-               total(ps.dt) * 60 / nullif(total(log.duration), 0) AS dtm,
-               total(hr) * 60 / nullif(total(log.duration), 0) AS hrm,
-               total(airshots) * 30 * 60 / nullif(total(log.duration), 0) AS as30,
-               total(medkits) * 30 * 60 / nullif(total(log.duration), 0) AS mk30,
-               total(medkits_hp) * 60 / nullif(total(log.duration), 0) AS mkhpm,
-               total(backstabs) * 30 * 60 / nullif(total(log.duration), 0) AS bs30,
-               total(headshots) * 30 * 60 / nullif(total(log.duration), 0) AS hs30,
-               total(headshots_hit) * 30 * 60 / nullif(total(log.duration), 0) AS hsh30,
-               total(sentries) * 30 * 60 / nullif(total(log.duration), 0) AS sen30,
-               total(cpc) * 30 * 60 / nullif(total(log.duration), 0) AS cpc30,
-               total(ic) * 30 * 60 / nullif(total(log.duration), 0) AS ic30,
+               kills * 30 * 60 / nullif(duration, 0) AS k30,
+               deaths * 30 * 60 / nullif(duration, 0) AS d30,
+               assists * 30 * 60 / nullif(duration, 0) AS a30,
+               dmg * 60 / nullif(duration, 0) AS dpm,
+               dt * 60 / nullif(duration, 0) AS dtm,
+               hr * 60 / nullif(duration, 0) AS hrm,
+               airshots * 30 * 60 / nullif(duration, 0) AS as30,
+               medkits * 30 * 60 / nullif(duration, 0) AS mk30,
+               medkits_hp * 60 / nullif(duration, 0) AS mkhpm,
+               backstabs * 30 * 60 / nullif(duration, 0) AS bs30,
+               headshots * 30 * 60 / nullif(duration, 0) AS hs30,
+               headshots_hit * 30 * 60 / nullif(duration, 0) AS hsh30,
+               sentries * 30 * 60 / nullif(duration, 0) AS sen30,
+               cpc * 30 * 60 / nullif(duration, 0) AS cpc30,
+               ic * 30 * 60 / nullif(duration, 0) AS ic30,
                -- Medic averages
-               total(hs.healing) * 60 / nullif(total(log.duration), 0) AS hgm,
-               total(ubers) * 30 * 60 / nullif(total(log.duration), 0) AS ub30,
-               total(drops) * 30 * 60 / nullif(total(log.duration), 0) AS drp30,
-               total(advantages_lost) * 30 * 60 / nullif(total(log.duration), 0) AS adl30,
-               total(deaths_after_uber) * 30 * 60 / nullif(total(log.duration), 0) AS dau30,
-               total(deaths_before_uber) * 30 * 60 / nullif(total(log.duration), 0) AS abu30
-           FROM player_stats AS ps
-           LEFT JOIN player_stats_extra AS pse USING (logid, playerid)
-           JOIN log_nodups AS log USING (logid)
-           LEFT JOIN medic_stats AS ms USING (logid, playerid)
-           LEFT JOIN (SELECT
-                   logid,
-                   healer AS playerid,
-                   sum(healing) AS healing
-               FROM heal_stats
-               GROUP BY logid, playerid
-           ) AS hs USING (logid, playerid)
-           WHERE ps.playerid = %(playerid)s
-               {};""".format(filter_clauses),
+               healing * 60 / nullif(duration, 0) AS hgm,
+               ubers * 30 * 60 / nullif(duration, 0) AS ub30,
+               drops * 30 * 60 / nullif(duration, 0) AS drp30,
+               advantages_lost * 30 * 60 / nullif(duration, 0) AS adl30,
+               deaths_after_uber * 30 * 60 / nullif(duration, 0) AS dau30,
+               deaths_before_uber * 30 * 60 / nullif(duration, 0) AS abu30
+           FROM ({}) AS totals;""".format(stats),
         {'playerid': flask.g.playerid, **filters})
     totals = totals.fetchone()
 
@@ -649,51 +754,149 @@ def weapons(steamid):
         {'playerid': flask.g.playerid, **filters})
     return flask.render_template("player/weapons.html", weapons=weapons)
 
-@player.route('/trends')
-def trends(steamid):
-    filters = get_filter_params()
-    window = clamp(flask.request.args.get('window', 20, int), 1, 500)
+# Per-log columns which _trends sums over each window
+trend_columns = {
+    'logid': "log.logid",
+    'time': "time",
+    # Doubled so that ties are integers
+    'result': "2 * (wins > losses)::INT + (wins = losses)::INT",
+    'round_result': "2 * wins + ties",
+    'rounds': "wins + losses + ties",
+    'kills': "ps.kills",
+    'deaths': "ps.deaths",
+    'assists': "ps.assists",
+    'dmg': "ps.dmg",
+    'duration': "log.duration",
+    'dt': "coalesce(ps.dt, 0)",
+    'dt_duration': "coalesce(nullelse(ps.dt, log.duration), 0)",
+    'hsg': "coalesce(hsg, 0)",
+    'hsg_duration': "coalesce(nullelse(hsg, log.duration), 0)",
+    'hsr': "coalesce(hsr, 0)",
+    'hsr_duration': "coalesce(nullelse(hsr, log.duration), 0)",
+}
+
+TREND_LOGS = 10000
+TREND_WINDOW = 500
+
+# The filter hash includes the overview version, so the series is refreshed whenever the player's
+# cache is purged.
+@cache.immutable("trends_{}_{}")
+def _get_trend_series(mc, steamid64, filter_hash, playerid, filters):
+    # Fetch enough extra logs to fill the window of the oldest log we display
     cur = get_db().cursor()
     cur.execute(
-        """SELECT
-               log.logid,
-               time,
-               (sum((wins > losses)::INT) OVER win + 0.5 * sum((wins = losses)::INT) OVER win) /
-                   count(*) OVER win AS winrate,
-               (sum(wins + 0.5 * ties) OVER win) /
-                   nullif(sum(wins + losses + ties) OVER win, 0) AS round_winrate,
-               sum(ps.kills) OVER win * 30.0 * 60 /
-                   nullif(sum(log.duration) OVER win, 0) AS kills,
-               sum(ps.deaths) OVER win * 30.0 * 60 /
-                   nullif(sum(log.duration) OVER win, 0) AS deaths,
-               sum(ps.assists) OVER win * 30.0 * 60 /
-                   nullif(sum(log.duration) OVER win, 0) AS assists,
-               sum(ps.dmg) OVER win * 60.0 / nullif(sum(log.duration) OVER win, 0) AS dpm,
-               sum(ps.dt) OVER win * 60.0 /
-                   nullif(sum(nullelse(ps.dt, log.duration)) OVER win, 0) AS dtm,
-               sum(hsg) OVER win * 60.0 /
-                   nullif(sum(nullelse(hsg, log.duration)) OVER win, 0) AS hpm_given,
-               sum(hsr) OVER win * 60.0 /
-                   nullif(sum(nullelse(hsr, log.duration)) OVER win, 0) AS hpm_recieved
+        """SELECT {}
            FROM log_nodups AS log
            JOIN player_stats AS ps USING (logid)
            WHERE ps.playerid = %(playerid)s
                {}
-           WINDOW win AS (
-               PARTITION BY ps.playerid
-               ORDER BY log.logid
-               GROUPS BETWEEN %(window)s - 1 PRECEDING AND CURRENT ROW
-           ) ORDER BY log.logid DESC
-           LIMIT 10000;""".format(get_filter_clauses(filters, *surrogate_filter_columns)),
-           {'playerid': flask.g.playerid, 'window': window, **filters})
-    trends = list(dict(row) for row in cur)
-    trends.reverse()
-    return flask.render_template("player/trends.html", trends=trends, window=window)
+           ORDER BY log.logid DESC
+           LIMIT %(limit)s;""".format(
+               ", ".join(f"{expr} AS {col}" for col, expr in trend_columns.items()),
+               get_filter_clauses(filters, *surrogate_filter_columns)),
+        {'playerid': playerid, 'limit': TREND_LOGS + TREND_WINDOW - 1, **filters})
+
+    rows = cur.fetchall()
+    rows.reverse()
+    # Store the series compactly, since it is cached as a single value
+    return { col: array('q' if col == 'time' else 'i', (row[i] for row in rows))
+             for i, col in enumerate(trend_columns) }
+
+def _trends(series, window):
+    sums = { col: tuple(accumulate(vals, initial=0)) for col, vals in series.items()
+             if col not in ('logid', 'time') }
+
+    trends = []
+    for i in range(max(len(series['logid']) - TREND_LOGS, 0), len(series['logid'])):
+        start = max(i + 1 - window, 0)
+
+        def total(col):
+            return sums[col][i + 1] - sums[col][start]
+
+        def rate(col, duration, scale):
+            duration = total(duration)
+            return total(col) * scale / duration if duration else None
+
+        rounds = total('rounds')
+        trends.append({
+            'logid': series['logid'][i],
+            'time': series['time'][i],
+            'winrate': total('result') / 2 / (i + 1 - start),
+            'round_winrate': total('round_result') / 2 / rounds if rounds else None,
+            'kills': rate('kills', 'duration', 30 * 60),
+            'deaths': rate('deaths', 'duration', 30 * 60),
+            'assists': rate('assists', 'duration', 30 * 60),
+            'dpm': rate('dmg', 'duration', 60),
+            'dtm': rate('dt', 'dt_duration', 60),
+            'hpm_given': rate('hsg', 'hsg_duration', 60),
+            'hpm_recieved': rate('hsr', 'hsr_duration', 60),
+        })
+    return trends
+
+@player.route('/trends')
+def trends(steamid):
+    filters = get_filter_params()
+    window = clamp(flask.request.args.get('window', 20, int), 1, TREND_WINDOW)
+    series = _get_trend_series(get_mc(), flask.g.steamid,
+                               hash_object(flask.g.player['version'], filters),
+                               flask.g.playerid, filters)
+    return flask.render_template("player/trends.html", trends=_trends(series, window),
+                                 window=window)
 
 @player.route('/maps')
 def maps(steamid):
     filters = get_filter_params()
-    filter_clauses = get_filter_clauses(filters, *surrogate_filter_columns)
+
+    # map_stats can only be filtered by the columns it is split up by
+    if use_cube(filters, 'title', 'date_from_ts', 'date_to_ts', 'players'):
+        filter_clauses = get_filter_clauses(filters, 'league', 'formatid', 'mapid',
+                                            primary_classid='classid')
+        stats = """SELECT
+                       mapid,
+                       sum(logs) AS logs,
+                       sum(round_wins) AS round_wins,
+                       sum(round_losses) AS round_losses,
+                       sum(round_ties) AS round_ties,
+                       sum(wins) AS wins,
+                       sum(losses) AS losses,
+                       sum(ties) AS ties,
+                       total(duration) AS duration,
+                       total(kills) AS kills,
+                       total(deaths) AS deaths,
+                       total(assists) AS assists,
+                       total(dmg) AS dmg,
+                       total(dt) AS dt,
+                       total(hits) AS hits,
+                       total(shots) AS shots
+                   FROM map_stats
+                   WHERE playerid = %(playerid)s
+                       {}
+                   GROUP BY mapid"""
+    else:
+        filter_clauses = get_filter_clauses(filters, *surrogate_filter_columns)
+        stats = """SELECT
+                       mapid,
+                       count(*) AS logs,
+                       sum(wins) AS round_wins,
+                       sum(losses) AS round_losses,
+                       sum(ties) AS round_ties,
+                       sum((wins > losses)::INT) AS wins,
+                       sum((wins < losses)::INT) AS losses,
+                       sum((wins = losses)::INT) AS ties,
+                       total(duration) AS duration,
+                       total(kills) AS kills,
+                       total(deaths) AS deaths,
+                       total(assists) AS assists,
+                       total(dmg) AS dmg,
+                       total(dt) AS dt,
+                       total(hits) AS hits,
+                       total(shots) AS shots
+                   FROM log_nodups
+                   JOIN player_stats using (logid)
+                   WHERE playerid = %(playerid)s
+                       {}
+                   GROUP BY mapid"""
+
     maps = get_db().cursor()
     maps.execute(
         """SELECT
@@ -718,41 +921,8 @@ def maps(steamid):
                total(hits) / nullif(sum(shots), 0.0) AS acc,
                sum(logs) AS logs,
                total(duration) AS duration
-           FROM (WITH map_unprefixed AS (SELECT
-                   mapid,
-                   replace(map, 'workshop/', '') AS map
-               FROM map) SELECT
-                   map,
-                   (SELECT
-                        array_agg(part)
-                    FROM unnest(regexp_split_to_array(lower(map), '[^a-z0-9]+')) AS part
-                    WHERE part != '') AS parts,
-                   stats.*
-               FROM (SELECT
-                       mapid,
-                       count(*) AS logs,
-                       sum(wins) AS round_wins,
-                       sum(losses) AS round_losses,
-                       sum(ties) AS round_ties,
-                       sum((wins > losses)::INT) AS wins,
-                       sum((wins < losses)::INT) AS losses,
-                       sum((wins = losses)::INT) AS ties,
-                       total(duration) AS duration,
-                       total(kills) AS kills,
-                       total(deaths) AS deaths,
-                       total(assists) AS assists,
-                       total(dmg) AS dmg,
-                       total(dt) AS dt,
-                       total(hits) AS hits,
-                       total(shots) AS shots
-                   FROM log_nodups
-                   JOIN player_stats using (logid)
-                   WHERE playerid = %(playerid)s
-                       {}
-                   GROUP BY mapid
-               ) AS stats
-               JOIN map USING (mapid)
-           ) AS maps
+           FROM ({}) AS stats
+           JOIN map USING (mapid)
            GROUP BY ROLLUP (parts[1], parts[2], parts[3:])
            HAVING parts[1] IS NOT NULL
            ORDER BY parts[1] NULLS FIRST,
@@ -760,6 +930,6 @@ def maps(steamid):
                    WHEN grouping(parts[2]) = 0 THEN coalesce(parts[2], '')
                    ELSE NULL
                END NULLS FIRST,
-               parts[3:] COLLATE numeric NULLS FIRST;""".format(filter_clauses),
+               parts[3:] COLLATE numeric NULLS FIRST;""".format(stats.format(filter_clauses)),
         {'playerid': flask.g.playerid, **filters})
     return flask.render_template("player/maps.html", maps=maps.fetchall())
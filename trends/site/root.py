@@ -11,7 +11,7 @@ from mpmetrics.flask import PrometheusMetrics
 from .. import cache
 from .common import get_logs, search_players, logs_last_modified
 from .util import get_db, get_filter_params, get_filter_clauses, get_mc, get_order, \
-                  get_pagination, last_modified
+                  get_pagination, hash_object, last_modified
 from ..steamid import SteamID
 
 root = flask.Blueprint('root', __name__)
@@ -135,10 +135,20 @@ def log_form():
         flask.abort(404)
     return flask.redirect(flask.url_for('.log', logids=logids), 301)
 
-@cache.mutable("log_{}")
-def get_log(mc, logid):
-    log = { 'version': cache.version(mc) }
-    params = { 'logid': logid }
+def _get_logs(mc, logids):
+    """Get several logs at once
+
+    Each query covers all of ``logids``, so this costs the same number of round trips as getting a
+    single log.
+
+    :param mc: The memcached client
+    :param logids: The logs to get
+    :type logids: list of int
+    :return: The logs, in the same order as ``logids``. Logs which do not exist are empty.
+    :rtype: list of dict
+    """
+
+    params = { 'logids': logids }
     cur = get_db().cursor()
 
     cur.execute("""SELECT
@@ -159,11 +169,29 @@ def get_log(mc, logid):
                    FROM log
                    LEFT JOIN format USING (formatid)
                    JOIN map USING (mapid)
-                   WHERE logid = %(logid)s;""", params)
-    if s := cur.fetchone():
-        log['summary'] = dict(s)
-    else:
-        return {}
+                   WHERE logid = ANY(%(logids)s);""", params)
+    logs = {}
+    for s in cur:
+        logs[s['logid']] = {
+            'version': cache.version(mc),
+            'summary': dict(s),
+            'rounds': [],
+            'players': [],
+            'totals': [],
+            'medics': [],
+            'ks': [],
+            'chat': [],
+        }
+
+    def add(name, keep_logid=False):
+        for row in cur:
+            row = dict(row)
+            logid = row['logid'] if keep_logid else row.pop('logid')
+            logs[logid][name].append(row)
+
+    if not logs:
+        return [{} for logid in logids]
+    params['logids'] = list(logs)
 
     cur.execute("""SELECT
                        logid,
@@ -180,11 +208,13 @@ def get_log(mc, logid):
                        red_ubers,
                        blue_ubers
                    FROM round
-                   WHERE logid = %(logid)s;""", params)
-    log['rounds'] = [dict(round) for round in cur]
+                   WHERE logid = ANY(%(logids)s)
+                   ORDER BY logid, seq;""", params)
+    add('rounds', keep_logid=True)
 
     cur.execute(
         """SELECT
+               logid,
                steamid64,
                class_stats,
                hsr AS healing,
@@ -213,6 +243,7 @@ def get_log(mc, logid):
            JOIN name USING (nameid)
            JOIN player USING (playerid)
            LEFT JOIN (SELECT
+                   logid,
                    playerid,
                    array_agg(json_build_object(
                        'classid', classid,
@@ -223,9 +254,10 @@ def get_log(mc, logid):
                        'assists', assists,
                        'dmg', dmg,
                        'weapon_stats', weapon_stats
-                   ) ORDER BY class_stats.duration DESC) AS class_stats
+                   ) ORDER BY class_stats.duration DESC, classid) AS class_stats
                FROM class_stats
                LEFT JOIN (SELECT
+                       logid,
                        playerid,
                        classid,
                        array_agg(json_build_object(
@@ -235,16 +267,16 @@ def get_log(mc, logid):
                            'dmg', dmg,
                            'shots', shots,
                            'hits', hits
-                       ) ORDER BY dmg DESC) AS weapon_stats
+                       ) ORDER BY dmg DESC, weaponid) AS weapon_stats
                    FROM weapon_stats
                    JOIN weapon_pretty USING (weaponid)
-                   WHERE logid = %(logid)s
-                   GROUP BY playerid, classid) AS ws USING (playerid, classid)
+                   WHERE logid = ANY(%(logids)s)
+                   GROUP BY logid, playerid, classid) AS ws USING (logid, playerid, classid)
                JOIN class USING (classid)
-               WHERE logid = %(logid)s
-               GROUP BY playerid) AS cs USING (playerid)
-           WHERE logid = %(logid)s;""", params)
-    log['players'] = [dict(player) for player in cur]
+               WHERE logid = ANY(%(logids)s)
+               GROUP BY logid, playerid) AS cs USING (logid, playerid)
+           WHERE logid = ANY(%(logids)s);""", params)
+    add('players')
 
     # This query could be constructed based on the results of the above queries, but for now it is
     # done separately to aid development
@@ -275,18 +307,20 @@ def get_log(mc, logid):
                    JOIN player_stats USING (logid)
                    LEFT JOIN player_stats_extra USING (logid, playerid)
                    LEFT JOIN (SELECT
+                           logid,
                            healee AS playerid,
                            sum(healing) AS healing
                        FROM heal_stats
-                       WHERE logid = %(logid)s
-                       GROUP BY healee
-                   ) AS hsr USING (playerid)
-                   WHERE logid = %(logid)s
+                       WHERE logid = ANY(%(logids)s)
+                       GROUP BY logid, healee
+                   ) AS hsr USING (logid, playerid)
+                   WHERE logid = ANY(%(logids)s)
                    GROUP BY logid, team
                    ORDER BY logid, team;""", params);
-    log['totals'] = [dict(total) for total in cur]
+    add('totals', keep_logid=True)
 
     cur.execute("""SELECT
+                       logid,
                        team,
                        steamid64,
                        coalesce(cs.duration, log.duration) AS duration,
@@ -308,6 +342,7 @@ def get_log(mc, logid):
                    CROSS JOIN class
                    LEFT JOIN class_stats AS cs USING (logid, playerid, classid)
                    LEFT JOIN (SELECT
+                           logid,
                            healer AS playerid,
                            sum(healing) AS healing,
                            array_agg(json_build_object(
@@ -318,6 +353,7 @@ def get_log(mc, logid):
                            ) ORDER BY healing DESC) AS healees
                        FROM heal_stats
                        JOIN (SELECT
+                               hs.logid,
                                healer,
                                playerid AS healee,
                                sum(duration) AS duration,
@@ -327,17 +363,18 @@ def get_log(mc, logid):
                            JOIN heal_stats AS hs ON (
                                hs.logid = cs.logid
                                AND hs.healee = cs.playerid
-                           ) WHERE hs.logid = %(logid)s
-                           GROUP BY healer, playerid
-                       ) AS cs USING (healer, healee)
+                           ) WHERE hs.logid = ANY(%(logids)s)
+                           GROUP BY hs.logid, healer, playerid
+                       ) AS cs USING (logid, healer, healee)
                        JOIN player ON (player.playerid = healee)
-                       WHERE logid = %(logid)s
-                       GROUP BY healer
-                   ) AS heal_stats USING (playerid)
-                   WHERE logid = %(logid)s AND class = 'medic';""", params);
-    log['medics'] = [dict(medic) for medic in cur]
+                       WHERE logid = ANY(%(logids)s)
+                       GROUP BY logid, healer
+                   ) AS heal_stats USING (logid, playerid)
+                   WHERE logid = ANY(%(logids)s) AND class = 'medic';""", params);
+    add('medics')
 
     cur.execute("""SELECT
+                       logid,
                        event,
                        array_agg(json_build_object(
                            'steamid64', steamid64,
@@ -356,12 +393,13 @@ def get_log(mc, logid):
                    FROM event_stats
                    JOIN player USING (playerid)
                    JOIN event USING (eventid)
-                   WHERE logid = %(logid)s
-                   GROUP BY event;""", params)
+                   WHERE logid = ANY(%(logids)s)
+                   GROUP BY logid, event;""", params)
     for e in cur:
-        log[e['event']] = e['events']
+        logs[e['logid']][e['event']] = e['events']
 
     cur.execute("""SELECT
+                       logid,
                        team,
                        steamid64,
                        name,
@@ -371,11 +409,12 @@ def get_log(mc, logid):
                    JOIN player_stats USING (logid, playerid)
                    JOIN name USING (nameid)
                    JOIN player USING (playerid)
-                   WHERE logid = %(logid)s
-                   ORDER BY killstreak.time;""", params)
-    log['ks'] = [dict(ks) for ks in cur]
+                   WHERE logid = ANY(%(logids)s)
+                   ORDER BY logid, killstreak.time;""", params)
+    add('ks')
 
     cur.execute("""SELECT
+                       logid,
                        team,
                        steamid64,
                        coalesce(name, 'Console') AS name,
@@ -384,11 +423,15 @@ def get_log(mc, logid):
                    LEFT JOIN player_stats USING (logid, playerid)
                    LEFT JOIN name USING (nameid)
                    LEFT JOIN player USING (playerid)
-                   WHERE logid = %(logid)s
-                   ORDER BY seq;""", params)
-    log['chat'] = [dict(msg) for msg in cur]
+                   WHERE logid = ANY(%(logids)s)
+                   ORDER BY logid, seq;""", params)
+    add('chat')
 
-    return log
+    return [logs.get(logid, {}) for logid in logids]
+
+@cache.mutable("log_{}")
+def get_log(mc, logid):
+    return _get_logs(mc, [logid])[0]
 
 @cache.mutable("match_{}_{}")
 def get_match(mc, league, matchid):
@@ -427,45 +470,12 @@ def get_match(mc, league, matchid):
         return m
     return {}
 
-@root.route('/log/<intlist:logids>')
-def log(logids):
-    if not logids:
-        flask.abort(404)
-    elif len(logids) > 10:
-        flask.abort(400)
+@cache.immutable("log_page_{}")
+def _merge_logs(mc, key, logids, logs, matches):
+    """Merge the stats of several logs together for log.html
 
-    logs = {}
-    mc = get_mc()
-    for logid in dict.fromkeys(logids):
-        if log := get_log(mc, logid):
-            logs[logid] = log
-
-    if not logs:
-        flask.abort(404)
-
-    matches = {}
-    logid_set = set(logids)
-    for logid, log in logs.items():
-        key = log['summary']['league'], log['summary']['matchid']
-        if key not in matches:
-            if not (m := get_match(mc, *key)):
-                continue
-            m['full_logs'] = set(m['full_logs'] or ())
-            matches[key] = m
-        matches[key]['full_logs'].add(logid)
-
-    since = 0
-    etag = ([], [])
-    for log in logs.values():
-        since = max(since, log['summary']['updated'])
-        etag[0].append(log['version'])
-    for m in matches.values():
-        since = max(since, m['fetched'])
-        etag[1].append(m['version'])
-
-    # Weak because logs/matches are not invalidated on avatar changes
-    if resp := last_modified(since or None, etag, weak=True):
-        return resp
+    This is cached under ``key``, which must change whenever any of the logs or matches do.
+    """
 
     def player_key(player):
         # 500 is probably greater than any teamid :)
@@ -482,6 +492,7 @@ def log(logids):
             classes = (500,)
         return (*teams, classes, names)
 
+    logid_set = set(logids)
     for m in matches.values():
         m['other_logs'] = list(m['full_logs'].difference(logid_set))
         m['current_logs'] = list(m['full_logs'].intersection(logid_set))
@@ -725,10 +736,68 @@ def log(logids):
     chats = [{ 'title': log['summary']['title'], 'messages': log['chat'] }
              for log in logs.values()]
 
+    return {
+        'logids': list(logs),
+        'logs': [log['summary'] for log in logs.values()],
+        'matches': matches,
+        'rounds': rounds,
+        'players': players,
+        'totals': totals,
+        'medics': medics,
+        'events': events,
+        'killstreaks': killstreaks,
+        'chats': chats,
+    }
+
+@root.route('/log/<intlist:logids>')
+def log(logids):
+    if not logids:
+        flask.abort(404)
+    elif len(logids) > 10:
+        flask.abort(400)
+
+    mc = get_mc()
+    unique_logids = list(dict.fromkeys(logids))
+
+    def batch(mc, args):
+        return _get_logs(mc, [logid for logid, in args])
+
+    logs = { logid: log for logid, log in
+             zip(unique_logids, get_log.multi(mc, [(logid,) for logid in unique_logids], batch))
+             if log }
+
+    if not logs:
+        flask.abort(404)
+
+    matches = {}
+    keys = list(dict.fromkeys((log['summary']['league'], log['summary']['matchid'])
+                              for log in logs.values()))
+    for key, m in zip(keys, get_match.multi(mc, keys)):
+        if m:
+            m['full_logs'] = set(m['full_logs'] or ())
+            matches[key] = m
+
+    for logid, log in logs.items():
+        key = log['summary']['league'], log['summary']['matchid']
+        if key in matches:
+            matches[key]['full_logs'].add(logid)
+
+    since = 0
+    etag = ([], [])
+    for log in logs.values():
+        since = max(since, log['summary']['updated'])
+        etag[0].append(log['version'])
+    for m in matches.values():
+        since = max(since, m['fetched'])
+        etag[1].append(m['version'])
+
+    # Weak because logs/matches are not invalidated on avatar changes
+    if resp := last_modified(since or None, etag, weak=True):
+        return resp
+
+    page_key = hash_object(b"", (unique_logids, etag))
     resp = flask.make_response(flask.render_template("log.html",
-        logids=logs.keys(), logs=[log['summary'] for log in logs.values()], matches=matches,
-        rounds=rounds, players=players, totals=totals, medics=medics, events=events,
-        killstreaks=killstreaks, chats=chats))
+        **_merge_logs(mc, page_key, unique_logids, logs, matches)))
     resp.headers['X-Accel-Expires'] = 0
     return resp
 
@@ -8,18 +8,19 @@ from datetime import datetime, timedelta
 from dateutil import tz
 from hashlib import blake2b, sha256
 from itertools import islice
+import json
+import os
 import pickle
 import sys
 
 import flask
-import psycopg2
+import psycopg2, psycopg2.pool
 from psycopg2.extras import NumericRange
-import pylibmc
 import werkzeug.exceptions, werkzeug.http
 
 from .. import cache
-from ..cache import mc_connect, NoopClient
-from ..sql import db_connect
+from ..cache import ClientPool, LocalCache, LocalClient, NoopClient
+from ..sql import ConnectionPool
 from ..util import clamp, League
 
 def last_modified(since, etag=None, weak=True):
@@ -49,32 +50,56 @@ def global_context(name):
         return decorated
     return decorator
 
+def get_db_pool():
+    app = flask.current_app
+    pool = app.extensions.get('db_pool')
+    # uWSGI loads the app before forking its workers, so each worker needs to make its own pool
+    if pool is None or pool.pid != os.getpid():
+        timeout = app.config['TIMEOUT']
+
+        def setup(c):
+            c.cursor().execute("SET statement_timeout = %s;", (timeout,))
+
+        # Some pages use temporary tables
+        pool = ConnectionPool(app.config['DATABASE'], "{} site".format(sys.argv[0]),
+                              size=int(app.config['DATABASE_POOL_SIZE']), setup=setup,
+                              reset="DISCARD TEMP;")
+        app.extensions['db_pool'] = pool
+    return pool
+
 @global_context('db_conn')
 def get_db():
     try:
-        c = db_connect(flask.current_app.config['DATABASE'],
-                       "{} {}".format(sys.argv[0], flask.request.path))
-    except psycopg2.OperationalError as error:
+        return get_db_pool().get(timeout=int(flask.current_app.config['TIMEOUT']) / 1000)
+    except (psycopg2.OperationalError, psycopg2.pool.PoolError) as error:
         flask.current_app.logger.exception("Could not connect to database")
         raise werkzeug.exceptions.ServiceUnavailable() from error
-    c.cursor().execute("SET statement_timeout = %s;", (flask.current_app.config['TIMEOUT'],))
-    return c
 
 def put_db(exception):
     if db := flask.g.pop('db_conn', None):
-        db.close()
+        get_db_pool().put(db)
+
+# Shared by all requests handled by this process
+local_cache = LocalCache()
+
+def get_mc_pool():
+    app = flask.current_app
+    pool = app.extensions.get('mc_pool')
+    if pool is None or pool.pid != os.getpid():
+        pool = ClientPool(app.config['MEMCACHED_SERVERS'])
+        app.extensions['mc_pool'] = pool
+    return pool
 
 @global_context('mc_conn')
 def get_mc():
-    mc = mc_connect(flask.current_app.config['MEMCACHED_SERVERS'])
-    try:
-        # pylibmc doesn't actually connect until we make a request. Force a connection failure
-        # up front so we can log it and use a fallback client
-        mc.get('connection_test')
+    mc = get_mc_pool().get()
+    if isinstance(mc, NoopClient):
         return mc
-    except pylibmc.ConnectionError as error:
-        flask.current_app.logger.exception("Could not connect to memcached")
-    return NoopClient()
+    return LocalClient(mc, local_cache)
+
+def put_mc(exception):
+    if mc := flask.g.pop('mc_conn', None):
+        get_mc_pool().put(mc.mc if isinstance(mc, LocalClient) else mc)
 
 @cache.mutable("view_{}")
 def _view_updated(mc, view):
@@ -94,7 +119,7 @@ def view_updated(view, pretty=None):
 
     c = get_db()
     with c.cursor() as cur:
-        cur.execute("SELECT pg_try_advisory_lock_shared(%s::REGCLASS::BIGINT)", (view,))
+        cur.execute("SELECT pg_try_advisory_xact_lock_shared(%s::REGCLASS::BIGINT)", (view,))
         if not cur.fetchone()[0]:
             msg = f"The {pretty or view} is being refreshed. Please try again later"
             raise werkzeug.exceptions.ServiceUnavailable(msg)
@@ -280,8 +305,77 @@ def get_order(column_map, default_column, default_dir='desc'):
 Page = namedtuple('Page', ('limit', 'offset'))
 
 @global_context('page')
-def get_pagination(limit=100, offset=0):
+def get_pagination(limit=100, offset=0, max_limit=None):
     args = flask.request.args
-    limit = clamp(args.get('limit', limit, int), 0, limit)
+    limit = clamp(args.get('limit', limit, int), 0, limit if max_limit is None else max_limit)
     offset = max(args.get('offset', offset, int), 0)
     return Page(limit, offset)
+
+Keyset = namedtuple('Keyset', ('column', 'key'))
+
+def get_keyset(columns, key=('logid', 'logid'), key_dir=None):
+    """Get a filter clause to continue from a pagination cursor
+
+    Instead of an offset, the next page may be requested with a ``cursor`` holding the sort
+    column and key of the last row on the current page. This lets the database seek directly to
+    the next row using an index on the sort column, instead of reading and discarding every row
+    before the offset. The caller must order by the sort column and then by ``key``, and should
+    ignore the offset if the returned clause is not empty.
+
+    :param columns: The columns (indexed by sort name) which support cursors. These must not be
+                    nullable. Each entry is a tuple of the column's SQL expression and its name in
+                    the results.
+    :type columns: dict of str: tuple(str, str)
+    :param key: A unique column to break ties with, in the same format as ``columns``
+    :type key: tuple(str, str)
+    :param str key_dir: The direction ``key`` is ordered in, or ``None`` to use the sort direction
+    :return: A filter clause and its parameters
+    :rtype: tuple(str, dict)
+    """
+
+    order = flask.g.order[0]
+    if order['sort'] not in columns:
+        return "", {}
+
+    column, result_column = columns[order['sort']]
+    key, result_key = key
+    flask.g.keyset = Keyset(result_column, result_key)
+    if not (cursor := flask.request.args.get('cursor', type=str)):
+        return "", {}
+
+    try:
+        sort, dir, value, last = json.loads(base64.urlsafe_b64decode(cursor))
+        if not isinstance(value, int) or not isinstance(last, int):
+            raise ValueError
+    except (TypeError, ValueError):
+        flask.abort(400, "Invalid cursor")
+    if sort != order['sort'] or dir != order['sort_dir']:
+        flask.abort(400, "Cursor does not match the sort order")
+
+    op = '<' if dir == 'desc' else '>'
+    key_op = '<' if (key_dir or dir) == 'desc' else '>'
+    clause = f"""AND {column} {op}= %(cursor_value)s
+                 AND ({column} {op} %(cursor_value)s OR {key} {key_op} %(cursor_key)s)"""
+    return clause, { 'cursor_value': value, 'cursor_key': last }
+
+def next_cursor(rows):
+    """Get the cursor for the page after ``rows``
+
+    :param rows: The rows on this page, filtered by :py:func:`get_keyset`
+    :type rows: list of dict
+    :return: The cursor, or ``None`` if this page does not support cursors or is the last page
+    :rtype: str
+    """
+
+    return last_cursor(len(rows), rows[-1] if rows else None)
+
+def last_cursor(count, last):
+    """Like :py:func:`next_cursor`, but only using the number of rows and the last row"""
+
+    if 'keyset' not in flask.g or count != flask.g.page.limit or not count:
+        return None
+
+    order = flask.g.order[0]
+    cursor = (order['sort'], order['sort_dir'], last[flask.g.keyset.column],
+              last[flask.g.keyset.key])
+    return base64.urlsafe_b64encode(json.dumps(cursor).encode()).decode()
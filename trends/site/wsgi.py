@@ -23,7 +23,7 @@ from .leaderboards import leaderboards
 from .league import league
 from .player import player
 from .root import root, metrics_extension
-from .util import put_db
+from .util import next_cursor, put_db, put_mc
 
 @flask.before_render_template.connect_via(blinker.ANY)
 def trace_template_start(app, template, context):
@@ -44,10 +44,11 @@ def trace_template_error(app, exception):
 class EnvConfig:
     DATABASE = "postgresql:///trends"
     TIMEOUT = 20000
+    DATABASE_POOL_SIZE = 4
     MEMCACHED_SERVERS = "127.0.0.1:11211"
 
     def __init__(self):
-        for name in ("DATABASE", "TIMEOUT", "MEMCACHED_SERVERS"):
+        for name in ("DATABASE", "TIMEOUT", "DATABASE_POOL_SIZE", "MEMCACHED_SERVERS"):
             val = os.environ.get(name)
             if val is not None:
                 setattr(self, name, val)
@@ -211,6 +212,7 @@ def create_app():
     app.after_request(cache_control)
     app.after_request(set_validators)
     app.teardown_appcontext(put_db)
+    app.teardown_appcontext(put_mc)
     app.url_defaults(StaticHashDefaults(app))
     app.url_map.converters['intlist'] = IntListConverter
 
@@ -228,6 +230,7 @@ def create_app():
     app.jinja_env.policies["json.dumps_kwargs"] = { 'default': json_default }
     app.jinja_env.globals.update(zip=zip)
     app.jinja_env.globals.update(wlt_class=wlt_class)
+    app.jinja_env.globals.update(next_cursor=next_cursor)
     app.jinja_env.add_extension('jinja2.ext.do')
     app.jinja_env.add_extension('jinja2.ext.i18n')
     app.jinja_env.install_null_translations(newstyle=True)
@@ -5,8 +5,11 @@ import contextlib
 import logging
 import os
 import sys
+import threading
+import time
 
-import psycopg2, psycopg2.extras
+from mpmetrics import Gauge, Histogram
+import psycopg2, psycopg2.extras, psycopg2.pool
 from sentry_sdk import Hub, tracing_utils
 
 from .steamid import SteamID
@@ -22,6 +25,21 @@ def disable_tracing():
     finally:
         tracing_disabled = False
 
+@contextlib.contextmanager
+def disable_wait_callback():
+    """Temporarily disable the wait callback installed by db_connect
+
+    Some operations (such as ``COPY``) are not supported when there is a wait callback. While the
+    callback is disabled, queries cannot be interrupted.
+    """
+
+    callback = psycopg2.extensions.get_wait_callback()
+    psycopg2.extensions.set_wait_callback(None)
+    try:
+        yield
+    finally:
+        psycopg2.extensions.set_wait_callback(callback)
+
 class TracingCursor(psycopg2.extras.DictCursor):
     def _log(self, query, vars, paramstyle=psycopg2.paramstyle):
         if tracing_disabled:
@@ -51,6 +69,109 @@ def db_connect(url, name=None):
     return psycopg2.connect(url, cursor_factory=TracingCursor,
                             application_name=name or " ".join(sys.argv))
 
+POOL_WAIT = Histogram('db_pool_wait_seconds', "Time spent waiting for a database connection")
+POOL_USED = Gauge('db_pool_connections_used', "Database connections in use")
+POOL_IDLE = Gauge('db_pool_connections_idle', "Idle database connections")
+
+class ConnectionPool:
+    """A bounded pool of database connections
+
+    Connections are opened on demand, up to ``size`` at once. Once they are all in use, callers
+    wait for one to be returned. Connections are rolled back and then reset with ``reset`` when
+    they are returned, so they must not be used in autocommit mode. Any session state should be set
+    up once by ``setup``. Pools cannot be shared between processes.
+
+    :param str url: Database to connect to
+    :param str name: The application name for each connection
+    :param int size: The maximum number of connections
+    :param setup: A function called with each new connection
+    :param str reset: SQL to clean up any session state left over from the last user
+    :param float ping_after: Check that connections which have been idle for this many seconds
+                             are still alive before handing them out
+    """
+
+    def __init__(self, url, name=None, size=4, setup=None, reset=None, ping_after=30):
+        self.url = url
+        self.name = name
+        self.setup = setup
+        self.reset = reset
+        self.ping_after = ping_after
+        self.pid = os.getpid()
+        self.slots = threading.BoundedSemaphore(size)
+        self.lock = threading.Lock()
+        self.idle = []
+
+    def _healthy(self, c, last_used):
+        if c.closed or c.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            return False
+        if time.monotonic() - last_used < self.ping_after:
+            return True
+
+        try:
+            c.cursor().execute("SELECT 1;")
+            c.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def get(self, timeout=None):
+        """Get a connection from the pool
+
+        :param float timeout: The maximum number of seconds to wait for a connection
+        :return: A database connection
+        :raises psycopg2.pool.PoolError: if no connection became available in time
+        :raises psycopg2.OperationalError: if a new connection could not be opened
+        """
+
+        start = time.monotonic()
+        if not self.slots.acquire(timeout=timeout):
+            raise psycopg2.pool.PoolError("Timed out waiting for a connection")
+        POOL_WAIT.observe(time.monotonic() - start)
+
+        try:
+            while True:
+                with self.lock:
+                    if not self.idle:
+                        break
+                    c, last_used = self.idle.pop()
+                POOL_IDLE.dec()
+                if self._healthy(c, last_used):
+                    POOL_USED.inc()
+                    return c
+                c.close()
+
+            c = db_connect(self.url, self.name)
+            if self.setup:
+                self.setup(c)
+                c.commit()
+        except:
+            self.slots.release()
+            raise
+        POOL_USED.inc()
+        return c
+
+    def put(self, c):
+        """Return a connection to the pool
+
+        :param c: A connection from :py:meth:`get`
+        """
+
+        POOL_USED.dec()
+        try:
+            if not c.closed:
+                c.rollback()
+                if self.reset:
+                    c.cursor().execute(self.reset)
+                    c.commit()
+                with self.lock:
+                    self.idle.append((c, time.monotonic()))
+                POOL_IDLE.inc()
+                return
+        except psycopg2.Error:
+            c.close()
+        finally:
+            self.slots.release()
+
 def db_schema(cur):
     with open("{}/schema.sql".format(os.path.dirname(__file__))) as schema:
         cur.execute(schema.read())
@@ -78,7 +199,7 @@ def _db_init(cur):
         upper = (i + 1) * 1e5
         logging.info("Creating partition %s", tbl)
 
-        cur.execute(f"CREATE TABLE {tbl} (LIKE log_json);")
+        cur.execute(f"CREATE TABLE {tbl} (LIKE log_json INCLUDING CONSTRAINTS);")
         cur.execute(f"ALTER TABLE {tbl} ADD CHECK (logid >= %s AND logid < %s);", (lower, upper))
         cur.execute(f"""INSERT INTO {tbl}
                         SELECT *
@@ -118,6 +239,14 @@ log_tables = (('log', 'logid'), ('log_json', 'logid'), ('round', 'logid, seq'),
              ('event_stats', 'playerid, logid, eventid'), ('chat', 'logid, seq'))
 
 def delete_logs(cur):
+    # The leaderboards need to be recalculated for anyone who played in these logs
+    cur.execute("""INSERT INTO cube_dirty (playerid)
+                   SELECT DISTINCT playerid
+                   FROM player_stats_backing
+                   WHERE logid IN (SELECT
+                           logid
+                       FROM to_delete
+                   ) ON CONFLICT DO NOTHING;""")
     # Done in reverse order as import_log
     # Don't delete log or log_json so we know not to parse this log again
     for table in log_tables[:1:-1]: